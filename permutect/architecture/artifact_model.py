@@ -1,4 +1,5 @@
 from itertools import chain
+from typing import List
 
 import torch
 from torch import Tensor, IntTensor
@@ -16,14 +17,14 @@ from permutect.architecture.gated_mlp import GatedRefAltMLP
 from permutect.architecture.mlp import MLP
 from permutect.architecture.set_pooling import SetPooling
 from permutect.data.datum import DEFAULT_GPU_FLOAT, DEFAULT_CPU_FLOAT
-from permutect.data.reads_batch import ReadsBatch
+from permutect.data.reads_batch import ReadsBatch, DownsampledReadsBatch
 from permutect.data.prefetch_generator import prefetch_generator
 from permutect.metrics.evaluation_metrics import EmbeddingMetrics
 from permutect.data.count_binning import alt_count_bin_index, alt_count_bin_name, MAX_ALT_COUNT
 from permutect.parameters import ModelParameters
 from permutect.sets.ragged_sets import RaggedSets
-from permutect.misc_utils import unfreeze, freeze, gpu_if_available
-from permutect.utils.enums import Variation, Epoch
+from permutect.misc_utils import unfreeze, freeze, gpu_if_available, mixed_precision
+from permutect.utils.enums import Variation, Epoch, Precision
 
 
 class BatchOutput:
@@ -77,6 +78,7 @@ class ArtifactModel(torch.nn.Module):
         self._dtype = DEFAULT_GPU_FLOAT if device != torch.device("cpu") else DEFAULT_CPU_FLOAT
         self._haplotypes_length = haplotypes_length # this is the length of ref and alt concatenated horizontally ie twice the CNN length
         self._params = params
+        self._precision = Precision.FP32    # a runtime setting, not saved with the model
 
         # embeddings of reads, info, and reference sequence prior to the transformer layers
         self.read_embedding = MLP([num_read_features] + params.read_layers, batch_normalize=params.batch_normalize, dropout_p=params.dropout_p)
@@ -115,6 +117,12 @@ class ArtifactModel(torch.nn.Module):
             dropout_p=self._params.dropout_p), adversarial_strength=0.01).to(device=self._device, dtype=self._dtype)
         self.num_sources = num_sources
 
+    def set_precision(self, precision: Precision):
+        """
+        precision of the feature computation.  Parameters, feature clustering, and calibration stay in full precision.
+        """
+        self._precision = precision
+
     def pooling_dimension(self) -> int:
         return self.set_pooling.output_dimension()
 
@@ -146,21 +154,11 @@ class ArtifactModel(torch.nn.Module):
     # so, for example, "re" means a 2D tensor with all reads in the batch stacked and "bre" means a 3D tensor indexed
     # first by variant within the batch, then the read within the variant
     def calculate_features(self, batch: ReadsBatch, weight_range: float = 0) -> Tensor:
-        ref_counts_b, alt_counts_b = batch.get_ref_counts(), batch.get_alt_counts()
-        total_ref, total_alt = torch.sum(ref_counts_b).item(), torch.sum(alt_counts_b).item()
-
-        read_embeddings_re = self.read_embedding.forward(batch.get_reads_re().to(dtype=self._dtype))
-        info_embeddings_be = self.info_embedding.forward(batch.get_info_be().to(dtype=self._dtype))
-        ref_seq_embeddings_be = self.haplotypes_cnn(batch.get_one_hot_haplotypes_bcs().to(dtype=self._dtype))
-        info_and_seq_be = torch.hstack((info_embeddings_be, ref_seq_embeddings_be))
-        info_and_seq_re = torch.vstack((torch.repeat_interleave(info_and_seq_be, repeats=ref_counts_b, dim=0),
-                                       torch.repeat_interleave(info_and_seq_be, repeats=alt_counts_b, dim=0)))
-        reads_info_seq_re = torch.hstack((read_embeddings_re, info_and_seq_re))
-
-        # TODO: might be a bug if every datum in batch has zero ref reads?
-        ref_bre = RaggedSets.from_flattened_tensor_and_sizes(reads_info_seq_re[:total_ref], ref_counts_b)
-        alt_bre = RaggedSets.from_flattened_tensor_and_sizes(reads_info_seq_re[total_ref:], alt_counts_b)
-        _, transformed_alt_bre = self.ref_alt_reads_encoder.forward(ref_bre, alt_bre)
+        with mixed_precision(self._device, self._precision):
+            read_embeddings_re, info_and_seq_be, ref_seq_embeddings_be = self.embed_reads_info_and_haplotypes(batch)
+            total_ref = torch.sum(batch.get_ref_counts()).item()
+            result_be = self.encode_and_pool(read_embeddings_re[:total_ref], read_embeddings_re[total_ref:], info_and_seq_be,
+                                             batch.get_ref_counts(), batch.get_alt_counts())
 
         # TODO: this old code has the random weighting logic which might still be valuable
         """
@@ -174,9 +172,57 @@ class ArtifactModel(torch.nn.Module):
 
         alt_means_ve = sums_over_rows(transformed_alt_re * normalized_alt_weights_r[:,None], alt_counts)
         """
-        result_be = self.set_pooling.forward(transformed_alt_bre)
+        # everything downstream of the features is in full precision
+        return result_be.to(dtype=self._dtype), ref_seq_embeddings_be.to(dtype=self._dtype) # ref seq embeddings are useful later
+
+    def embed_reads_info_and_haplotypes(self, batch: ReadsBatch):
+        read_embeddings_re = self.read_embedding.forward(batch.get_reads_re().to(dtype=self._dtype))
+        info_and_seq_be, ref_seq_embeddings_be = self.embed_info_and_haplotypes(batch.get_info_be().to(dtype=self._dtype),
+            batch.get_one_hot_haplotypes_bcs().to(dtype=self._dtype))
+        return read_embeddings_re, info_and_seq_be, ref_seq_embeddings_be
+
+    def embed_info_and_haplotypes(self, info_be: Tensor, one_hot_haplotypes_bcs: Tensor):
+        info_embeddings_be = self.info_embedding.forward(info_be)
+        ref_seq_embeddings_be = self.haplotypes_cnn(one_hot_haplotypes_bcs)
+        return torch.hstack((info_embeddings_be, ref_seq_embeddings_be)), ref_seq_embeddings_be
 
-        return result_be, ref_seq_embeddings_be # ref seq embeddings are useful later
+    def encode_and_pool(self, ref_embeddings_re: Tensor, alt_embeddings_re: Tensor, info_and_seq_be: Tensor,
+                        ref_counts_b: IntTensor, alt_counts_b: IntTensor) -> Tensor:
+        ref_info_seq_re = torch.hstack((ref_embeddings_re, torch.repeat_interleave(info_and_seq_be, repeats=ref_counts_b, dim=0)))
+        alt_info_seq_re = torch.hstack((alt_embeddings_re, torch.repeat_interleave(info_and_seq_be, repeats=alt_counts_b, dim=0)))
+
+        # TODO: might be a bug if every datum in batch has zero ref reads?
+        ref_bre = RaggedSets.from_flattened_tensor_and_sizes(ref_info_seq_re, ref_counts_b)
+        alt_bre = RaggedSets.from_flattened_tensor_and_sizes(alt_info_seq_re, alt_counts_b)
+        _, transformed_alt_bre = self.ref_alt_reads_encoder.forward(ref_bre, alt_bre)
+        return self.set_pooling.forward(transformed_alt_bre)
+
+    def calculate_features_of_views(self, parent_batch: ReadsBatch, downsampled_batches: List[DownsampledReadsBatch]) -> List[Tensor]:
+        """
+        features of a batch and of downsampled views of it, in that order, in a single fused forward pass.  Reads, info,
+        and haplotypes are embedded once, the read embeddings of each view are gathered from those of the parent, and
+        all views are encoded and pooled together as one super-batch.
+
+        Since the encoder and pooling act on each read set separately this is equivalent to separate forward passes,
+        except that views share dropout masks.  Batch norm statistics, however, would be pooled over views, so with batch
+        norm we fall back to separate passes.
+        """
+        views = [parent_batch] + downsampled_batches
+        if self._params.batch_normalize:
+            return [self.calculate_features(view)[0] for view in views]
+
+        with mixed_precision(self._device, self._precision):
+            read_embeddings_re, info_and_seq_be, _ = self.embed_reads_info_and_haplotypes(parent_batch)
+            ref_embeddings, alt_embeddings = [], []
+            for view in views:
+                view_read_embeddings_re = read_embeddings_re if view is parent_batch else read_embeddings_re[view.read_indices]
+                total_ref = torch.sum(view.get_ref_counts()).item()
+                ref_embeddings.append(view_read_embeddings_re[:total_ref])
+                alt_embeddings.append(view_read_embeddings_re[total_ref:])
+
+            features_ve = self.encode_and_pool(torch.vstack(ref_embeddings), torch.vstack(alt_embeddings), info_and_seq_be.repeat(len(views), 1),
+                torch.cat([view.get_ref_counts() for view in views]), torch.cat([view.get_alt_counts() for view in views]))
+        return list(torch.split(features_ve.to(dtype=self._dtype), parent_batch.size()))
 
     def calculate_logits(self, batch: ReadsBatch):
         features_be, _ = self.calculate_features(batch)
@@ -207,6 +253,28 @@ class ArtifactModel(torch.nn.Module):
                            calibrated_logits_bk=calibrated_logits_bk,
                            weights=weights_b, source_weights=weights_b*source_weights_b)
 
+    def compute_batch_outputs_of_views(self, parent_batch: ReadsBatch, downsampled_batches: List[DownsampledReadsBatch], balancer: Balancer) -> List[BatchOutput]:
+        """
+        the same as compute_batch_output for a parent batch and each of its downsampled views, in that order, using a
+        single fused forward pass
+        """
+        views = [parent_batch] + downsampled_batches
+        # as in separate calls to compute_batch_output, the balancer sees the downsampled views before the parent
+        weights = [balancer.process_batch_and_compute_weights(view) for view in downsampled_batches + [parent_batch]]
+        weights = weights[-1:] + weights[:-1]
+
+        features_ve = torch.vstack(self.calculate_features_of_views(parent_batch, downsampled_batches))
+        calibrated_logits_v, uncalibrated_logits_v, calibrated_logits_vk = self.feature_clustering.calculate_logits(features_ve,
+            ref_counts_b=torch.cat([view.get_ref_counts() for view in views]), alt_counts_b=torch.cat([view.get_alt_counts() for view in views]),
+            var_types_b=torch.cat([view.get_variant_types() for view in views]))
+
+        batch_size = parent_batch.size()
+        return [BatchOutput(features_be=features_be, uncalibrated_logits_b=uncalibrated_logits_b, calibrated_logits_b=calibrated_logits_b,
+                            calibrated_logits_bk=calibrated_logits_bk, weights=weights_b, source_weights=weights_b * source_weights_b)
+                for features_be, uncalibrated_logits_b, calibrated_logits_b, calibrated_logits_bk, (weights_b, source_weights_b) in
+                zip(torch.split(features_ve, batch_size), torch.split(uncalibrated_logits_v, batch_size), torch.split(calibrated_logits_v, batch_size),
+                    torch.split(calibrated_logits_vk, batch_size), weights)]
+
     def make_dict_for_saving(self, artifact_log_priors=None, artifact_spectra=None):
         return {constants.STATE_DICT_NAME: self.state_dict(),
                 constants.HYPERPARAMS_NAME: self._params,
@@ -0,0 +1,123 @@
+import json
+import warnings
+import zipfile
+
+import torch
+import torch_scatter     # registers the segment ops used by the compiled graph
+from torch import Tensor
+
+from permutect.architecture.artifact_model import ArtifactModel
+from permutect.data.reads_batch import ReadsBatch
+from permutect.utils.enums import Variation
+
+COMPILED_MODEL_METADATA_NAME = 'permutect_compiled_artifact_model.json'
+
+# sizes of the random example batches used to trace the graph and then to check it on a batch of different shape
+TRACE_BATCH_SIZE, CHECK_BATCH_SIZE = 17, 11
+MAX_EXAMPLE_COUNT = 8
+
+
+class ArtifactInferenceGraph(torch.nn.Module):
+    """
+    The inference path of an artifact model as a function of plain tensors, from reads to calibrated artifact logits and
+    features.  Ref and alt reads are separate inputs so that nothing in the graph depends on the value of a tensor.
+    """
+    def __init__(self, model: ArtifactModel):
+        super(ArtifactInferenceGraph, self).__init__()
+        self.model = model
+
+    def forward(self, ref_reads_re: Tensor, alt_reads_re: Tensor, info_be: Tensor, one_hot_haplotypes_bcs: Tensor,
+                ref_counts_b: Tensor, alt_counts_b: Tensor, var_types_b: Tensor):
+        ref_embeddings_re = self.model.read_embedding.forward(ref_reads_re)
+        alt_embeddings_re = self.model.read_embedding.forward(alt_reads_re)
+        info_and_seq_be, _ = self.model.embed_info_and_haplotypes(info_be, one_hot_haplotypes_bcs)
+        features_be = self.model.encode_and_pool(ref_embeddings_re, alt_embeddings_re, info_and_seq_be, ref_counts_b, alt_counts_b)
+        calibrated_logits_b, _, _ = self.model.feature_clustering.calculate_logits(features_be, ref_counts_b, alt_counts_b, var_types_b)
+        return calibrated_logits_b, features_be
+
+
+def graph_inputs(batch: ReadsBatch, dtype):
+    total_ref = torch.sum(batch.get_ref_counts()).item()
+    reads_re = batch.get_reads_re().to(dtype=dtype)
+    return (reads_re[:total_ref], reads_re[total_ref:], batch.get_info_be().to(dtype=dtype),
+            batch.get_one_hot_haplotypes_bcs().to(dtype=dtype), batch.get_ref_counts(), batch.get_alt_counts(), batch.get_variant_types())
+
+
+def make_example_inputs(model: ArtifactModel, batch_size: int, generator: torch.Generator):
+    """
+    random graph inputs with the model's dimensions and varied read counts, including zero ref reads
+    """
+    device, dtype = model._device, model._dtype
+    ref_counts_b = torch.randint(0, MAX_EXAMPLE_COUNT, (batch_size, ), generator=generator).to(device)
+    alt_counts_b = torch.randint(1, MAX_EXAMPLE_COUNT, (batch_size, ), generator=generator).to(device)
+    num_read_features = model.read_embedding.input_dimension()
+    ref_reads_re = torch.randn(torch.sum(ref_counts_b).item(), num_read_features, generator=generator).to(device, dtype)
+    alt_reads_re = torch.randn(torch.sum(alt_counts_b).item(), num_read_features, generator=generator).to(device, dtype)
+    info_be = torch.randn(batch_size, model.info_embedding.input_dimension(), generator=generator).to(device, dtype)
+
+    # ref and alt channels of one-hot bases, as in ReadsBatch.get_one_hot_haplotypes_bcs
+    seq_length = model.haplotypes_length() // 2
+    bases_bs = torch.randint(0, 5, (batch_size * 2, seq_length), generator=generator)
+    one_hot_haplotypes_bcs = torch.nn.functional.one_hot(bases_bs, num_classes=5).permute(0, 2, 1).reshape(batch_size, 10, seq_length)
+    var_types_b = torch.randint(0, len(Variation), (batch_size, ), generator=generator)
+    return (ref_reads_re, alt_reads_re, info_be, one_hot_haplotypes_bcs.to(device, dtype), ref_counts_b, alt_counts_b, var_types_b.to(device))
+
+
+@torch.inference_mode(False)
+def compile_artifact_model(model: ArtifactModel) -> torch.jit.ScriptModule:
+    """
+    trace the inference graph of a full-precision model, then freeze its parameters into the graph and apply
+    TorchScript's inference optimizations, which fuse elementwise chains and fold constants.  The result is checked
+    against the eager model on a batch of a different shape than the one it was traced on.
+    """
+    model.eval()
+    graph = ArtifactInferenceGraph(model).eval()
+    generator = torch.Generator().manual_seed(0)
+    trace_inputs = make_example_inputs(model, TRACE_BATCH_SIZE, generator)
+    check_inputs = make_example_inputs(model, CHECK_BATCH_SIZE, generator)
+
+    with torch.no_grad(), warnings.catch_warnings():
+        # RaggedSets' shape assertions are evaluated once when tracing, which is harmless
+        warnings.simplefilter("ignore", torch.jit.TracerWarning)
+        traced = torch.jit.trace(graph, trace_inputs, check_trace=False)
+        compiled = torch.jit.optimize_for_inference(torch.jit.freeze(traced))
+
+        for expected, actual in zip(graph(*check_inputs), compiled(*check_inputs)):
+            if not torch.allclose(expected, actual, rtol=1e-3, atol=1e-4):
+                raise Exception("compiled artifact model disagrees with the original model")
+    return compiled
+
+
+def save_compiled_artifact_model(compiled: torch.jit.ScriptModule, model: ArtifactModel, path):
+    metadata = {'pooling_dimension': model.pooling_dimension(), 'device': str(model._device)}
+    torch.jit.save(compiled, path, _extra_files={COMPILED_MODEL_METADATA_NAME: json.dumps(metadata)})
+
+
+def is_compiled_artifact_model(path) -> bool:
+    if not zipfile.is_zipfile(path):
+        return False
+    with zipfile.ZipFile(path) as archive:
+        return any(name.endswith('extra/' + COMPILED_MODEL_METADATA_NAME) for name in archive.namelist())
+
+
+class CompiledArtifactModel:
+    """
+    A compiled artifact model loaded without the Python modules of the original.  It provides the inference methods of
+    ArtifactModel that filtering uses.  Devices are part of the traced graph, so it runs on the device it was compiled on.
+    """
+    def __init__(self, path):
+        extra_files = {COMPILED_MODEL_METADATA_NAME: ''}
+        self._graph = torch.jit.load(path, _extra_files=extra_files)
+        self._metadata = json.loads(extra_files[COMPILED_MODEL_METADATA_NAME])
+        self._device = torch.device(self._metadata['device'])
+        self._dtype = torch.float32
+
+    def pooling_dimension(self) -> int:
+        return self._metadata['pooling_dimension']
+
+    def calculate_logits(self, batch: ReadsBatch):
+        """
+        the same as ArtifactModel.calculate_logits, except that only calibrated logits and features are computed
+        """
+        calibrated_logits_b, features_be = self._graph(*graph_inputs(batch, self._dtype))
+        return calibrated_logits_b, None, None, features_be
@@ -7,6 +7,7 @@ from torch.nn import Parameter
 
 from permutect.architecture.monotonic import MonoDense
 from permutect.data.count_binning import MAX_REF_COUNT, MAX_ALT_COUNT
+from permutect.misc_utils import full_precision
 from permutect.metrics import plotting
 from permutect.utils.enums import Variation
 
@@ -39,21 +40,26 @@ class FeatureClustering(nn.Module):
         self.distance_calibration = MonoDense(3 + FeatureClustering.VAR_TYPE_EMBEDDING_DIM, calibration_hidden_layer_sizes + [1], 1, 0)
         self.var_type_embeddings_ve = Parameter(torch.rand(len(Variation), FeatureClustering.VAR_TYPE_EMBEDDING_DIM))
 
+    # distances and calibration are numerically sensitive, so they are computed in full precision even within a
+    # mixed-precision region
     def centroid_distances(self, features_be: Tensor) -> Tensor:
-        batch_size = len(features_be)
-        centroids_bke = self.centroids_ke.view(1, self.num_clusters, self.feature_dim)
-        features_bke = features_be.view(batch_size, 1, self.feature_dim)
-        diff_bke = centroids_bke - features_bke
-        dist_bk = torch.norm(diff_bke, dim=-1) * self.centroid_distance_normalization
-        return dist_bk
+        with full_precision(features_be.device):
+            centroids_bke = self.centroids_ke.view(1, self.num_clusters, self.feature_dim)
+            features_bke = features_be.to(dtype=self.centroids_ke.dtype).view(-1, 1, self.feature_dim)
+            diff_bke = centroids_bke - features_bke
+            dist_bk = torch.norm(diff_bke, dim=-1) * self.centroid_distance_normalization
+            return dist_bk
 
     def calculate_logits(self, features_be: Tensor, ref_counts_b: IntTensor, alt_counts_b: IntTensor, var_types_b: IntTensor):
-        batch_size = len(features_be)
+        with full_precision(features_be.device):
+            return self._calculate_logits(features_be, ref_counts_b, alt_counts_b, var_types_b)
+
+    def _calculate_logits(self, features_be: Tensor, ref_counts_b: IntTensor, alt_counts_b: IntTensor, var_types_b: IntTensor):
         dist_bk = self.centroid_distances(features_be)
 
         # flatten b,k indices to a single pseudo-batch index, then unflatten
         cal_dist_bk = self.calibrated_distances(dist_bk.view(-1), repeat_interleave(ref_counts_b, self.num_clusters),
-            repeat_interleave(alt_counts_b, self.num_clusters), repeat_interleave(var_types_b, self.num_clusters)).view(batch_size, self.num_clusters)
+            repeat_interleave(alt_counts_b, self.num_clusters), repeat_interleave(var_types_b, self.num_clusters)).view(-1, self.num_clusters)
 
         uncal_logits_bk = -dist_bk
         cal_logits_bk = -cal_dist_bk
@@ -1,6 +1,6 @@
 from collections import defaultdict
 from itertools import chain
-from math import ceil
+from math import ceil, inf
 
 import torch
 from matplotlib import pyplot as plt
@@ -8,18 +8,25 @@ from torch import Tensor, IntTensor
 from torch.utils.tensorboard import SummaryWriter
 from tqdm.autonotebook import trange, tqdm
 
+from permutect import constants
 from permutect.architecture.spectra.artifact_spectra import ArtifactSpectra
 from permutect.architecture.spectra.normal_artifact_spectrum import NormalArtifactSpectrum
 from permutect.architecture.spectra.overdispersed_binomial_mixture import OverdispersedBinomialMixture
 from permutect.architecture.spectra.somatic_spectrum import SomaticSpectrum
-from permutect.data.datum import DEFAULT_GPU_FLOAT, DEFAULT_CPU_FLOAT
-from permutect.data.posterior_data import PosteriorBatch
+from permutect.data.datum import DEFAULT_GPU_FLOAT, DEFAULT_CPU_FLOAT, Datum
+from permutect.data.posterior_data import PosteriorBatch, PosteriorDataset
 from permutect.data.prefetch_generator import prefetch_generator
 from permutect.metrics import plotting
-from permutect.data.count_binning import NUM_ALT_COUNT_BINS, count_from_alt_bin_index, alt_count_bin_index
+from permutect.data.count_binning import NUM_ALT_COUNT_BINS, count_from_alt_bin_index, alt_count_bin_indices
 from permutect.misc_utils import StreamingAverage, gpu_if_available, backpropagate
 from permutect.utils.stats_utils import beta_binomial_log_lk
 from permutect.utils.enums import Variation, Call
+from permutect.utils.math_utils import theoretical_f1_thresholds
+
+# defaults for full-batch fitting of AF spectra and priors
+DEFAULT_SPECTRUM_CHUNK_SIZE = 65536
+DEFAULT_SPECTRUM_TOLERANCE = 1e-5
+DEFAULT_SPECTRUM_PATIENCE = 5
 
 
 # TODO: write unit test asserting that this comes out to zero when counts are zero
@@ -211,14 +218,7 @@ class PosteriorModel(torch.nn.Module):
                 #loss = - torch.sum(confidence_mask * log_evidence) / (torch.sum(confidence_mask) + 0.000001)
 
                 # note that we don't multiply by batch size because we take the mean of log evidence above
-                # however, we must sum over variant types since each ignored site is simultaneously a missing non-SNV,
-                # a missing non-INSERTION etc
-                # we use a germline allele frequency of 0.001 for the missing sites but it doesn't really matter
-                for var_type_idx, variant_type in enumerate(Variation):
-                    log_priors = torch.nn.functional.log_softmax(self.make_unnormalized_priors_bc(torch.LongTensor([var_type_idx]).to(device=self._device, dtype=self._dtype), torch.tensor([0.001], device=self._device)), dim=1)
-                    log_seq_error_prior = log_priors.squeeze()[Call.SEQ_ERROR]
-                    missing_loss = -ignored_to_non_ignored_ratio * log_seq_error_prior  
-                    loss += missing_loss
+                loss += self.missing_sites_loss(ignored_to_non_ignored_ratio)
 
                 backpropagate(optimizer, loss)
 
@@ -237,82 +237,172 @@ class PosteriorModel(torch.nn.Module):
 
             if summary_writer is not None:
                 summary_writer.add_scalar("spectrum negative log evidence", epoch_loss.get(), epoch)
+                self.write_spectra_summary(summary_writer, epoch)
+
+    def learn_priors_and_spectra_full_batch(self, posterior_dataset: PosteriorDataset, max_iterations: int, ignored_to_non_ignored_ratio: float,
+                                            summary_writer: SummaryWriter = None, learning_rate: float = 0.001, chunk_size: int = DEFAULT_SPECTRUM_CHUNK_SIZE,
+                                            tolerance: float = DEFAULT_SPECTRUM_TOLERANCE, patience: int = DEFAULT_SPECTRUM_PATIENCE):
+        """
+        Alternative to learn_priors_and_spectra in which the whole posterior dataset sits on the device and each iteration
+        is a single optimizer step on the loss over all data, evaluated in a few large chunks whose gradients are accumulated.
+        The M step uses the posteriors of the same pass.  Iteration stops when the relative change in the loss has been
+        less than tolerance for patience consecutive iterations, or after max_iterations.
+        """
+        spectra_and_prior_params = chain(self.somatic_spectrum.parameters(), self.artifact_spectra.parameters(),
+                                         [self._unnormalized_priors_vc], self.normal_artifact_spectra.parameters())
+        optimizer = torch.optim.Adam(spectra_and_prior_params, lr=learning_rate)
+
+        # the batches are slices of the dataset tensors, converted to the model's float dtype just once
+        posterior_dataset.to(self._device)
+        chunks = [posterior_dataset.get_batch(start, start + chunk_size).copy_to(self._device, self._dtype)
+                  for start in range(0, len(posterior_dataset), chunk_size)]
+        types_n = posterior_dataset.data_be[:, Datum.VARIANT_TYPE_IDX]
+
+        previous_loss, num_stalled_iterations = inf, 0
+        for iteration in trange(1, max_iterations + 1, desc="AF spectra iteration"):
+            optimizer.zero_grad(set_to_none=True)
+            posteriors_lbc = []
+            loss = self.missing_sites_loss(ignored_to_non_ignored_ratio)
+            loss.backward()
+            loss = loss.detach()
+
+            batch: PosteriorBatch
+            for batch in chunks:
+                relative_posteriors = self.log_relative_posteriors_bc(batch)
+                chunk_loss = -torch.sum(torch.logsumexp(relative_posteriors, dim=1)) / len(posterior_dataset)
+                chunk_loss.backward()
+                loss += chunk_loss.detach()
+                posteriors_lbc.append(torch.softmax(relative_posteriors, dim=-1).detach())
+
+            optimizer.step()
+            self.update_priors_m_step(torch.vstack(posteriors_lbc), types_n, ignored_to_non_ignored_ratio)
+
+            loss = loss.item()
+            if summary_writer is not None:
+                summary_writer.add_scalar("spectrum negative log evidence", loss, iteration)
 
-                for depth in [9, 19, 30, 50, 100]:
-                    art_spectra_fig, art_spectra_axs = plot_artifact_spectra(self.artifact_spectra, depth)
-                    summary_writer.add_figure("Artifact AF Spectra at depth = " + str(depth), art_spectra_fig, epoch)
-
-                #normal_artifact_spectra_fig, normal_artifact_spectra_axs = plot_artifact_spectra(self.normal_artifact_spectra)
-                #summary_writer.add_figure("Normal Artifact AF Spectra", normal_artifact_spectra_fig, epoch)
-
-                var_spectra_fig, var_spectra_axs = plt.subplots()
-                frac, dens = self.somatic_spectrum.spectrum_density_vs_fraction()
-                var_spectra_axs.plot(frac.detach().numpy(), dens.detach().numpy(), label="spectrum")
-                var_spectra_axs.set_title("Variant AF Spectrum")
-                summary_writer.add_figure("Variant AF Spectra", var_spectra_fig, epoch)
-
-                # bar plot of log priors -- data is indexed by call type name, and x ticks are variant types
-                log_prior_bar_plot_data = defaultdict(list)
-                for var_type_idx, variant_type in enumerate(Variation):
-                    log_priors = torch.nn.functional.log_softmax(self.make_unnormalized_priors_bc(torch.LongTensor([var_type_idx]).to(device=self._device, dtype=self._dtype), torch.tensor([0.001])), dim=-1)
-                    log_priors_cpu = log_priors.squeeze().detach().cpu()
-                    for call_type in (Call.SOMATIC, Call.ARTIFACT, Call.NORMAL_ARTIFACT):
-                        log_prior_bar_plot_data[call_type.name].append(log_priors_cpu[call_type])
-
-                prior_fig, prior_ax = plotting.grouped_bar_plot(log_prior_bar_plot_data, [v_type.name for v_type in Variation], "log priors")
-                summary_writer.add_figure("log priors", prior_fig, epoch)
-
-                # normal artifact joint tumor-normal spectra
-                # na_fig, na_axes = plt.subplots(1, len(Variation), sharex='all', sharey='all', squeeze=False)
-                # for variant_index, variant_type in enumerate(Variation):
-                #    self.normal_artifact_spectra[variant_index].density_plot_on_axis(na_axes[0, variant_index])
-                # plotting.tidy_subplots(na_fig, na_axes, x_label="tumor fraction", y_label="normal fraction",
-                #                       row_labels=[""], column_labels=[var_type.name for var_type in Variation])
-                # summary_writer.add_figure("normal artifact spectra", na_fig, epoch)
+            # the M step can increase the loss at first, so we look for the loss to stop changing, not to stop decreasing
+            num_stalled_iterations = (num_stalled_iterations + 1) if abs(previous_loss - loss) < tolerance * abs(loss) else 0
+            previous_loss = loss
+            if num_stalled_iterations >= patience:
+                print(f"AF spectra converged after {iteration} iterations.")
+                break
+
+        if summary_writer is not None:
+            self.write_spectra_summary(summary_writer, iteration)
+
+    def missing_sites_loss(self, ignored_to_non_ignored_ratio: float) -> Tensor:
+        """
+        loss, normalized per non-ignored site, of the sites in which no evidence of variation was found.  We must sum over
+        variant types since each ignored site is simultaneously a missing non-SNV, a missing non-INSERTION etc.  We use a
+        germline allele frequency of 0.001 for the missing sites but it doesn't really matter
+        """
+        loss = 0
+        for var_type_idx, variant_type in enumerate(Variation):
+            log_priors = torch.nn.functional.log_softmax(self.make_unnormalized_priors_bc(torch.LongTensor([var_type_idx]).to(device=self._device, dtype=self._dtype), torch.tensor([0.001], device=self._device)), dim=1)
+            log_seq_error_prior = log_priors.squeeze()[Call.SEQ_ERROR]
+            loss += -ignored_to_non_ignored_ratio * log_seq_error_prior
+        return loss
+
+    def write_spectra_summary(self, summary_writer: SummaryWriter, epoch: int):
+        for depth in [9, 19, 30, 50, 100]:
+            art_spectra_fig, art_spectra_axs = plot_artifact_spectra(self.artifact_spectra, depth)
+            summary_writer.add_figure("Artifact AF Spectra at depth = " + str(depth), art_spectra_fig, epoch)
+
+        #normal_artifact_spectra_fig, normal_artifact_spectra_axs = plot_artifact_spectra(self.normal_artifact_spectra)
+        #summary_writer.add_figure("Normal Artifact AF Spectra", normal_artifact_spectra_fig, epoch)
+
+        var_spectra_fig, var_spectra_axs = plt.subplots()
+        frac, dens = self.somatic_spectrum.spectrum_density_vs_fraction()
+        var_spectra_axs.plot(frac.detach().numpy(), dens.detach().numpy(), label="spectrum")
+        var_spectra_axs.set_title("Variant AF Spectrum")
+        summary_writer.add_figure("Variant AF Spectra", var_spectra_fig, epoch)
+
+        # bar plot of log priors -- data is indexed by call type name, and x ticks are variant types
+        log_prior_bar_plot_data = defaultdict(list)
+        for var_type_idx, variant_type in enumerate(Variation):
+            log_priors = torch.nn.functional.log_softmax(self.make_unnormalized_priors_bc(torch.LongTensor([var_type_idx]).to(device=self._device, dtype=self._dtype), torch.tensor([0.001])), dim=-1)
+            log_priors_cpu = log_priors.squeeze().detach().cpu()
+            for call_type in (Call.SOMATIC, Call.ARTIFACT, Call.NORMAL_ARTIFACT):
+                log_prior_bar_plot_data[call_type.name].append(log_priors_cpu[call_type])
+
+        prior_fig, prior_ax = plotting.grouped_bar_plot(log_prior_bar_plot_data, [v_type.name for v_type in Variation], "log priors")
+        summary_writer.add_figure("log priors", prior_fig, epoch)
+
+        # normal artifact joint tumor-normal spectra
+        # na_fig, na_axes = plt.subplots(1, len(Variation), sharex='all', sharey='all', squeeze=False)
+        # for variant_index, variant_type in enumerate(Variation):
+        #    self.normal_artifact_spectra[variant_index].density_plot_on_axis(na_axes[0, variant_index])
+        # plotting.tidy_subplots(na_fig, na_axes, x_label="tumor fraction", y_label="normal fraction",
+        #                       row_labels=[""], column_labels=[var_type.name for var_type in Variation])
+        # summary_writer.add_figure("normal artifact spectra", na_fig, epoch)
 
     # map of Variant type to probability threshold that maximizes F1 score
-    # loader is a Dataloader whose collate_fn is the PosteriorBatch constructor
-    def calculate_probability_thresholds(self, posterior_loader, summary_writer: SummaryWriter = None, germline_mode: bool = False):
+    # loader yields PosteriorBatches
+    def calculate_probability_thresholds(self, posterior_loader, summary_writer: SummaryWriter = None, germline_mode: bool = False,
+                                         make_plots: bool = True):
         self.train(False)
-        error_probs_by_type = {var_type: [] for var_type in Variation}   # includes both artifact and seq errors
+        error_probs_lb, var_types_lb, alt_counts_lb = [], [], []   # error probs include both artifact and seq errors
 
-        error_probs_by_type_by_cnt = {var_type: [[] for _ in range(NUM_ALT_COUNT_BINS)] for var_type in Variation}
-
-        # TODO: use the EvaluationMetrics class to generate the theoretical ROC curve
-        # TODO: then delete plotting.plot_theoretical_roc_on_axis
         batch: PosteriorBatch
         for batch in tqdm(prefetch_generator(posterior_loader), mininterval=10, total=len(posterior_loader)):
             # TODO: should this be the original alt counts instead?
-            alt_counts_b = batch.get_alt_counts().cpu().tolist()
-            # 0th column is true variant, subtract it from 1 to get error prob
-            error_probs_b = self.error_probabilities_b(batch, germline_mode).cpu().tolist()
+            alt_counts_lb.append(batch.get_alt_counts())
+            var_types_lb.append(batch.get_variant_types())
+            error_probs_lb.append(self.error_probabilities_b(batch, germline_mode).detach())
+
+        error_probs_n, var_types_n = torch.cat(error_probs_lb), torch.cat(var_types_lb)
+        count_bins_n = alt_count_bin_indices(torch.cat(alt_counts_lb)).clamp(min=0, max=NUM_ALT_COUNT_BINS - 1)
+
+        # find the best thresholds by variant type and by variant type and alt count bin in a single batched operation
+        # groups are the variant types followed by (variant type, count bin) pairs
+        num_types = len(Variation)
+        groups_n = torch.cat((var_types_n, num_types + var_types_n * NUM_ALT_COUNT_BINS + count_bins_n))
+        thresholds_g, _, _ = theoretical_f1_thresholds(error_probs_n.repeat(2), groups_n, num_types * (1 + NUM_ALT_COUNT_BINS))
+        thresholds_g = thresholds_g.cpu()
+        thresholds_by_type = {var_type: thresholds_g[var_type].item() for var_type in Variation}
+        thresholds_by_type_and_cnt = thresholds_g[num_types:].view(num_types, NUM_ALT_COUNT_BINS)
+
+        if summary_writer is not None:
+            for var_type in Variation:
+                for count_bin in range(NUM_ALT_COUNT_BINS):
+                    summary_writer.add_scalar(f"error probability threshold for {var_type.name} by alt count",
+                                              thresholds_by_type_and_cnt[var_type, count_bin].item(), count_from_alt_bin_index(count_bin))
 
-            for var_type, alt_count, error_prob in zip(batch.get_variant_types().cpu().tolist(), alt_counts_b, error_probs_b):
-                error_probs_by_type[var_type].append(error_prob)
-                error_probs_by_type_by_cnt[var_type][alt_count_bin_index(alt_count)].append(error_prob)
+        if make_plots and summary_writer is not None:
+            self.plot_theoretical_rocs(summary_writer, error_probs_n.cpu(), var_types_n.cpu(), count_bins_n.cpu())
 
-        thresholds_by_type = {}
+        return thresholds_by_type
+
+    # TODO: use the EvaluationMetrics class to generate the theoretical ROC curve
+    # TODO: then delete plotting.plot_theoretical_roc_on_axis
+    def plot_theoretical_rocs(self, summary_writer: SummaryWriter, error_probs_n: Tensor, var_types_n: Tensor, count_bins_n: Tensor):
         roc_fig, roc_axes = plt.subplots(1, len(Variation), sharex='all', sharey='all', squeeze=False)
         roc_by_cnt_fig, roc_by_cnt_axes = plt.subplots(1, len(Variation), sharex='all', sharey='all', squeeze=False, figsize=(10, 6), dpi=100)
+        count_bin_labels = [str(count_from_alt_bin_index(count_bin)) for count_bin in range(NUM_ALT_COUNT_BINS)]
         for var_type in Variation:
+            type_mask_n = var_types_n == var_type
             # plot all count ROC curves for this variant type
-            count_bin_labels = [str(count_from_alt_bin_index(count_bin)) for count_bin in range(NUM_ALT_COUNT_BINS)]
-            _ = plotting.plot_theoretical_roc_on_axis(error_probs_by_type_by_cnt[var_type], count_bin_labels, roc_by_cnt_axes[0, var_type])
-            best_threshold = plotting.plot_theoretical_roc_on_axis([error_probs_by_type[var_type]], [""], roc_axes[0, var_type])[0][0]
-
-            # TODO: the theoretical ROC might need to return the best threshold for this
-            thresholds_by_type[var_type] = best_threshold
+            error_probs_by_cnt = [error_probs_n[type_mask_n & (count_bins_n == count_bin)].tolist() for count_bin in range(NUM_ALT_COUNT_BINS)]
+            plotting.plot_theoretical_roc_on_axis(error_probs_by_cnt, count_bin_labels, roc_by_cnt_axes[0, var_type])
+            plotting.plot_theoretical_roc_on_axis([error_probs_n[type_mask_n].tolist()], [""], roc_axes[0, var_type])
 
         variation_types = [var_type.name for var_type in Variation]
         plotting.tidy_subplots(roc_by_cnt_fig, roc_by_cnt_axes, x_label="sensitivity", y_label="precision",
                                row_labels=[""], column_labels=variation_types)
         plotting.tidy_subplots(roc_fig, roc_axes, x_label="sensitivity", y_label="precision",
                                row_labels=[""], column_labels=variation_types)
-        if summary_writer is not None:
-            summary_writer.add_figure("theoretical ROC by variant type ", roc_fig)
-            summary_writer.add_figure("theoretical ROC by variant type and alt count ", roc_by_cnt_fig)
-
-        return thresholds_by_type
+        summary_writer.add_figure("theoretical ROC by variant type ", roc_fig)
+        summary_writer.add_figure("theoretical ROC by variant type and alt count ", roc_by_cnt_fig)
+
+    # save a fitted model along with its error probability thresholds, eg to annotate VCF shards separately
+    def save_model(self, path, error_probability_thresholds, germline_mode: bool = False):
+        torch.save({constants.STATE_DICT_NAME: self.state_dict(),
+                    constants.NUM_BASE_FEATURES_NAME: self.num_base_features,
+                    constants.NO_GERMLINE_MODE_NAME: self.no_germline_mode,
+                    constants.HET_BETA_NAME: self.het_beta,
+                    constants.GERMLINE_MODE_NAME: germline_mode,
+                    constants.ERROR_PROBABILITY_THRESHOLDS_NAME: error_probability_thresholds}, path)
 
     def update_priors_m_step(self, posteriors_nc, types_n, ignored_to_non_ignored_ratio):
         # update the priors in an EM-style M step.  We'll need the counts of each call type vs variant type
@@ -335,3 +425,14 @@ class PosteriorModel(torch.nn.Module):
 
             self._unnormalized_priors_vc[:, Call.SEQ_ERROR] = 0
             self._unnormalized_priors_vc[:, Call.GERMLINE] = -9999 if self.no_germline_mode else 0
+
+
+def load_posterior_model(path, device: torch.device = gpu_if_available()):
+    saved = torch.load(path, map_location=device)
+
+    # the initial priors are overwritten by the state dict
+    model = PosteriorModel(variant_log_prior=0.0, artifact_log_prior=0.0, num_base_features=saved[constants.NUM_BASE_FEATURES_NAME],
+                           no_germline_mode=saved[constants.NO_GERMLINE_MODE_NAME], device=device, het_beta=saved[constants.HET_BETA_NAME])
+    model.load_state_dict(saved[constants.STATE_DICT_NAME])
+    model.to(model._dtype)
+    return model, saved[constants.ERROR_PROBABILITY_THRESHOLDS_NAME], saved[constants.GERMLINE_MODE_NAME]
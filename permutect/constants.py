@@ -43,8 +43,26 @@ NUM_EPOCHS_NAME = 'num_epochs'
 NUM_CALIBRATION_EPOCHS_NAME = 'num_calibration_epochs'
 INFERENCE_BATCH_SIZE_NAME = 'inference_batch_size'
 NUM_WORKERS_NAME = 'num_workers'
+TWO_PASS_NORMALIZATION_NAME = 'two_pass_normalization'
+TRAINING_NORMALIZATION_NAME = 'training_normalization'
+DATASET_MEMORY_BUDGET_NAME = 'dataset_memory_budget'
+SHUFFLE_BLOCK_SIZE_NAME = 'shuffle_block_size'
+SHUFFLE_WINDOW_SIZE_NAME = 'shuffle_window_size'
+PRECISION_NAME = 'precision'
+READ_BUDGET_NAME = 'read_budget'
+BUCKET_BY_READ_COUNT_NAME = 'bucket_by_read_count'
+DISTRIBUTED_TIMEOUT_HOURS_NAME = 'distributed_timeout_hours'
 NUM_SPECTRUM_ITERATIONS_NAME = 'num_spectrum_iterations'
 SPECTRUM_LEARNING_RATE_NAME = 'spectrum_learning_rate'
+FULL_BATCH_SPECTRA_NAME = 'full_batch_spectra'
+MAX_SPECTRUM_ITERATIONS_NAME = 'max_spectrum_iterations'
+SPECTRUM_TOLERANCE_NAME = 'spectrum_tolerance'
+NO_ROC_PLOTS_NAME = 'no_roc_plots'
+FILTER_MODE_NAME = 'filter_mode'
+POSTERIOR_SHARDS_NAME = 'posterior_shards'
+POSTERIOR_MODEL_NAME = 'posterior_model'
+ARTIFACT_CACHE_DIR_NAME = 'artifact_cache_dir'
+ERROR_PROBABILITY_THRESHOLDS_NAME = 'error_probability_thresholds'
 
 DATASET_EDIT_TYPE_NAME = 'dataset_edit'
 
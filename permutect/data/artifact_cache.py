@@ -0,0 +1,63 @@
+import hashlib
+import os
+
+import numpy as np
+import torch
+
+from permutect.data.datum import Datum
+from permutect.misc_utils import file_checksum
+from permutect.utils.enums import Precision
+
+ARTIFACT_CACHE_SUFFIX = '.artifact_cache'
+
+
+def artifact_cache_file(cache_dir, dataset_file, artifact_model_file, normalization_file=None, chunk_size: int = None,
+                        precision: Precision = Precision.FP32) -> str:
+    """
+    path of the cached artifact model outputs for a dataset.  These depend on the contents of the dataset, the model,
+    the precision, and the training normalization if there is one.  Otherwise each chunk of the dataset is normalized
+    separately, so they also depend on the chunk size.
+    """
+    digest = hashlib.sha256()
+    for file in (dataset_file, artifact_model_file, normalization_file):
+        digest.update(("none" if file is None else file_checksum(file)).encode())
+    if normalization_file is None:
+        digest.update(str(chunk_size).encode())
+    if precision != Precision.FP32:     # so that full-precision keys are unchanged
+        digest.update(precision.value.encode())
+    return os.path.join(cache_dir, digest.hexdigest() + ARTIFACT_CACHE_SUFFIX)
+
+
+def cache_artifact_model_outputs(model_outputs, cache_file, feature_dimension: int):
+    """
+    pass through a generator of (datum arrays, artifact logits, features) batches, saving all of them to the cache file
+    once it is exhausted.  Only the scalar datum elements are saved.  The file is written atomically so that concurrent
+    runs never read an incomplete cache.  Outputs of an empty dataset are cached too, with features of the given
+    dimension, so that the feature dimension is always available from the cache.
+    """
+    data_arrays, logits, features = [np.zeros((0, Datum.NUM_SCALAR_ELEMENTS), dtype=np.int64)], [np.zeros(0, dtype=np.float32)], \
+        [torch.zeros(0, feature_dimension, dtype=torch.float16)]
+    for data_be, artifact_logits_b, features_be in model_outputs:
+        data_arrays.append(data_be[:, :Datum.NUM_SCALAR_ELEMENTS])
+        logits.append(artifact_logits_b)
+        features.append(features_be.to(dtype=torch.float16))
+        yield data_be, artifact_logits_b, features_be
+
+    os.makedirs(os.path.dirname(os.path.abspath(cache_file)), exist_ok=True)
+    temporary_file = f"{cache_file}.{os.getpid()}.tmp"
+    torch.save([np.vstack(data_arrays), np.concatenate(logits), torch.vstack(features)], temporary_file, pickle_protocol=4)
+    os.replace(temporary_file, cache_file)
+
+
+def cached_feature_dimension(cache_file) -> int:
+    return torch.load(cache_file)[2].shape[1]
+
+
+def generate_cached_artifact_model_outputs(cache_file, batch_size: int):
+    """
+    generate (datum arrays, artifact logits, features) batches from a cache file
+    """
+    data_be, artifact_logits_b, features_be = torch.load(cache_file)
+    for start in range(0, len(data_be), batch_size):
+        stop = start + batch_size
+        yield data_be[start:stop], artifact_logits_b[start:stop], features_be[start:stop]
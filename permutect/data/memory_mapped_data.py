@@ -0,0 +1,307 @@
+"""
+On-disk dataset format that is memory-mapped in place, without extraction or copying.
+
+A dataset is an uncompressed tarfile containing the members
+
+    header.json         format version and the exact shapes and dtypes of the arrays, hence their sizes in memory
+    reads.npy           float16 array of the reads of all data, shape (total read count, num read features)
+    data.npy            int64 array of all datum arrays, shape (num data, datum array length)
+    read_offsets.npy    int64 array of shape (num data + 1).  The reads of the nth datum, ref reads followed by alt
+                        reads, are the rows read_offsets[n]:read_offsets[n+1] of reads.npy
+    metadata.npy        structured array of compact per-datum columns (see METADATA_DTYPE) copied from data.npy, so that
+                        totals, folds, and samplers never need to touch the datum arrays or reads
+
+Because the tarfile is uncompressed, each .npy member is stored contiguously and np.memmap can open it at its offset
+within the tarfile.  The tarfile may contain other members, such as a saved normalization.
+"""
+import io
+import json
+import os
+import tarfile
+import tempfile
+from typing import List
+
+import numpy as np
+import torch
+
+from permutect.data.count_binning import cap_ref_count, cap_alt_count
+from permutect.data.datum import Datum
+from permutect.data.reads_datum import ReadsDatum
+from permutect.misc_utils import ConsistentValue, read_tar_index, write_tar_index
+
+FORMAT_VERSION = 1
+
+HEADER_FILE_NAME = 'header.json'
+READS_FILE_NAME = 'reads.npy'
+DATA_FILE_NAME = 'data.npy'
+READ_OFFSETS_FILE_NAME = 'read_offsets.npy'
+METADATA_FILE_NAME = 'metadata.npy'
+
+READS_DTYPE = np.float16
+DATA_DTYPE = np.int64
+
+# metadata columns and the datum array indices they come from
+METADATA_COLUMNS = [('label', np.int8, Datum.LABEL_IDX), ('source', np.int16, Datum.SOURCE_IDX),
+                    ('variant_type', np.int8, Datum.VARIANT_TYPE_IDX), ('ref_count', np.int32, Datum.REF_COUNT_IDX),
+                    ('alt_count', np.int32, Datum.ALT_COUNT_IDX), ('contig', np.int32, Datum.CONTIG_IDX),
+                    ('position', np.int64, Datum.POSITION_IDX)]
+METADATA_DTYPE = np.dtype([(name, dtype) for name, dtype, _ in METADATA_COLUMNS])
+
+
+def metadata_from_data_array(data_be: np.ndarray) -> np.ndarray:
+    """
+    structured metadata array from a 2D array whose rows are datum arrays
+    """
+    result = np.empty(len(data_be), dtype=METADATA_DTYPE)
+    for name, _, datum_idx in METADATA_COLUMNS:
+        result[name] = data_be[:, datum_idx]
+    return result
+
+
+def is_memory_mapped_dataset(data_tarfile) -> bool:
+    index = read_tar_index(data_tarfile)
+    if index is not None:
+        return any(name == HEADER_FILE_NAME for name, _, _ in index)
+    with tarfile.open(data_tarfile) as tar:
+        return HEADER_FILE_NAME in tar.getnames()
+
+
+class MemoryMappedData:
+    """
+    the reads, datum arrays, and read offsets of a dataset, memory-mapped from the dataset tarfile
+    """
+    def __init__(self, data_tarfile):
+        offsets_and_sizes = get_member_offsets_and_sizes(data_tarfile)
+        header_offset, header_size = offsets_and_sizes[HEADER_FILE_NAME]
+        with open(data_tarfile, 'rb') as file:
+            file.seek(header_offset)
+            header = json.loads(file.read(header_size))
+        assert header['format_version'] == FORMAT_VERSION, f"Unsupported dataset format version {header['format_version']}"
+        self.header = header
+
+        self.reads_re = memory_map_npy_member(data_tarfile, offsets_and_sizes[READS_FILE_NAME][0])
+        self.data_be = memory_map_npy_member(data_tarfile, offsets_and_sizes[DATA_FILE_NAME][0])
+        self.read_offsets = memory_map_npy_member(data_tarfile, offsets_and_sizes[READ_OFFSETS_FILE_NAME][0])
+        # the metadata are compact, so we always load them into RAM
+        self.metadata = np.array(memory_map_npy_member(data_tarfile, offsets_and_sizes[METADATA_FILE_NAME][0]))
+        assert len(self.read_offsets) == len(self.data_be) + 1
+
+    def __len__(self):
+        return len(self.data_be)
+
+    def reads_size_in_bytes(self) -> int:
+        return self.header['num_read_rows'] * self.header['num_read_features'] * np.dtype(self.header['reads_dtype']).itemsize
+
+    def data_size_in_bytes(self) -> int:
+        """
+        size of the datum arrays, the read offsets, and the metadata
+        """
+        num_data = self.header['num_data']
+        return num_data * self.header['datum_array_length'] * np.dtype(self.header['data_dtype']).itemsize + \
+            (num_data + 1) * np.dtype(np.int64).itemsize + num_data * METADATA_DTYPE.itemsize
+
+    def load_into_ram(self, include_reads: bool):
+        """
+        replace the memory maps of the datum arrays and read offsets, and optionally the reads, with in-memory copies
+        """
+        self.data_be = np.array(self.data_be)
+        self.read_offsets = np.array(self.read_offsets)
+        if include_reads:
+            self.reads_re = np.array(self.reads_re)
+
+    def get_reads_datum(self, index: int) -> ReadsDatum:
+        # copy the datum array because the memory map is read-only and some tools edit data
+        reads_re = self.reads_re[self.read_offsets[index]:self.read_offsets[index + 1]]
+        return ReadsDatum(datum_array=np.array(self.data_be[index]), reads_re=reads_re)
+
+    def gather_batch(self, indices, pin_memory: bool = False):
+        """
+        gather the datum arrays and reads of several data directly from the backing arrays into preallocated, optionally
+        pinned, tensors.  As in ReadsBatch, the reads are ordered as the ref reads of all data followed by the alt reads
+        of all data.
+
+        returns (data_be, reads_re) tensors
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        data_be = torch.empty((len(indices), self.data_be.shape[1]), dtype=torch.int64, pin_memory=pin_memory)
+        np.take(self.data_be, indices, axis=0, out=data_be.numpy())
+
+        read_starts = self.read_offsets[indices]
+        ref_counts, alt_counts = data_be.numpy()[:, Datum.REF_COUNT_IDX], data_be.numpy()[:, Datum.ALT_COUNT_IDX]
+        read_rows = np.concatenate((concatenated_ranges(read_starts, ref_counts),
+                                    concatenated_ranges(read_starts + ref_counts, alt_counts)))
+
+        reads_re = torch.empty((len(read_rows), self.reads_re.shape[1]), dtype=torch.float16, pin_memory=pin_memory)
+        np.take(self.reads_re, read_rows, axis=0, out=reads_re.numpy())
+        return data_be, reads_re
+
+
+def concatenated_ranges(starts: np.ndarray, lengths: np.ndarray) -> np.ndarray:
+    """
+    concatenation of the ranges [starts[0], starts[0] + lengths[0]), [starts[1], starts[1] + lengths[1]) etc.
+    Example: starts [10, 20], lengths [2, 3] -> [10, 11, 20, 21, 22]
+    """
+    range_starts_in_output = np.cumsum(lengths) - lengths
+    return np.repeat(starts - range_starts_in_output, lengths) + np.arange(np.sum(lengths))
+
+
+def get_member_offsets_and_sizes(data_tarfile):
+    """
+    dict of member name -> (offset, size) of the member's contents within the tarfile, from the tarfile's index if
+    there is one
+    """
+    index = read_tar_index(data_tarfile)
+    if index is not None:
+        return {name: (offset, size) for name, offset, size in index}
+    with tarfile.open(data_tarfile) as tar:
+        return {member.name: (member.offset_data, member.size) for member in tar.getmembers()}
+
+
+def memory_map_npy_member(data_tarfile, offset: int) -> np.ndarray:
+    """
+    memory-map a .npy file stored in an uncompressed tarfile, given the offset of the member's contents
+    """
+    with open(data_tarfile, 'rb') as file:
+        file.seek(offset)
+        version = np.lib.format.read_magic(file)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(file)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(file)
+        array_offset = file.tell()
+
+    if np.prod(shape) == 0:     # np.memmap can't map zero bytes
+        return np.zeros(shape, dtype=dtype)
+    return np.memmap(data_tarfile, dtype=dtype, mode='r', offset=array_offset, shape=shape, order='F' if fortran_order else 'C')
+
+
+class MemoryMappedDataWriter:
+    """
+    Writes a memory-mappable dataset tarfile from chunks of data that arrive one at a time, so that the whole dataset
+    never has to be in memory.  Reads and datum arrays are appended to raw temporary files and copied into the tarfile
+    behind .npy headers when the writer is closed.
+
+    Ref and alt reads are downsampled to the maximum counts used in training when written, so that the dataset can be
+    memory-mapped as-is.
+
+    Usage:
+        with MemoryMappedDataWriter(output_tarfile) as writer:
+            for reads_data in chunks:
+                writer.write(reads_data)
+    """
+    def __init__(self, output_tarfile):
+        self.output_tarfile = output_tarfile
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.reads_path = os.path.join(self.temp_dir.name, 'reads.bin')
+        self.data_path = os.path.join(self.temp_dir.name, 'data.bin')
+        self.metadata_path = os.path.join(self.temp_dir.name, 'metadata.bin')
+        self.reads_file = open(self.reads_path, 'wb')
+        self.data_file = open(self.data_path, 'wb')
+        self.metadata_file = open(self.metadata_path, 'wb')
+        self.read_counts = []
+        self.num_read_features = ConsistentValue()
+        self.datum_array_length = ConsistentValue()
+        self.extra_members = []     # (file, arcname) tuples
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.reads_file.close()
+            self.data_file.close()
+            self.metadata_file.close()
+            self.temp_dir.cleanup()
+
+    def write(self, reads_data: List[ReadsDatum]):
+        if not reads_data:
+            return
+        reads_data = [datum.copy_with_downsampled_reads(cap_ref_count(datum.get_ref_count()), cap_alt_count(datum.get_alt_count()))
+                      for datum in reads_data]
+        reads_re = np.vstack([datum.get_reads_re() for datum in reads_data]).astype(READS_DTYPE)
+        data_be = np.vstack([datum.get_array_1d() for datum in reads_data]).astype(DATA_DTYPE)
+        self.num_read_features.check(reads_re.shape[1])
+        self.datum_array_length.check(data_be.shape[1])
+
+        self.reads_file.write(reads_re.tobytes())
+        self.data_file.write(data_be.tobytes())
+        self.metadata_file.write(metadata_from_data_array(data_be).tobytes())
+        self.read_counts.extend(len(datum.get_reads_re()) for datum in reads_data)
+
+    def add_file(self, file, arcname: str):
+        """
+        include an additional file, such as a saved normalization, in the output tarfile
+        """
+        self.extra_members.append((file, arcname))
+
+    def close(self):
+        self.reads_file.close()
+        self.data_file.close()
+        self.metadata_file.close()
+        num_data = len(self.read_counts)
+        if num_data == 0:
+            print(f"No data were written, so {self.output_tarfile} is an empty dataset.")
+        read_offsets = np.zeros(num_data + 1, dtype=np.int64)
+        read_offsets[1:] = np.cumsum(self.read_counts)
+
+        header = {'format_version': FORMAT_VERSION, 'num_data': num_data, 'num_read_rows': int(read_offsets[-1]),
+                  'num_read_features': self.num_read_features.value or 0, 'datum_array_length': self.datum_array_length.value or 0,
+                  'reads_dtype': np.dtype(READS_DTYPE).name, 'data_dtype': np.dtype(DATA_DTYPE).name}
+
+        with tarfile.open(self.output_tarfile, 'w') as tar:
+            add_bytes_to_tarfile(tar, HEADER_FILE_NAME, json.dumps(header).encode())
+            add_raw_array_to_tarfile(tar, READS_FILE_NAME, self.reads_path, READS_DTYPE,
+                                     (int(read_offsets[-1]), header['num_read_features']))
+            add_raw_array_to_tarfile(tar, DATA_FILE_NAME, self.data_path, DATA_DTYPE, (num_data, header['datum_array_length']))
+            npy_buffer = io.BytesIO()
+            np.save(npy_buffer, read_offsets)
+            add_bytes_to_tarfile(tar, READ_OFFSETS_FILE_NAME, npy_buffer.getvalue())
+            add_raw_array_to_tarfile(tar, METADATA_FILE_NAME, self.metadata_path, METADATA_DTYPE, (num_data,))
+            for file, arcname in self.extra_members:
+                tar.add(file, arcname=arcname)
+        write_tar_index(self.output_tarfile)     # so that readers seek straight to each member
+        self.temp_dir.cleanup()
+
+
+def add_bytes_to_tarfile(tar: tarfile.TarFile, arcname: str, contents: bytes):
+    tarinfo = tarfile.TarInfo(arcname)
+    tarinfo.size = len(contents)
+    tar.addfile(tarinfo, io.BytesIO(contents))
+
+
+def add_raw_array_to_tarfile(tar: tarfile.TarFile, arcname: str, raw_path, dtype, shape):
+    """
+    add a .npy member to a tarfile from a header and a raw file of array contents, without assembling the .npy on disk
+    """
+    header_buffer = io.BytesIO()
+    np.lib.format.write_array_header_1_0(header_buffer, {'descr': np.lib.format.dtype_to_descr(np.dtype(dtype)),
+                                                         'fortran_order': False, 'shape': shape})
+    raw_size = os.path.getsize(raw_path)
+    assert raw_size == np.prod(shape) * np.dtype(dtype).itemsize, "Raw file size doesn't match the array shape"
+
+    tarinfo = tarfile.TarInfo(arcname)
+    tarinfo.size = len(header_buffer.getvalue()) + raw_size
+    with open(raw_path, 'rb') as raw_file:
+        # tarfile expects full reads, which the buffered reader provides by calling readinto repeatedly
+        tar.addfile(tarinfo, io.BufferedReader(ConcatenatedReader([io.BytesIO(header_buffer.getvalue()), raw_file])))
+
+
+class ConcatenatedReader(io.RawIOBase):
+    """
+    read-only file-like object that reads several file-like objects one after another
+    """
+    def __init__(self, files):
+        self.files = list(files)
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while self.files:
+            num_read = self.files[0].readinto(buffer)
+            if num_read:
+                return num_read
+            self.files.pop(0)
+        return 0
@@ -30,9 +30,13 @@ GTCCTGGACACGCTGTTGGCC
 -11.327
 -0.000
 """
+from __future__ import annotations
+
+import tarfile
 from typing import List
 
 import numpy as np
+import torch
 from sklearn.preprocessing import QuantileTransformer
 
 from permutect.data.count_binning import cap_ref_count, cap_alt_count
@@ -45,11 +49,139 @@ from permutect.utils.enums import Variation, Label
 MAX_VALUE = 10000
 EPSILON = 0.00001
 QUANTILE_DATA_COUNT = 10000
+READ_BLOCK_BYTES = 64 * 1024 * 1024
+SKETCH_CAPACITY = 100000    # number of rows sampled for fitting two-pass quantile normalization
+
+# name of the saved two-pass normalization within a preprocessed dataset tarfile
+NORMALIZATION_FILE_NAME = 'normalization.pt'
 
 
-def read_data(dataset_file, only_artifacts: bool = False, source: int=0):
+def read_data(dataset_file, only_artifacts: bool = False, source: int=0, block_bytes: int = READ_BLOCK_BYTES):
     """
     generator that yields data from a plain text dataset file.
+
+    The file is read in large blocks of bytes.  Within each block we find record boundaries from the counts lines and
+    convert all read rows and info vectors of the block to numpy in a single call each, rather than parsing line by line.
+    The yielded data are identical to those of read_data_line_by_line.
+    """
+    n = 0
+    pending_lines = []
+    for lines in generate_line_blocks(dataset_file, block_bytes):
+        lines = pending_lines + lines
+        record_starts, ref_counts, alt_counts, num_lines_used, end_of_data = find_complete_records(lines)
+        pending_lines = lines[num_lines_used:]
+
+        if record_starts:
+            # the first column is read group index, which we currently discard
+            read_lines = [line for start, ref_count, alt_count in zip(record_starts, ref_counts, alt_counts)
+                          for line in lines[start + 5:start + 5 + ref_count + alt_count]]
+            all_reads = lines_to_2d_array(read_lines)[:, 1:]
+            all_info = lines_to_2d_array([lines[start + 3] for start in record_starts])
+            read_ends = np.cumsum(np.array(ref_counts) + np.array(alt_counts))
+
+            for r, (start, ref_count, alt_count) in enumerate(zip(record_starts, ref_counts, alt_counts)):
+                n += 1
+                label = Label.get_label(lines[start].decode().strip())
+                passes_label_filter = (label == Label.ARTIFACT or not only_artifacts)
+
+                # contig:position,ref->alt
+                locus, mutation = lines[start + 1].decode().strip().split(",")
+                contig, position = map(int, locus.split(":"))   # contig is an integer *index* from a sequence dictionary
+                if n % 100000 == 0:
+                    print(f"{contig}:{position}")
+
+                if alt_count == 0 or not passes_label_filter:
+                    continue
+
+                ref_allele, alt_allele = mutation.strip().split("->")
+                ref_sequence_string = lines[start + 2].decode().strip()
+                trailer_start = start + 5 + ref_count + alt_count
+                original_depth, original_alt_count, original_normal_depth, original_normal_alt_count = read_integers(lines[trailer_start])
+                seq_error_log_lk = read_float(lines[trailer_start + 1])
+                normal_seq_error_log_lk = read_float(lines[trailer_start + 2])
+
+                reads_start = read_ends[r] - ref_count - alt_count
+                ref_tensor = all_reads[reads_start:reads_start + ref_count] if ref_count > 0 else None
+                alt_tensor = all_reads[reads_start + ref_count:read_ends[r]]
+
+                datum = ReadsDatum.from_gatk(label=label, variant_type=Variation.get_type(ref_allele, alt_allele), source=source,
+                                             original_depth=original_depth, original_alt_count=original_alt_count,
+                                             original_normal_depth=original_normal_depth, original_normal_alt_count=original_normal_alt_count,
+                                             contig=contig, position=position, ref_allele=ref_allele, alt_allele=alt_allele,
+                                             seq_error_log_lk=seq_error_log_lk, normal_seq_error_log_lk=normal_seq_error_log_lk,
+                                             ref_sequence_string=ref_sequence_string, gatk_info_array=all_info[r],
+                                             ref_tensor=ref_tensor, alt_tensor=alt_tensor)
+
+                yield datum.copy_with_downsampled_reads(cap_ref_count(datum.get_ref_count()), cap_alt_count(datum.get_alt_count()))
+
+        if end_of_data:
+            return
+
+    if pending_lines:
+        raise Exception(f"Incomplete record at the end of {dataset_file}")
+
+
+def generate_line_blocks(dataset_file, block_bytes: int):
+    """
+    generator of lists of complete lines (bytes without the trailing newline) read from a file in large blocks
+    """
+    with open(dataset_file, 'rb') as file:
+        leftover = b''
+        while block := file.read(block_bytes):
+            lines = (leftover + block).split(b'\n')
+            leftover = lines.pop()  # the last line is incomplete unless the block happened to end with a newline
+            yield lines
+        if leftover:
+            yield [leftover]
+
+
+def record_length(ref_count: int, alt_count: int) -> int:
+    # label, variant, reference context, info, counts, reads, original counts, seq error, normal seq error
+    return 5 + ref_count + alt_count + 3
+
+
+def find_complete_records(lines):
+    """
+    find the starting line of each complete record in a list of lines, along with its ref and alt read counts.
+    Also return the number of lines spanned by these complete records and whether a blank label line, which marks the
+    end of data, was found.
+    """
+    record_starts, ref_counts, alt_counts = [], [], []
+    start, num_lines = 0, len(lines)
+    while start < num_lines:
+        if not lines[start].strip():
+            return record_starts, ref_counts, alt_counts, start, True
+        if start + 4 >= num_lines:
+            break
+        ref_count, alt_count = map(int, lines[start + 4].split()[:2])
+        length = record_length(ref_count, alt_count)
+        if start + length > num_lines:
+            break
+        record_starts.append(start)
+        ref_counts.append(ref_count)
+        alt_counts.append(alt_count)
+        start += length
+    return record_starts, ref_counts, alt_counts, start, False
+
+
+def lines_to_2d_array(lines) -> np.ndarray:
+    """
+    convert many lines of whitespace-separated numbers, all with the same number of tokens, to a clipped float16 2D array
+    in a single bulk conversion
+    """
+    num_columns = len(lines[0].split()) if lines else 0
+    if num_columns == 0:
+        return np.zeros((len(lines), 0), dtype=DEFAULT_NUMPY_FLOAT)
+    flattened = np.fromstring(b' '.join(lines), dtype=np.float64, sep=' ')
+    if len(flattened) != len(lines) * num_columns:
+        raise Exception("Lines of a block have inconsistent numbers of values")
+    return np.clip(flattened.reshape(len(lines), num_columns).astype(DEFAULT_NUMPY_FLOAT), -MAX_VALUE, MAX_VALUE)
+
+
+def read_data_line_by_line(dataset_file, only_artifacts: bool = False, source: int=0):
+    """
+    generator that yields data from a plain text dataset file, parsing one line at a time.  This is much slower than
+    read_data and is kept as a reference implementation for testing and benchmarking.
     """
     with open(dataset_file) as file:
         n = 0
@@ -103,13 +235,15 @@ def read_data(dataset_file, only_artifacts: bool = False, source: int=0):
 # if sources is None, source is set to zero
 # if List is length-1, that's the source for all files
 # otherwise each file has its own source int
-def generate_normalized_data(dataset_files, max_bytes_per_chunk: int, sources: List[int]=None):
+def generate_normalized_data(dataset_files, max_bytes_per_chunk: int, sources: List[int]=None, normalization: Normalization = None):
     """
     given text dataset files, generate normalized lists of read sets that fit in memory
 
     In addition to quantile-normalizing read tensors it also enlarges the info tensors
     :param dataset_files:
     :param max_bytes_per_chunk:
+    :param normalization: if given, a fixed normalization applied to every chunk.  Otherwise quantile transforms are fit
+            to each chunk.
     :return:
     """
     for n, dataset_file in enumerate(dataset_files):
@@ -126,61 +260,240 @@ def generate_normalized_data(dataset_files, max_bytes_per_chunk: int, sources: L
                 report_memory_usage()
                 print(f"{bytes_in_buffer} bytes in chunk")
 
-                normalize_buffer(buffer, read_quantile_transform, info_quantile_transform)
+                if normalization is None:
+                    normalize_buffer(buffer, read_quantile_transform, info_quantile_transform)
+                else:
+                    normalization.normalize(buffer)
                 yield buffer
                 num_buffers_filled += 1
                 buffer, bytes_in_buffer = [], 0
         # There will be some data left over, in general.  Since it's small, use the last buffer's
         # quantile transforms for better statistical power if it's from the same text file
         if buffer:
-            normalize_buffer(buffer, read_quantile_transform, info_quantile_transform, refit_transforms=(num_buffers_filled==0))
+            if normalization is None:
+                normalize_buffer(buffer, read_quantile_transform, info_quantile_transform, refit_transforms=(num_buffers_filled==0))
+            else:
+                normalization.normalize(buffer)
             yield buffer
 
 
-# this normalizes the buffer and also prepends new features to the info tensor
-def normalize_buffer(buffer, read_quantile_transform, info_quantile_transform, refit_transforms=True):
-    EPSILON = 0.00001   # tiny quantity for jitter
+class ReservoirSketch:
+    """
+    A uniform random sample, of bounded size, of the rows of a stream of 2D arrays.  Column quantiles of the sample
+    estimate those of the entire stream with rank error of order 1/sqrt(capacity).  Sketches of different streams can be
+    merged into a sketch of the combined stream.
+    """
+    def __init__(self, capacity: int = SKETCH_CAPACITY):
+        self.capacity = capacity
+        self.sample = None
+        self.num_seen = 0
+
+    def update(self, rows_2d: np.ndarray):
+        if self.sample is None:
+            self.sample = np.zeros((0, rows_2d.shape[1]), dtype=rows_2d.dtype)
+
+        # fill the reservoir until it reaches capacity
+        num_to_fill = min(len(rows_2d), self.capacity - len(self.sample))
+        if num_to_fill > 0:
+            self.sample = np.vstack((self.sample, rows_2d[:num_to_fill]))
+
+        # after that, the i-th row (1-based) of the stream replaces a random slot with probability capacity / i
+        remaining = rows_2d[num_to_fill:]
+        if len(remaining) > 0:
+            stream_indices = self.num_seen + num_to_fill + np.arange(1, len(remaining) + 1)
+            slots = (np.random.random(len(remaining)) * stream_indices).astype(np.int64)
+            accepted = slots < self.capacity
+            self.sample[slots[accepted]] = remaining[accepted]
+        self.num_seen += len(rows_2d)
+
+    def merge(self, other: ReservoirSketch) -> ReservoirSketch:
+        if other.sample is None:
+            return self
+        elif self.sample is None:
+            self.sample, self.num_seen = other.sample.copy(), other.num_seen
+            return self
+
+        sample_size = min(self.capacity, len(self.sample) + len(other.sample))
+        # as if sampling without replacement from the combined stream, the number of rows from each sketch is hypergeometric
+        num_from_self = np.random.hypergeometric(self.num_seen, other.num_seen, sample_size)
+        num_from_self = min(max(num_from_self, sample_size - len(other.sample)), len(self.sample))
+        rows_from_self = self.sample[np.random.choice(len(self.sample), num_from_self, replace=False)]
+        rows_from_other = other.sample[np.random.choice(len(other.sample), sample_size - num_from_self, replace=False)]
+        self.sample = np.vstack((rows_from_self, rows_from_other))
+        self.num_seen += other.num_seen
+        return self
+
+
+class Normalization:
+    """
+    Quantile transforms of read and info features, along with their binary (hence untransformed) columns, that are fit
+    once to an entire dataset and then applied unchanged to every chunk
+    """
+    def __init__(self, read_quantile_transform: QuantileTransformer, info_quantile_transform: QuantileTransformer,
+                 binary_read_columns: List[int], binary_info_columns: List[int]):
+        self.read_quantile_transform = read_quantile_transform
+        self.info_quantile_transform = info_quantile_transform
+        self.binary_read_columns = binary_read_columns
+        self.binary_info_columns = binary_info_columns
+
+    def normalize(self, buffer: List[ReadsDatum]):
+        normalize_buffer(buffer, self.read_quantile_transform, self.info_quantile_transform, refit_transforms=False,
+                         binary_read_columns=self.binary_read_columns, binary_info_columns=self.binary_info_columns)
+
+    def save(self, file):
+        torch.save(self, file, pickle_protocol=4)
+
+    @classmethod
+    def load(cls, file) -> Normalization:
+        return torch.load(file)
+
+    @classmethod
+    def load_from_tarfile(cls, data_tarfile) -> Normalization:
+        with tarfile.open(data_tarfile) as tar:
+            try:
+                member = tar.getmember(NORMALIZATION_FILE_NAME)
+            except KeyError:
+                raise Exception(f"{data_tarfile} has no saved normalization.  Was it preprocessed with two-pass normalization?")
+            return cls.load(tar.extractfile(member))
+
+
+class NormalizationSketch:
+    """
+    Bounded-memory summary of the ref read and info features of a dataset, from which a Normalization is fit.  Sketches
+    of different files can be merged.
+    """
+    def __init__(self, capacity: int = SKETCH_CAPACITY):
+        self.ref_read_sketch = ReservoirSketch(capacity)
+        self.info_sketch = ReservoirSketch(capacity)
+
+        # columns that are binary in every datum seen
+        self.binary_read_columns = None
+        self.binary_info_columns = None
+
+    def update(self, buffer: List[ReadsDatum]):
+        all_ref = np.vstack([datum.get_ref_reads_re() for datum in buffer])
+        all_info = np.vstack([datum.get_info_1d() for datum in buffer])
+        self.ref_read_sketch.update(all_ref)
+        self.info_sketch.update(all_info)
+        self.binary_read_columns = intersect_columns(self.binary_read_columns, binary_column_indices(all_ref))
+        self.binary_info_columns = intersect_columns(self.binary_info_columns, binary_column_indices(all_info))
+
+    def merge(self, other: NormalizationSketch) -> NormalizationSketch:
+        self.ref_read_sketch.merge(other.ref_read_sketch)
+        self.info_sketch.merge(other.info_sketch)
+        self.binary_read_columns = intersect_columns(self.binary_read_columns, other.binary_read_columns)
+        self.binary_info_columns = intersect_columns(self.binary_info_columns, other.binary_info_columns)
+        return self
+
+    def fit(self) -> Normalization:
+        assert self.ref_read_sketch.sample is not None, "No data to fit normalization"
+        ref_sample, info_sample = self.ref_read_sketch.sample, self.info_sketch.sample
+        read_quantile_transform = QuantileTransformer(n_quantiles=100, output_distribution='normal', subsample=len(ref_sample))
+        info_quantile_transform = QuantileTransformer(n_quantiles=100, output_distribution='normal', subsample=len(info_sample))
+        read_quantile_transform.fit(jitter(ref_sample))
+        info_quantile_transform.fit(jitter(info_sample))
+        return Normalization(read_quantile_transform, info_quantile_transform, self.binary_read_columns, self.binary_info_columns)
+
+
+# None represents the columns of a sketch that hasn't seen any data
+def intersect_columns(columns1, columns2):
+    return columns2 if columns1 is None else (columns1 if columns2 is None else sorted(set(columns1) & set(columns2)))
+
+
+def sketch_dataset_file(dataset_file, max_bytes_per_chunk: int) -> NormalizationSketch:
+    """
+    first pass of two-pass normalization: sketch the features of a plain text file, one chunk of data in memory at a time
+    """
+    sketch = NormalizationSketch()
+    buffer, bytes_in_buffer = [], 0
+    for reads_datum in read_data(dataset_file):
+        buffer.append(reads_datum)
+        bytes_in_buffer += reads_datum.size_in_bytes()
+        if bytes_in_buffer > max_bytes_per_chunk:
+            sketch.update(buffer)
+            buffer, bytes_in_buffer = [], 0
+    if buffer:
+        sketch.update(buffer)
+    return sketch
+
+
+def fit_normalization(dataset_files, max_bytes_per_chunk: int) -> Normalization:
+    sketch = NormalizationSketch()
+    for dataset_file in dataset_files:
+        sketch.merge(sketch_dataset_file(dataset_file, max_bytes_per_chunk))
+    return sketch.fit()
+
 
+# this normalizes the buffer and also prepends new features to the info tensor
+# binary columns are determined from the buffer unless given
+def normalize_buffer(buffer, read_quantile_transform, info_quantile_transform, refit_transforms=True,
+                     binary_read_columns=None, binary_info_columns=None):
     # 2D array.  Rows are ref/alt reads, columns are read features
-    all_ref = np.vstack([datum.get_ref_reads_re() for datum in buffer])
     all_reads = np.vstack([datum.reads_re for datum in buffer])
 
     # 2D array.  Rows are read sets, columns are info features
     all_info = np.vstack([datum.get_info_1d() for datum in buffer])
 
-    all_ref_jittered = all_ref + EPSILON * np.random.randn(*all_ref.shape)
-    all_reads_jittered = all_reads + EPSILON * np.random.randn(*all_reads.shape)
-    all_info_jittered = all_info + EPSILON * np.random.randn(*all_info.shape)
+    ref_counts = np.array([datum.get_ref_count() for datum in buffer])
+    alt_counts = np.array([datum.get_alt_count() for datum in buffer])
+    assert np.all(alt_counts > 0), "every datum must have alt reads"
+    read_ends = np.cumsum(ref_counts + alt_counts)
+    is_ref_read = np.repeat(np.tile([True, False], len(buffer)), np.column_stack((ref_counts, alt_counts)).reshape(-1))
+    all_ref = all_reads[is_ref_read]
 
-    num_read_features = all_ref.shape[1]
-    binary_read_columns = binary_column_indices(all_ref)    # make sure not to use jittered arrays here!
+    num_read_features = all_reads.shape[1]
+    if binary_read_columns is None:
+        binary_read_columns = binary_column_indices(all_ref)    # make sure not to use jittered arrays here!
 
     # 1 if is binary, 0 if not binary
-    binary_read_column_mask = np.zeros(num_read_features)
-    binary_read_column_mask[binary_read_columns] = 1
+    binary_read_column_mask = np.zeros(num_read_features, dtype=bool)
+    binary_read_column_mask[binary_read_columns] = True
 
-    binary_info_columns = binary_column_indices(all_info)   # make sure not to use jittered arrays here!
+    if binary_info_columns is None:
+        binary_info_columns = binary_column_indices(all_info)   # make sure not to use jittered arrays here!
 
     if refit_transforms:    # fit quantiles column by column (aka feature by feature)
-        read_quantile_transform.fit(all_ref_jittered)
-        info_quantile_transform.fit(all_info_jittered)
+        read_quantile_transform.fit(jitter(all_ref))
+        info_quantile_transform.fit(jitter(all_info))
 
     # it's more efficient to apply the quantile transform to all reads at once, then split it back into read sets
-    all_reads_transformed = transform_except_for_binary_columns(all_reads_jittered, read_quantile_transform, binary_read_columns)
-    all_info_transformed = transform_except_for_binary_columns(all_info_jittered, info_quantile_transform, binary_info_columns)
+    all_reads_transformed = transform_except_for_binary_columns(jitter(all_reads), read_quantile_transform, binary_read_columns)
+    all_info_transformed = transform_except_for_binary_columns(jitter(all_info), info_quantile_transform, binary_info_columns)
 
-    read_counts = np.array([len(datum.reads_re) for datum in buffer])
-    read_index_ranges = np.cumsum(read_counts)
+    # medians are an appropriate outlier-tolerant summary, except for binary columns where the mean makes more sense
+    alt_means, alt_medians = alt_means_and_medians(all_reads_transformed, read_ends, alt_counts)
+    extra_info = np.where(binary_read_column_mask, alt_means, alt_medians)
 
+    read_starts = read_ends - ref_counts - alt_counts
     for n, datum in enumerate(buffer):
-        datum.reads_re = all_reads_transformed[0 if n == 0 else read_index_ranges[n - 1]:read_index_ranges[n]]
+        datum.reads_re = all_reads_transformed[read_starts[n]:read_ends[n]]
+        datum.set_info_1d(np.hstack([extra_info[n], all_info_transformed[n]]))
 
-        # medians are an appropriate outlier-tolerant summary, except for binary columns where the mean makes more sense
-        alt_medians = np.median(datum.get_alt_reads_re(), axis=0)
-        alt_means = np.mean(datum.get_alt_reads_re(), axis=0)
 
-        extra_info = binary_read_column_mask * alt_means + (1 - binary_read_column_mask) * alt_medians
-        datum.set_info_1d(np.hstack([extra_info, all_info_transformed[n]]))
+def jitter(array_2d: np.ndarray) -> np.ndarray:
+    # tiny random noise to break ties before quantile transforms
+    return array_2d + EPSILON * np.random.randn(*array_2d.shape)
+
+
+def alt_means_and_medians(all_reads: np.ndarray, read_ends: np.ndarray, alt_counts: np.ndarray):
+    """
+    featurewise means and medians over the alt reads of each datum, where the alt reads of the nth datum are the rows of
+    all_reads that end at read_ends[n].  Means are a single segment reduction, and medians are computed for all data
+    with the same alt count at once.
+    """
+    alt_starts = read_ends - alt_counts
+
+    # reduceat sums each segment between consecutive boundaries.  Alternating alt starts and ends as boundaries gives
+    # the alt segments at even indices.  The final boundary is the end of the array and is omitted.
+    boundaries = np.column_stack((alt_starts, read_ends)).reshape(-1)[:-1]
+    alt_means = np.add.reduceat(all_reads, boundaries, axis=0)[0::2] / alt_counts[:, None]
+
+    alt_medians = np.zeros_like(alt_means)
+    for alt_count in np.unique(alt_counts):
+        data_indices = np.flatnonzero(alt_counts == alt_count)
+        row_indices = alt_starts[data_indices][:, None] + np.arange(alt_count)[None, :]
+        alt_medians[data_indices] = np.median(all_reads[row_indices], axis=1)
+    return alt_means, alt_medians
 
 
 def line_to_tensor(line: str) -> np.ndarray:
@@ -204,19 +517,23 @@ def read_float(line: str):
     return float(line.strip().split()[0])
 
 
-def is_binary(column_tensor_1d: np.ndarray):
+def is_binary(column_tensor_1d: np.ndarray) -> bool:
     assert len(column_tensor_1d.shape) == 1
-    return all(el.item() == 0 or el.item() == 1 for el in column_tensor_1d)
+    return bool(np.all((column_tensor_1d == 0) | (column_tensor_1d == 1)))
 
 
-def binary_column_indices(tensor_2d: np.ndarray):
+# columns are checked one at a time to avoid boolean temporaries the size of the whole array
+def binary_column_mask(tensor_2d: np.ndarray) -> np.ndarray:
     assert len(tensor_2d.shape) == 2
-    return [n for n in range(tensor_2d.shape[1]) if is_binary(tensor_2d[:, n])]
+    return np.array([is_binary(tensor_2d[:, n]) for n in range(tensor_2d.shape[1])], dtype=bool)
+
+
+def binary_column_indices(tensor_2d: np.ndarray):
+    return np.flatnonzero(binary_column_mask(tensor_2d)).tolist()
 
 
 def non_binary_column_indices(tensor_2d: np.ndarray):
-    assert len(tensor_2d.shape) == 2
-    return [n for n in range(tensor_2d.shape[1]) if not is_binary(tensor_2d[:, n])]
+    return np.flatnonzero(~binary_column_mask(tensor_2d)).tolist()
 
 
 # copy the unnormalized values of binary features (columns)
@@ -1,46 +1,31 @@
 from __future__ import annotations
 
 import copy
-import random
 import math
-from typing import List, Iterable
 
-import numpy as np
 import torch
 from torch import IntTensor, Tensor
-from torch.utils.data import Dataset, DataLoader
 
 from permutect.data.batch import Batch
 from permutect.data.datum import Datum
 
 
-class PosteriorDatum(Datum):
-
+class PosteriorBatch(Batch):
+    """
+    A batch is a slice of the rows of a PosteriorDataset's tensors.  The float tensor has one row per datum with the
+    columns below.
+    """
     ALLELE_FREQUENCY = 0
     ARTIFACT_LOGIT = 1
     MAF = 2
     NORMAL_MAF = 3
+    NUM_FLOATS = 4
 
-    def __init__(self, datum_array, allele_frequency: float, artifact_logit: float, maf: float, normal_maf: float, embedding: Tensor):
-        super().__init__(datum_array)
-        self.embedding = embedding
-
-        self.float_array = torch.zeros(4, dtype=torch.float16)
-        self.float_array[PosteriorDatum.ALLELE_FREQUENCY] = allele_frequency
-        self.float_array[PosteriorDatum.ARTIFACT_LOGIT] = artifact_logit
-        self.float_array[PosteriorDatum.MAF] = maf
-        self.float_array[PosteriorDatum.NORMAL_MAF] = normal_maf
-
-    def get_artifact_logit(self) -> float:
-        return self.float_array[self.__class__.ARTIFACT_LOGIT]
-
-
-class PosteriorBatch(Batch):
-
-    def __init__(self, data: List[PosteriorDatum]):
-        super().__init__(data)
-        self.embeddings = torch.vstack([item.embedding for item in data]).float()
-        self.float_tensor = torch.vstack([item.float_array for item in data]).float()
+    def __init__(self, data_be: Tensor, float_tensor: Tensor, embeddings: Tensor):
+        self.data = data_be
+        self.float_tensor = float_tensor
+        self.embeddings = embeddings
+        self._finish_initializiation_from_data_array()
 
     def pin_memory(self):
         super().pin_memory()
@@ -58,33 +43,88 @@ class PosteriorBatch(Batch):
         return new_batch
 
     def get_allele_frequencies(self) -> Tensor:
-        return self.float_tensor[:, PosteriorDatum.ALLELE_FREQUENCY]
+        return self.float_tensor[:, PosteriorBatch.ALLELE_FREQUENCY]
 
     def get_artifact_logits(self) -> Tensor:
-        return self.float_tensor[:, PosteriorDatum.ARTIFACT_LOGIT]
+        return self.float_tensor[:, PosteriorBatch.ARTIFACT_LOGIT]
 
     def get_mafs(self) -> Tensor:
-        return self.float_tensor[:, PosteriorDatum.MAF]
+        return self.float_tensor[:, PosteriorBatch.MAF]
 
     def get_normal_mafs(self) -> Tensor:
-        return self.float_tensor[:, PosteriorDatum.NORMAL_MAF]
+        return self.float_tensor[:, PosteriorBatch.NORMAL_MAF]
 
     def get_original_normal_ref_counts(self) -> IntTensor:
         return self.get_original_normal_depths() - self.get_original_normal_alt_counts()
 
 
-class PosteriorDataset(Dataset):
-    def __init__(self, data: Iterable[PosteriorDatum], shuffle: bool = True):
-        self.data = data
-
-        if shuffle:
-            random.shuffle(self.data)
+class PosteriorDataset:
+    """
+    Columnar dataset of three contiguous tensors with one row per datum: int64 datum arrays, float16 (allele frequency,
+    artifact logit, maf, normal maf) columns, and embeddings.  Batches are slices of these tensors, so there is no
+    per-datum collation, and the whole dataset can be moved to the GPU.
+
+    Only the scalar elements of the datum arrays are kept, since the posterior model doesn't use the haplotypes or info.
+    Datasets can be saved as shards and datasets loaded from several shards, eg one for each genomic interval.
+    """
+    def __init__(self, data_be, float_array_be, embeddings_be, shuffle: bool = True):
+        # the dataset is typically built under inference mode, but its batches are later used to learn the posterior
+        # model, so we need ordinary tensors
+        with torch.inference_mode(False):
+            permutation = torch.randperm(len(data_be)) if shuffle else torch.arange(len(data_be))
+            self.data_be = torch.as_tensor(data_be)[:, :Datum.NUM_SCALAR_ELEMENTS].to(dtype=torch.long)[permutation]
+            self.float_tensor = torch.as_tensor(float_array_be).to(dtype=torch.float16)[permutation]
+            self.embeddings = torch.as_tensor(embeddings_be).to(dtype=torch.float16)[permutation]
+        assert len(self.data_be) == len(self.float_tensor) == len(self.embeddings)
+        assert self.float_tensor.shape[1] == PosteriorBatch.NUM_FLOATS
 
     def __len__(self) -> int:
-        return len(self.data)
+        return len(self.data_be)
 
-    def __getitem__(self, index) -> PosteriorDatum:
-        return self.data[index]
+    def size_in_bytes(self) -> int:
+        return sum(tensor.element_size() * tensor.nelement() for tensor in (self.data_be, self.float_tensor, self.embeddings))
+
+    def to(self, device) -> PosteriorDataset:
+        self.data_be, self.float_tensor, self.embeddings = self.data_be.to(device), self.float_tensor.to(device), self.embeddings.to(device)
+        return self
+
+    def pin_memory(self) -> PosteriorDataset:
+        if not self.data_be.is_cuda:
+            self.data_be, self.float_tensor, self.embeddings = self.data_be.pin_memory(), self.float_tensor.pin_memory(), self.embeddings.pin_memory()
+        return self
+
+    def get_batch(self, start: int, stop: int) -> PosteriorBatch:
+        return PosteriorBatch(self.data_be[start:stop], self.float_tensor[start:stop], self.embeddings[start:stop])
+
+    def save(self, file):
+        torch.save([self.data_be.cpu(), self.float_tensor.cpu(), self.embeddings.cpu()], file, pickle_protocol=4)
+
+    @classmethod
+    def load(cls, files, shuffle: bool = True) -> PosteriorDataset:
+        """
+        load and concatenate one or more saved shards
+        """
+        shards = [torch.load(file) for file in files]
+        return cls(*(torch.vstack([shard[n] for shard in shards]) for n in range(3)), shuffle=shuffle)
+
+    def make_data_loader(self, batch_size: int, pin_memory: bool = False) -> PosteriorDataLoader:
+        if pin_memory:
+            self.pin_memory()
+        return PosteriorDataLoader(self, batch_size)
+
+
+class PosteriorDataLoader:
+    """
+    Iterates over contiguous slices of a PosteriorDataset, in the same order every epoch.  Like a DataLoader, it exposes
+    the dataset and its number of batches.
+    """
+    def __init__(self, dataset: PosteriorDataset, batch_size: int):
+        self.dataset = dataset
+        self.batch_size = batch_size
+
+    def __len__(self) -> int:
+        return math.ceil(len(self.dataset) / self.batch_size)
 
-    def make_data_loader(self, batch_size: int, pin_memory: bool = False, num_workers: int = 0):
-        return DataLoader(dataset=self, batch_size=batch_size, pin_memory=pin_memory, num_workers=num_workers, collate_fn=PosteriorBatch)
+    def __iter__(self):
+        for start in range(0, len(self.dataset), self.batch_size):
+            yield self.dataset.get_batch(start, start + self.batch_size)
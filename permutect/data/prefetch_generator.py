@@ -1,24 +1,156 @@
+import queue
+import threading
+import time
+
+import torch
 from torch.utils.data import DataLoader
 
 from permutect.data.datum import DEFAULT_GPU_FLOAT, DEFAULT_CPU_FLOAT
 from permutect.misc_utils import gpu_if_available
 
+DEFAULT_PREFETCH_DEPTH = 4
+
+_END_OF_DATA = object()
 
-def prefetch_generator(dataloader: DataLoader, device=gpu_if_available()):
+
+class Prefetcher:
+    """
+    Iterates over a dataloader in a background thread, sending batches to the device and keeping up to depth batches
+    ready in a bounded queue.  On CUDA the copies are issued on a separate stream so that they overlap computation.
+    The dataloader must yield batches that have a copy_to method.
+
+    Starvation counters record how often, and for how long, the consumer had to wait for a batch.  If this is a large
+    fraction of the time, the consumer is input-bound.
+    """
+    def __init__(self, dataloader: DataLoader, device=gpu_if_available(), depth: int = DEFAULT_PREFETCH_DEPTH):
+        assert depth > 0, "prefetch depth must be positive"
+        self.dataloader = dataloader
+        self.device = device
+        self.depth = depth
+        self.is_cuda = device.type == 'cuda'
+        self.dtype = DEFAULT_GPU_FLOAT if self.is_cuda else DEFAULT_CPU_FLOAT
+
+        self.num_batches = 0
+        self.num_starved = 0            # number of batches the consumer had to wait for
+        self.starved_seconds = 0.0      # total time the consumer spent waiting
+        self.total_seconds = 0.0        # total time from the start of iteration to the end
+
+    def __len__(self):
+        return len(self.dataloader)
+
+    def __iter__(self):
+        batch_queue = queue.Queue(maxsize=self.depth)
+        stop = threading.Event()
+        thread = threading.Thread(target=self._produce, args=(batch_queue, stop), daemon=True)
+        start = time.time()
+        thread.start()
+        try:
+            while True:
+                try:
+                    item = batch_queue.get_nowait()
+                except queue.Empty:
+                    self.num_starved += 1
+                    wait_start = time.time()
+                    item = batch_queue.get()
+                    self.starved_seconds += time.time() - wait_start
+
+                if item is _END_OF_DATA:
+                    break
+                elif isinstance(item, BaseException):
+                    raise item
+
+                batch, copy_done = item
+                if copy_done is not None:
+                    torch.cuda.current_stream().wait_event(copy_done)
+                    record_stream(batch, torch.cuda.current_stream())
+                self.num_batches += 1
+                yield batch
+        finally:
+            stop.set()
+            # unblock the producer if it is waiting on a full queue
+            while thread.is_alive():
+                try:
+                    batch_queue.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            self.total_seconds += time.time() - start
+
+    def _produce(self, batch_queue: queue.Queue, stop: threading.Event):
+        try:
+            stream = torch.cuda.Stream(device=self.device) if self.is_cuda else None
+            for cpu_batch in self.dataloader:
+                if stop.is_set():
+                    return
+                if stream is None:
+                    batch_queue.put((cpu_batch.copy_to(self.device, dtype=self.dtype), None))
+                else:
+                    with torch.cuda.stream(stream):
+                        batch = cpu_batch.copy_to(self.device, dtype=self.dtype)
+                        copy_done = torch.cuda.Event()
+                        copy_done.record(stream)
+                    batch_queue.put((batch, copy_done))
+            batch_queue.put(_END_OF_DATA)
+        except BaseException as exception:
+            batch_queue.put(exception)
+
+    def starved_fraction(self) -> float:
+        return self.starved_seconds / self.total_seconds if self.total_seconds > 0 else 0.0
+
+    def report(self) -> str:
+        return f"Prefetcher: {self.num_starved} of {self.num_batches} batches waited on input, {self.starved_seconds:.1f} " \
+               f"of {self.total_seconds:.1f} s ({100 * self.starved_fraction():.1f}%) spent waiting."
+
+
+def record_stream(batch, stream):
+    """
+    mark the CUDA tensors of a batch as used by a stream, so that their memory, which was allocated on the copy stream,
+    is not reused before the consuming stream is done with it
+    """
+    for value in vars(batch).values():
+        if isinstance(value, torch.Tensor) and value.is_cuda:
+            value.record_stream(stream)
+
+
+def background_generator(generator, depth: int = DEFAULT_PREFETCH_DEPTH):
+    """
+    run a generator in a background thread, keeping up to depth of its items ready in a bounded queue.  Chaining these
+    turns a sequence of generators into a pipeline whose stages run concurrently.  Exceptions in the background thread
+    are re-raised in the consumer.
+    """
+    assert depth > 0, "queue depth must be positive"
+    item_queue = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+
+    def produce():
+        try:
+            for item in generator:
+                if stop.is_set():
+                    return
+                item_queue.put(item)
+            item_queue.put(_END_OF_DATA)
+        except BaseException as exception:
+            item_queue.put(exception)
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while (item := item_queue.get()) is not _END_OF_DATA:
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        stop.set()
+        # unblock the producer if it is waiting on a full queue
+        while thread.is_alive():
+            try:
+                item_queue.get(timeout=0.1)
+            except queue.Empty:
+                pass
+
+
+def prefetch_generator(dataloader: DataLoader, device=gpu_if_available(), depth: int = DEFAULT_PREFETCH_DEPTH) -> Prefetcher:
     """
     prefetch and send batches to GPU in the background
-    dataloader must yield betches that have a copy_to method
-    """
-    loader_iter = iter(dataloader)
-    is_cuda = device.type == 'cuda'
-    dtype = DEFAULT_GPU_FLOAT if is_cuda else DEFAULT_CPU_FLOAT
-    next_batch_cpu = next(loader_iter, None)
-    next_batch = None if next_batch_cpu is None else next_batch_cpu.copy_to(device=device, dtype=dtype)
-    for _ in range(len(dataloader)):
-        # the prefetched + sent-to-GPU batch is processed
-        batch = next_batch
-        # but in the background we'll fetch the next batch and send to GPU
-        # the default None will come up on the final batch where there is no next batch to prefetch
-        next_batch_cpu = next(loader_iter, None)
-        next_batch = None if next_batch_cpu is None else next_batch_cpu.copy_to(device, dtype=dtype)
-        yield batch
\ No newline at end of file
+    dataloader must yield batches that have a copy_to method
+    """
+    return Prefetcher(dataloader, device, depth)
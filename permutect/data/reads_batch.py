@@ -38,6 +38,18 @@ class ReadsBatch(Batch):
         list_of_alt_tensors = [item.get_alt_reads_re() for item in data]
         self.reads_re = torch.from_numpy(np.vstack(list_of_ref_tensors + list_of_alt_tensors))
 
+    @classmethod
+    def from_tensors(cls, data_be: Tensor, reads_re: Tensor) -> ReadsBatch:
+        """
+        construct a batch from already-collated tensors, without any per-datum objects.  reads_re must contain the ref
+        reads of all data followed by the alt reads of all data.
+        """
+        result = cls.__new__(cls)
+        result.data = data_be
+        result.reads_re = reads_re
+        result._finish_initializiation_from_data_array()
+        return result
+
     # pin memory for all tensors that are sent to the GPU
     def pin_memory(self):
         super().pin_memory()
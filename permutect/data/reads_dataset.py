@@ -2,26 +2,39 @@ import math
 import os
 import psutil
 import random
-import tarfile
 import tempfile
+import time
 from typing import Iterable, List
 
+import numpy as np
 import torch
 from torch.utils.data import Dataset, DataLoader
 from torch.utils.data.sampler import Sampler
 
 from mmap_ninja.ragged import RaggedMmap
 from permutect.data.count_binning import cap_ref_count, cap_alt_count
+from permutect.data.memory_mapped_data import MemoryMappedData, is_memory_mapped_dataset, metadata_from_data_array
+from permutect.data.plain_text_data import NORMALIZATION_FILE_NAME
 from permutect.data.reads_datum import ReadsDatum
 from permutect.data.reads_batch import ReadsBatch
-from permutect.data.batch import BatchProperty, BatchIndexedTensor
+from permutect.data.batch import BatchProperty, BatchIndexedTensor, BatchIndices
+from permutect.misc_utils import generate_tar_members, get_rank, get_world_size
 from permutect.utils.enums import Variation, Label
 
 TENSORS_PER_BASE_DATUM = 2  # 1) 2D reads (ref and alt), 1) 1D concatenated stuff
 
-# tarfiles on disk take up about 4x as much as the dataset on RAM
+# legacy tarfiles on disk take up about 4x as much as the dataset on RAM
 TARFILE_TO_RAM_RATIO = 4
 
+# by default, datasets may use this fraction of the available RAM
+DEFAULT_MEMORY_FRACTION = 0.8
+
+
+class MemoryMode:
+    RAM = "ram"         # everything in RAM
+    HYBRID = "hybrid"   # datum arrays and read offsets in RAM, reads memory-mapped
+    MMAP = "mmap"       # everything memory-mapped
+
 
 WEIGHT_PSEUDOCOUNT = 10
 
@@ -31,60 +44,148 @@ def ratio_with_pseudocount(a, b):
 
 
 class ReadsDataset(Dataset):
-    def __init__(self, data_in_ram: Iterable[ReadsDatum] = None, data_tarfile=None, num_folds: int = 1):
+    def __init__(self, data_in_ram: Iterable[ReadsDatum] = None, data_tarfile=None, num_folds: int = 1, memory_budget: int = None):
+        """
+        memory_budget: bytes of RAM the dataset may occupy.  If None, a fraction of the currently available RAM.
+        """
         super(ReadsDataset, self).__init__()
         assert data_in_ram is not None or data_tarfile is not None, "No data given"
         assert data_in_ram is None or data_tarfile is None, "Data given from both RAM and tarfile"
         self.num_folds = num_folds
-        self.totals_slvra = BatchIndexedTensor.make_zeros(num_sources=1, include_logits=False, device=torch.device('cpu'))
-
+        self.pin_batches = False    # whether __getitems__ gathers batches into pinned memory
+        # seconds and bytes of fetching in __getitems__, in shared memory so that data loader workers contribute.  It
+        # must not be an inference tensor, even if the dataset is created in inference mode, because it is updated in
+        # place by data loader threads and processes outside of inference mode
+        with torch.inference_mode(False):
+            self.fetch_seconds_and_bytes = torch.zeros(2, dtype=torch.float64).share_memory_()
+
+        self._memory_mapped_data = None
+        self.memory_mode = MemoryMode.RAM
         if data_in_ram is not None:
             self._data = data_in_ram
             self._memory_map_mode = False
         else:
-            tarfile_size = os.path.getsize(data_tarfile)    # in bytes
-            estimated_data_size_in_ram = tarfile_size // TARFILE_TO_RAM_RATIO
             available_memory = psutil.virtual_memory().available
-            fits_in_ram = estimated_data_size_in_ram < 0.8 * available_memory
+            if memory_budget is None:
+                memory_budget = int(DEFAULT_MEMORY_FRACTION * available_memory)
+            print(f"The system has {available_memory} bytes of RAM available and the dataset memory budget is {memory_budget} bytes.")
 
-            print(f"The tarfile size is {tarfile_size} bytes on disk for an estimated {estimated_data_size_in_ram} bytes in memory and the system has {available_memory} bytes of RAM available.")
-            if fits_in_ram:
-                print("loading the dataset from the tarfile into RAM:")
-                self._data = list(make_base_data_generator_from_tarfile(data_tarfile))
+            if is_memory_mapped_dataset(data_tarfile):
+                self._memory_mapped_data = MemoryMappedData(data_tarfile)
                 self._memory_map_mode = False
+                reads_bytes, data_bytes = self._memory_mapped_data.reads_size_in_bytes(), self._memory_mapped_data.data_size_in_bytes()
+                print(f"The dataset has {reads_bytes} bytes of reads and {data_bytes} bytes of other data.")
+                if reads_bytes + data_bytes <= memory_budget:
+                    print("loading the dataset into RAM:")
+                    self.memory_mode = MemoryMode.RAM
+                    self._memory_mapped_data.load_into_ram(include_reads=True)
+                elif data_bytes <= memory_budget:
+                    print("loading the dataset into RAM, except for reads, which are memory-mapped:")
+                    self.memory_mode = MemoryMode.HYBRID
+                    self._memory_mapped_data.load_into_ram(include_reads=False)
+                else:
+                    print("memory-mapping the dataset:")
+                    self.memory_mode = MemoryMode.MMAP
             else:
-                print("loading the dataset into a memory-mapped file:")
-                self._memory_map_dir = tempfile.TemporaryDirectory()
+                # legacy tarfiles don't record their in-memory size, so we estimate it
+                tarfile_size = os.path.getsize(data_tarfile)    # in bytes
+                estimated_data_size_in_ram = tarfile_size // TARFILE_TO_RAM_RATIO
+                fits_in_ram = estimated_data_size_in_ram < memory_budget
+
+                print(f"The tarfile size is {tarfile_size} bytes on disk for an estimated {estimated_data_size_in_ram} bytes in memory.")
+                if fits_in_ram:
+                    print("loading the dataset from the tarfile into RAM:")
+                    self._data = list(make_base_data_generator_from_tarfile(data_tarfile))
+                    self._memory_map_mode = False
+                else:
+                    print("loading the dataset into a memory-mapped file:")
+                    self.memory_mode = MemoryMode.MMAP
+                    self._memory_map_dir = tempfile.TemporaryDirectory()
+
+                    RaggedMmap.from_generator(out_dir=self._memory_map_dir.name,
+                                              sample_generator=make_flattened_tensor_generator(
+                                                  make_base_data_generator_from_tarfile(data_tarfile)),
+                                              batch_size=10000, verbose=False)
+                    self._data = RaggedMmap(self._memory_map_dir.name)
+                    self._memory_map_mode = True
+
+        # columns of label, source etc. for vectorized totals, folds, and sampler masks
+        if self._memory_mapped_data is not None:
+            self.metadata = self._memory_mapped_data.metadata
+        else:
+            self.metadata = metadata_from_data_array(np.vstack(list(self._generate_datum_arrays())))
 
-                RaggedMmap.from_generator(out_dir=self._memory_map_dir.name,
-                                          sample_generator=make_flattened_tensor_generator(
-                                              make_base_data_generator_from_tarfile(data_tarfile)),
-                                          batch_size=10000, verbose=False)
-                self._data = RaggedMmap(self._memory_map_dir.name)
-                self._memory_map_mode = True
+        self.totals_slvra = BatchIndexedTensor.make_zeros(num_sources=int(np.max(self.metadata['source'])) + 1,
+                                                          include_logits=False, device=torch.device('cpu'))
+        metadata_columns = {name: torch.from_numpy(self.metadata[name].astype(np.int64)) for name in self.metadata.dtype.names}
+        batch_indices = BatchIndices(sources=metadata_columns['source'], labels=metadata_columns['label'],
+                                     var_types=metadata_columns['variant_type'], ref_counts=metadata_columns['ref_count'],
+                                     alt_counts=metadata_columns['alt_count'])
+        batch_indices.increment_tensor(self.totals_slvra, values=torch.ones(len(self.metadata)))
 
         # this is used in the batch sampler to make same-shape batches
-        self.indices_by_fold = [[] for _ in range(num_folds)]
-
-        for n, datum in enumerate(self):
-            self.totals_slvra.record_datum(datum)
-            fold = n % num_folds
-            self.indices_by_fold[fold].append(n)
+        self.indices_by_fold = [np.arange(fold, len(self.metadata), num_folds) for fold in range(num_folds)]
 
         self.num_read_features = self[0].get_reads_re().shape[1]
         self.num_info_features = len(self[0].get_info_1d())
         self.haplotypes_length = len(self[0].get_haplotypes_1d())
 
+        # for counting the bytes of fetched data in RAM from the metadata rather than datum by datum
+        self._datum_array_bytes = self[0].get_array_1d().nbytes
+        self._read_bytes = self[0].get_reads_re().itemsize * self.num_read_features
+
     def __len__(self):
+        if self._memory_mapped_data is not None:
+            return len(self._memory_mapped_data)
         return len(self._data) // TENSORS_PER_BASE_DATUM if self._memory_map_mode else len(self._data)
 
     def __getitem__(self, index):
-        if self._memory_map_mode:
+        if self._memory_mapped_data is not None:
+            return self._memory_mapped_data.get_reads_datum(index)
+        elif self._memory_map_mode:
             bottom_index = index * TENSORS_PER_BASE_DATUM
             return ReadsDatum(datum_array=self._data[bottom_index + 1], reads_re=self._data[bottom_index])
         else:
             return self._data[index]
 
+    def _generate_datum_arrays(self):
+        """
+        datum arrays without the reads, where the storage allows it
+        """
+        if self._memory_map_mode:
+            for n in range(len(self)):
+                yield self._data[n * TENSORS_PER_BASE_DATUM + 1]
+        else:
+            for datum in self._data:
+                yield datum.get_array_1d()
+
+    def __getitems__(self, indices):
+        """
+        DataLoader fetches whole batches of indices from the batch sampler via this method.  For the memory-mapped
+        format a collated ReadsBatch is gathered directly from the backing arrays, otherwise a list of ReadsDatum.
+        """
+        start = time.time()
+        if self._memory_mapped_data is not None:
+            data_be, reads_re = self._memory_mapped_data.gather_batch(indices, pin_memory=self.pin_batches)
+            result = ReadsBatch.from_tensors(data_be, reads_re)
+            num_bytes = data_be.nelement() * data_be.element_size() + reads_re.nelement() * reads_re.element_size()
+        else:
+            result = [self[index] for index in indices]
+            num_reads = np.sum(self.metadata['ref_count'][indices], dtype=np.int64) + np.sum(self.metadata['alt_count'][indices], dtype=np.int64)
+            num_bytes = len(indices) * self._datum_array_bytes + int(num_reads) * self._read_bytes
+        self.fetch_seconds_and_bytes += torch.tensor([time.time() - start, num_bytes], dtype=torch.float64)
+        return result
+
+    def report_fetch_throughput(self, message: str = ""):
+        """
+        print the throughput of fetching data since the last report and reset it.  With several data loader workers
+        the seconds of fetching are summed over workers, and batches still being prefetched count towards the next report.
+        """
+        seconds, num_bytes = self.fetch_seconds_and_bytes.tolist()
+        self.fetch_seconds_and_bytes.zero_()
+        megabytes = num_bytes / 1e6
+        print(f"{message} fetched {megabytes:.1f} MB in {seconds:.1f} s, {megabytes / max(seconds, 1e-6):.1f} MB/s.")
+
     def num_sources(self) -> int:
         return self.totals_slvra.num_sources()
 
@@ -122,9 +223,32 @@ class ReadsDataset(Dataset):
         return num_sources
 
     def make_data_loader(self, folds_to_use: List[int], batch_size: int, pin_memory=False, num_workers: int = 0,
-                         sources_to_use: List[int] = None, labeled_only: bool = False):
-        sampler = SemiSupervisedBatchSampler(self, batch_size, folds_to_use, sources_to_use, labeled_only)
-        return DataLoader(dataset=self, batch_sampler=sampler, collate_fn=ReadsBatch, pin_memory=pin_memory, num_workers=num_workers)
+                         sources_to_use: List[int] = None, labeled_only: bool = False, shuffle_block_size: int = 0,
+                         shuffle_window_size: int = 0, read_budget: int = 0, bucket_by_read_count: bool = False,
+                         distributed: bool = False):
+        """
+        shuffle_block_size: if positive, use a BlockShuffleBatchSampler with this block size and a shuffle window of
+            shuffle_window_size for sequential access to out-of-core data.  Otherwise, data are fully shuffled.
+        read_budget: if positive, use a ReadBudgetBatchSampler that forms batches of at most this many reads, optionally
+            bucketed by read count, instead of batches of batch_size data.
+        distributed: if True, use a DistributedSemiSupervisedBatchSampler that gives this process its share of every
+            batch in data-parallel training.
+        """
+        if distributed:
+            assert read_budget <= 0 and shuffle_block_size <= 0, "distributed training requires fixed-size, fully shuffled batches"
+            sampler = DistributedSemiSupervisedBatchSampler(self, batch_size, folds_to_use, sources_to_use, labeled_only)
+        elif read_budget > 0:
+            assert shuffle_block_size <= 0, "batching by read budget requires fully random shuffling"
+            sampler = ReadBudgetBatchSampler(self, read_budget, folds_to_use, sources_to_use, labeled_only, bucket_by_read_count)
+        elif shuffle_block_size > 0:
+            sampler = BlockShuffleBatchSampler(self, batch_size, folds_to_use, sources_to_use, labeled_only,
+                                               block_size=shuffle_block_size, window_size=shuffle_window_size)
+        else:
+            sampler = SemiSupervisedBatchSampler(self, batch_size, folds_to_use, sources_to_use, labeled_only)
+        # memory pinned in worker processes doesn't survive the transfer to the main process, so in that case the
+        # DataLoader pins batches after the fact
+        self.pin_batches = pin_memory and num_workers == 0
+        return DataLoader(dataset=self, batch_sampler=sampler, collate_fn=collate_reads_batch, pin_memory=pin_memory, num_workers=num_workers)
 
     def make_train_and_valid_loaders(self, validation_fold: int, batch_size: int, is_cuda: bool, num_workers: int, sources_to_use: List[int] = None):
         train_loader = self.make_data_loader(self.all_but_one_fold(validation_fold), batch_size, is_cuda, num_workers, sources_to_use)
@@ -132,6 +256,13 @@ class ReadsDataset(Dataset):
         return train_loader, valid_loader
 
 
+def collate_reads_batch(data) -> ReadsBatch:
+    """
+    data are either a ReadsBatch already gathered by ReadsDataset.__getitems__ or a list of ReadsDatum
+    """
+    return data if isinstance(data, ReadsBatch) else ReadsBatch(data)
+
+
 # from a generator that yields BaseDatum(s), create a generator that yields the two numpy arrays needed to reconstruct the datum
 def make_flattened_tensor_generator(reads_data_generator):
     for reads_datum in reads_data_generator:
@@ -140,14 +271,16 @@ def make_flattened_tensor_generator(reads_data_generator):
 
 
 def make_base_data_generator_from_tarfile(data_tarfile):
-    # extract the tarfile to a temporary directory that will be cleaned up when the program ends
-    temp_dir = tempfile.TemporaryDirectory()
-    tar = tarfile.open(data_tarfile)
-    tar.extractall(temp_dir.name)
-    tar.close()
-    data_files = [os.path.abspath(os.path.join(temp_dir.name, p)) for p in os.listdir(temp_dir.name)]
-
-    for file in data_files:
+    if is_memory_mapped_dataset(data_tarfile):
+        memory_mapped_data = MemoryMappedData(data_tarfile)
+        for n in range(len(memory_mapped_data)):
+            yield memory_mapped_data.get_reads_datum(n)
+        return
+
+    # legacy tarfile of ReadsDatum.save_list files, deserialized straight from the tar stream
+    for name, file in generate_tar_members(data_tarfile):
+        if os.path.basename(name) == NORMALIZATION_FILE_NAME:
+            continue
         for datum in ReadsDatum.load_list(file):
             ref_count = cap_ref_count(datum.get_ref_count())
             alt_count = cap_alt_count(datum.get_alt_count())
@@ -166,24 +299,20 @@ class SemiSupervisedBatchSampler(Sampler):
     def __init__(self, dataset: ReadsDataset, batch_size: int, folds_to_use: List[int],
                  sources_to_use: List[int] = None, labeled_only: bool = False):
         # combine the index maps of all relevant folds
-        self.indices_to_use = []
-        source_set = None if sources_to_use is None else set(sources_to_use)
-        for fold in folds_to_use:
-            indices_in_fold = dataset.indices_by_fold[fold] if not labeled_only else \
-                [idx for idx in dataset.indices_by_fold[fold] if dataset[idx].get_label() != Label.UNLABELED]
-            if sources_to_use is None:
-                source_indices_in_fold = indices_in_fold
-            else:
-                source_indices_in_fold = [idx for idx in indices_in_fold if dataset[idx].get_source() in source_set]
-
-            self.indices_to_use.extend(source_indices_in_fold)
+        indices = np.concatenate([dataset.indices_by_fold[fold] for fold in folds_to_use])
+        mask = np.ones(len(indices), dtype=bool)
+        if labeled_only:
+            mask &= dataset.metadata['label'][indices] != Label.UNLABELED
+        if sources_to_use is not None:
+            mask &= np.isin(dataset.metadata['source'][indices], sources_to_use)
+        self.indices_to_use = indices[mask]
 
         self.batch_size = batch_size
         self.num_batches = math.ceil(len(self.indices_to_use) / self.batch_size)
 
     def __iter__(self):
-        batches = []    # list of lists of indices -- each sublist is a batch
-        random.shuffle(self.indices_to_use)
+        batches = []    # list of arrays of indices -- each array is a batch
+        np.random.shuffle(self.indices_to_use)
         batches.extend(chunk(self.indices_to_use, self.batch_size))
         random.shuffle(batches)
 
@@ -192,3 +321,114 @@ class SemiSupervisedBatchSampler(Sampler):
     def __len__(self):
         return self.num_batches
 
+
+class DistributedSemiSupervisedBatchSampler(SemiSupervisedBatchSampler):
+    """
+    Batch sampler for data-parallel training.  All processes shuffle the data of the given folds and sources identically,
+    using a seed that is shared between processes and advances every epoch, and split them into batches of batch_size.
+    Each batch is dealt out among processes, so that together the processes take the same steps as a single process
+    with this batch size, and every process has the same number of batches.  A final batch too small to give every
+    process a datum is dropped.
+
+    By default the rank and number of processes are those of the current process group.
+    """
+    def __init__(self, dataset: ReadsDataset, batch_size: int, folds_to_use: List[int], sources_to_use: List[int] = None,
+                 labeled_only: bool = False, rank: int = None, world_size: int = None, seed: int = 0):
+        super(DistributedSemiSupervisedBatchSampler, self).__init__(dataset, batch_size, folds_to_use, sources_to_use, labeled_only)
+        self.rank = get_rank() if rank is None else rank
+        self.world_size = get_world_size() if world_size is None else world_size
+        assert 0 <= self.rank < self.world_size, "rank must be between 0 and the number of processes"
+        assert batch_size >= self.world_size, "batch size must be at least the number of processes"
+        self.seed, self.epoch = seed, 0
+        num_data = len(self.indices_to_use)
+        self.num_batches = num_data // batch_size + (1 if num_data % batch_size >= self.world_size else 0)
+
+    def __iter__(self):
+        rng = np.random.default_rng(self.seed + self.epoch)
+        self.epoch += 1
+        shuffled_indices = self.indices_to_use[rng.permutation(len(self.indices_to_use))]
+        batches = [batch[self.rank::self.world_size] for batch in chunk(shuffled_indices, self.batch_size) if len(batch) >= self.world_size]
+        return iter([batches[n] for n in rng.permutation(len(batches))])
+
+
+class ReadBudgetBatchSampler(SemiSupervisedBatchSampler):
+    """
+    Batch sampler that packs shuffled data into batches of at most read_budget total ref and alt reads, rather than a
+    fixed number of data, so that memory and time per batch are predictable.  A datum with more reads than the budget
+    gets a batch to itself.
+
+    If bucket_by_read_count is set, data are sorted by read count, with ties in random order, before packing, so that
+    each batch contains data of similar read counts.  The order of batches is always shuffled.
+
+    The number of batches varies slightly between epochs, so len() is that of one packing done in advance.  With
+    bucket_by_read_count it is exact, since sorted read counts pack the same way every epoch.
+    """
+    def __init__(self, dataset: ReadsDataset, read_budget: int, folds_to_use: List[int], sources_to_use: List[int] = None,
+                 labeled_only: bool = False, bucket_by_read_count: bool = False):
+        assert read_budget > 0, "read budget must be positive"
+        super(ReadBudgetBatchSampler, self).__init__(dataset, read_budget, folds_to_use, sources_to_use, labeled_only)
+        self.read_budget = read_budget
+        self.bucket_by_read_count = bucket_by_read_count
+        self.read_counts = dataset.metadata['ref_count'].astype(np.int64) + dataset.metadata['alt_count'].astype(np.int64)
+        self.num_batches = len(self.make_batches())
+
+    def make_batches(self) -> List[np.ndarray]:
+        np.random.shuffle(self.indices_to_use)
+        indices = self.indices_to_use
+        if self.bucket_by_read_count:
+            indices = indices[np.argsort(self.read_counts[indices], kind='stable')]
+        return pack_into_budget(indices, self.read_counts[indices], self.read_budget)
+
+    def __iter__(self):
+        batches = self.make_batches()
+        random.shuffle(batches)
+        return iter(batches)
+
+
+def pack_into_budget(indices: np.ndarray, sizes: np.ndarray, budget: int) -> List[np.ndarray]:
+    """
+    split indices, in order, into consecutive batches whose sizes sum to at most the budget, except that an index whose
+    size alone exceeds the budget forms its own batch.  Batches are filled greedily, and the end of each is found by
+    binary search in the cumulative sizes, so the loop is over batches rather than data.
+    """
+    cumulative_sizes = np.concatenate(([0], np.cumsum(sizes)))
+    batch_starts, start = [], 0
+    while start < len(indices):
+        batch_starts.append(start)
+        end = np.searchsorted(cumulative_sizes, cumulative_sizes[start] + budget, side='right') - 1
+        start = max(end, start + 1)
+    return np.split(indices, batch_starts[1:]) if len(indices) > 0 else []
+
+
+class BlockShuffleBatchSampler(SemiSupervisedBatchSampler):
+    """
+    Batch sampler for data that don't fit in RAM, such as memory-mapped datasets, that trades some randomness for
+    sequential disk access.  The data used are split into blocks of block_size consecutive indices and the order of
+    blocks is shuffled.  Blocks are then read in that order, window_size data at a time, and data are shuffled within each
+    window.  Thus only one window's worth of storage is accessed at a time, in large contiguous pieces.
+
+    The window is rounded up to a whole number of blocks.  Each epoch reports the throughput of reading the data.
+    """
+    def __init__(self, dataset: ReadsDataset, batch_size: int, folds_to_use: List[int], sources_to_use: List[int] = None,
+                 labeled_only: bool = False, block_size: int = 10000, window_size: int = 100000):
+        super(BlockShuffleBatchSampler, self).__init__(dataset, batch_size, folds_to_use, sources_to_use, labeled_only)
+        assert block_size > 0, "block size must be positive"
+        self.indices_to_use.sort()  # consecutive indices are consecutive in storage
+        self.block_size = block_size
+        self.blocks_per_window = max(1, math.ceil(window_size / block_size))
+        self.dataset = dataset
+
+    def __iter__(self):
+        blocks = chunk(self.indices_to_use, self.block_size)
+        random.shuffle(blocks)
+
+        windows = []
+        for window_start in range(0, len(blocks), self.blocks_per_window):
+            window = np.concatenate(blocks[window_start:window_start + self.blocks_per_window])
+            np.random.shuffle(window)
+            windows.append(window)
+        shuffled_indices = np.concatenate(windows) if windows else np.zeros(0, dtype=np.int64)
+
+        for batch in chunk(shuffled_indices, self.batch_size):
+            yield batch
+        self.dataset.report_fetch_throughput(f"Block shuffle sampler: {len(shuffled_indices)} data,")
@@ -15,7 +15,7 @@ from permutect.metrics.loss_metrics import AccuracyMetrics
 from permutect.data.count_binning import NUM_ALT_COUNT_BINS, NUM_REF_COUNT_BINS, \
     ref_count_bin_name, count_from_alt_bin_index, alt_count_bin_name
 from permutect.metrics.posterior_result import PosteriorResult
-from permutect.misc_utils import gpu_if_available
+from permutect.misc_utils import gpu_if_available, all_reduce_sum
 from permutect.utils.enums import Variation, Call, Epoch, Label
 
 NUM_DATA_FOR_TENSORBOARD_PROJECTION = 10000
@@ -41,6 +41,16 @@ class EvaluationMetrics:
         self.has_been_sent_to_cpu = True
         return self
 
+    def all_reduce(self, epoch_types: List[Epoch]):
+        """
+        In data-parallel training, sum over processes so that every process has the metrics of all data.  Every process
+        must pass the same epoch types.
+        """
+        assert not self.has_been_sent_to_cpu, "Can't all-reduce after already sending to CPU"
+        for epoch_type in epoch_types:
+            all_reduce_sum(self.accuracy_metrics_by_epoch_type[epoch_type])
+        return self
+
     # TODO: currently doesn't record unlabeled data at all
     def record_batch(self, epoch_type: Epoch, batch: Batch, logits: Tensor, weights: Tensor = None):
         assert not self.has_been_sent_to_cpu, "Can't record after already sending to CPU"
@@ -170,6 +180,7 @@ class EmbeddingMetrics:
     TRUE_NEGATIVE = "true-negative"
     FALSE_NEGATIVE_ARTIFACT = "false-negative-artifact"
     TRUE_NEGATIVE_SEQ_ERROR = "true-negative-seq-error"
+    UNKNOWN = "unknown"
 
     def __init__(self):
         # things we will collect for the projections
@@ -215,14 +226,15 @@ class EmbeddingMetrics:
 
             interesting = interesting_indices & indices
             boring = boring_indices & indices
-            boring_count = max(len(interesting) // 3, 100) if is_filter_variants else len(boring)
+            boring_count = min(max(len(interesting) // 3, 100), len(boring)) if is_filter_variants else len(boring)
             boring_to_keep = np.array([int(n) for n in boring])[np.random.choice(len(boring), size=boring_count, replace=False)]
             idx = sample_indices_for_tensorboard(np.hstack((boring_to_keep, np.array([int(n) for n in interesting]))))
 
-            summary_writer.add_embedding(stacked_features[idx],
-                                         metadata=[all_metadata[round(n)] for n in idx.tolist()],
-                                         metadata_header=["Labels", "Correctness", "Types", "Counts"],
-                                         tag=prefix+"embedding for variant type " + variant_name, global_step=epoch)
+            if len(idx) > 0:
+                summary_writer.add_embedding(stacked_features[idx],
+                                             metadata=[all_metadata[round(n)] for n in idx.tolist()],
+                                             metadata_header=["Labels", "Correctness", "Types", "Counts"],
+                                             tag=prefix+"embedding for variant type " + variant_name, global_step=epoch)
 
         # read average embeddings stratified by alt count
         for count_bin in range(NUM_ALT_COUNT_BINS):
@@ -230,7 +242,7 @@ class EmbeddingMetrics:
             indices = set([n for n, alt_count in enumerate(self.truncated_count_metadata) if alt_count == str(count)])
             interesting = interesting_indices & indices
             boring = boring_indices & indices
-            boring_count = max(len(interesting) // 3, 100) if is_filter_variants else len(boring)
+            boring_count = min(max(len(interesting) // 3, 100), len(boring)) if is_filter_variants else len(boring)
             boring_to_keep = np.array([int(n) for n in boring])[np.random.choice(len(boring), size=boring_count, replace=False)]
             idx = sample_indices_for_tensorboard(np.hstack((boring_to_keep, np.array([int(n) for n in interesting]))))
 
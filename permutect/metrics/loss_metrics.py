@@ -12,7 +12,7 @@ from permutect.data.batch import Batch, BatchProperty, BatchIndexedTensor
 from permutect.data.count_binning import NUM_LOGIT_BINS, top_of_logit_bin, logits_from_bin_indices, \
     ALT_COUNT_BIN_BOUNDS, REF_COUNT_BIN_BOUNDS, NUM_ALT_COUNT_BINS, alt_count_bin_name, NUM_REF_COUNT_BINS
 from permutect.metrics import plotting
-from permutect.misc_utils import gpu_if_available
+from permutect.misc_utils import gpu_if_available, all_reduce_sum
 from permutect.utils.array_utils import select_and_sum
 from permutect.utils.enums import Variation, Epoch, Label
 
@@ -41,6 +41,15 @@ class LossMetrics:
         self.totals_slvra.record(batch, (values * weights_to_use).detach())
         self.counts_slvra.record(batch, weights_to_use.detach())
 
+    def all_reduce(self):
+        """
+        In data-parallel training, sum over processes so that every process has the metrics of all data.
+        """
+        assert not self.has_been_sent_to_cpu, "Can't all-reduce after already sending to CPU"
+        all_reduce_sum(self.totals_slvra)
+        all_reduce_sum(self.counts_slvra)
+        return self
+
     def get_averages(self) -> BatchIndexedTensor:
         return self.totals_slvra / (0.001 + self.counts_slvra)
 
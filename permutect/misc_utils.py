@@ -1,9 +1,15 @@
+import contextlib
+import datetime
+import hashlib
+import io
 import psutil
 import tarfile
 import os
 import torch
 from torch import Tensor
 
+from permutect.utils.enums import Precision
+
 
 def report_memory_usage(message: str = ""):
     print(f"{message}  Memory usage: {psutil.virtual_memory().percent:.1f}%")
@@ -100,14 +106,172 @@ class StreamingAverage:
         self._sum += torch.sum(values * weights).item()
 
 
-def backpropagate(optimizer: torch.optim.Optimizer, loss: Tensor):
+def backpropagate(optimizer: torch.optim.Optimizer, loss: Tensor, grad_scaler: torch.cuda.amp.GradScaler = None,
+                  distributed: bool = False):
+    """
+    distributed: sum gradients over all processes before the optimizer step, for data-parallel training
+    """
     optimizer.zero_grad(set_to_none=True)
-    loss.backward()
-    optimizer.step()
+    (loss if grad_scaler is None else grad_scaler.scale(loss)).backward()
+    if distributed:
+        sum_gradients(param for group in optimizer.param_groups for param in group['params'])
+    if grad_scaler is None:
+        optimizer.step()
+    else:
+        grad_scaler.step(optimizer)
+        grad_scaler.update()
+
+
+AUTOCAST_DTYPES = {Precision.BF16: torch.bfloat16, Precision.FP16: torch.float16}
+
+
+def mixed_precision(device: torch.device, precision: Precision):
+    """
+    context manager in which eligible operations (eg matrix multiplications) run in the given reduced precision
+    """
+    if precision == Precision.FP32:
+        return contextlib.nullcontext()
+    if precision == Precision.FP16 and device.type != 'cuda':
+        raise Exception("fp16 mixed precision requires a GPU.  Use bf16 on the CPU.")
+    return torch.autocast(device_type=device.type, dtype=AUTOCAST_DTYPES[precision])
+
+
+def full_precision(device: torch.device):
+    """
+    context manager that disables autocast, for numerically sensitive computations within a mixed-precision region
+    """
+    return torch.autocast(device_type=device.type, enabled=False)
+
+
+# the main process alone makes plots, saves outputs, and in prune_dataset prunes a whole fold while the others wait in
+# their next collective operation, which must not time out in the meantime
+DEFAULT_DISTRIBUTED_TIMEOUT_HOURS = 24
+
+
+def init_distributed_from_environment(timeout_hours: float = None, backend: str = 'gloo') -> bool:
+    """
+    join a process group for data-parallel training if launched as one of several processes, eg by torchrun, which sets
+    the RANK, WORLD_SIZE, LOCAL_RANK, MASTER_ADDR and MASTER_PORT environment variables.  Returns whether training is
+    distributed.  Without a process group the helpers below reduce to the single-process case.
+
+    timeout_hours: how long a process may wait in a collective operation, by default DEFAULT_DISTRIBUTED_TIMEOUT_HOURS
+    """
+    if is_distributed() or int(os.environ.get('WORLD_SIZE', 1)) <= 1:
+        return is_distributed()
+    if torch.cuda.is_available():
+        torch.cuda.set_device(int(os.environ.get('LOCAL_RANK', 0)))   # so that gpu_if_available() is this process's GPU
+    timeout = datetime.timedelta(hours=DEFAULT_DISTRIBUTED_TIMEOUT_HOURS if timeout_hours is None else timeout_hours)
+    torch.distributed.init_process_group(backend=backend, timeout=timeout)
+    print(f"Process {get_rank()} of {get_world_size()} joined the {backend} process group.")
+    return True
+
+
+def is_distributed() -> bool:
+    return torch.distributed.is_available() and torch.distributed.is_initialized()
+
+
+def get_rank() -> int:
+    return torch.distributed.get_rank() if is_distributed() else 0
+
+
+def get_world_size() -> int:
+    return torch.distributed.get_world_size() if is_distributed() else 1
+
+
+def is_main_process() -> bool:
+    return get_rank() == 0
 
 
-def extract_to_temp_dir(tar_file, directory):
-    tar = tarfile.open(tar_file)
-    tar.extractall(directory)
-    tar.close()
-    return [os.path.abspath(os.path.join(directory, p)) for p in os.listdir(directory)]
+def all_reduce_sum(tensor: Tensor) -> Tensor:
+    """
+    in-place sum of a tensor over all processes
+    """
+    if is_distributed():
+        torch.distributed.all_reduce(tensor.data, op=torch.distributed.ReduceOp.SUM)
+    return tensor
+
+
+def broadcast_module(module: torch.nn.Module):
+    """
+    copy parameters and buffers from the main process so that all processes start from the same state
+    """
+    if is_distributed():
+        for tensor in module.state_dict().values():
+            torch.distributed.broadcast(tensor, src=0)
+
+
+def sum_gradients(parameters):
+    """
+    sum the gradients of trainable parameters over all processes in a single all-reduce.  Since losses are sums over data,
+    the result is the gradient of the combined batch of all processes.  A parameter keeps a gradient of None only if it
+    has none in every process, so that the optimizer treats it exactly as in a single-process run.
+    """
+    if not is_distributed():
+        return
+    params = [param for param in parameters if param.requires_grad]
+    if not params:
+        return
+    has_grad_p = torch.tensor([float(param.grad is not None) for param in params], device=params[0].device)
+    grads = [param.grad.reshape(-1) if param.grad is not None else torch.zeros(param.numel(), device=param.device, dtype=param.dtype) for param in params]
+    flattened = all_reduce_sum(torch.cat(grads + [has_grad_p.to(dtype=grads[0].dtype)]))
+    has_grad_p = flattened[-len(params):] > 0
+    offset = 0
+    for param, has_grad in zip(params, has_grad_p.tolist()):
+        param.grad = flattened[offset:offset + param.numel()].view_as(param).clone() if has_grad else None
+        offset += param.numel()
+
+
+TAR_INDEX_SUFFIX = '.index'
+
+
+def write_tar_index(tar_file):
+    """
+    write a sidecar index of the tarfile's regular file members, one "name offset size" line per member, where offset
+    is the byte offset of the member's contents.  Only meaningful for uncompressed tarfiles.
+    """
+    with tarfile.open(tar_file) as tar, open(tar_file + TAR_INDEX_SUFFIX, 'w') as index_file:
+        for member in tar:
+            if member.isfile():
+                index_file.write(f"{member.name}\t{member.offset_data}\t{member.size}\n")
+
+
+def read_tar_index(tar_file):
+    """
+    list of (name, offset, size) tuples from the tarfile's sidecar index, or None if there is no index or it is older
+    than the tarfile
+    """
+    index_file = tar_file + TAR_INDEX_SUFFIX
+    if not os.path.exists(index_file) or os.path.getmtime(index_file) < os.path.getmtime(tar_file):
+        return None
+    with open(index_file) as f:
+        return [(name, int(offset), int(size)) for name, offset, size in (line.rstrip('\n').split('\t') for line in f)]
+
+
+def generate_tar_members(tar_file):
+    """
+    generate (name, file object) pairs of the tarfile's regular file members in place, without extracting to disk.
+    If the tarfile has an index each member is read directly at its offset, otherwise members are streamed in order.
+    Each file object is only valid until the next pair is generated.
+    """
+    index = read_tar_index(tar_file)
+    if index is not None:
+        with open(tar_file, 'rb') as f:
+            for name, offset, size in index:
+                f.seek(offset)
+                yield name, io.BytesIO(f.read(size))
+    else:
+        with tarfile.open(tar_file) as tar:
+            for member in tar:
+                if member.isfile():
+                    yield member.name, tar.extractfile(member)
+
+
+def file_checksum(path, block_size: int = 1 << 20) -> str:
+    """
+    sha256 hex digest of a file's contents
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while block := f.read(block_size):
+            digest.update(block)
+    return digest.hexdigest()
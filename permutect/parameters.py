@@ -1,6 +1,8 @@
 from typing import List
 
 from permutect import constants
+from permutect.misc_utils import DEFAULT_DISTRIBUTED_TIMEOUT_HOURS
+from permutect.utils.enums import Precision
 
 
 class ModelParameters:
@@ -83,7 +85,8 @@ def add_model_params_to_parser(parser):
 class TrainingParameters:
     def __init__(self, batch_size: int, num_epochs: int, learning_rate: float = 0.001,
                  weight_decay: float = 0.01, num_workers: int = 0, num_calibration_epochs: int = 0,
-                 inference_batch_size: int = 8192):
+                 inference_batch_size: int = 8192, shuffle_block_size: int = 0, shuffle_window_size: int = 0,
+                 precision: Precision = Precision.FP32, read_budget: int = 0, bucket_by_read_count: bool = False):
         self.batch_size = batch_size
         self.num_epochs = num_epochs
         self.learning_rate = learning_rate
@@ -91,6 +94,11 @@ class TrainingParameters:
         self.num_workers = num_workers
         self.num_calibration_epochs = num_calibration_epochs
         self.inference_batch_size = inference_batch_size
+        self.shuffle_block_size = shuffle_block_size
+        self.shuffle_window_size = shuffle_window_size
+        self.precision = precision
+        self.read_budget = read_budget
+        self.bucket_by_read_count = bucket_by_read_count
 
 
 def parse_training_params(args) -> TrainingParameters:
@@ -101,7 +109,13 @@ def parse_training_params(args) -> TrainingParameters:
     num_calibration_epochs = getattr(args, constants.NUM_CALIBRATION_EPOCHS_NAME)
     num_workers = getattr(args, constants.NUM_WORKERS_NAME)
     inference_batch_size = getattr(args, constants.INFERENCE_BATCH_SIZE_NAME)
-    return TrainingParameters(batch_size, num_epochs, learning_rate, weight_decay, num_workers, num_calibration_epochs, inference_batch_size)
+    shuffle_block_size = getattr(args, constants.SHUFFLE_BLOCK_SIZE_NAME)
+    shuffle_window_size = getattr(args, constants.SHUFFLE_WINDOW_SIZE_NAME)
+    precision = Precision(getattr(args, constants.PRECISION_NAME))
+    read_budget = getattr(args, constants.READ_BUDGET_NAME)
+    bucket_by_read_count = getattr(args, constants.BUCKET_BY_READ_COUNT_NAME)
+    return TrainingParameters(batch_size, num_epochs, learning_rate, weight_decay, num_workers, num_calibration_epochs,
+                              inference_batch_size, shuffle_block_size, shuffle_window_size, precision, read_budget, bucket_by_read_count)
 
 
 def add_training_params_to_parser(parser):
@@ -120,3 +134,30 @@ def add_training_params_to_parser(parser):
                         help='number of calibration-only epochs')
     parser.add_argument('--' + constants.INFERENCE_BATCH_SIZE_NAME, type=int, default=8192, required=False,
                         help='batch size when performing model inference (not training)')
+    parser.add_argument('--' + constants.SHUFFLE_BLOCK_SIZE_NAME, type=int, default=0, required=False,
+                        help='if positive, shuffle the order of blocks of this many consecutive data, and shuffle data only '
+                             'within a window of blocks, so that memory-mapped datasets are read sequentially.  '
+                             '0 means fully random shuffling.')
+    parser.add_argument('--' + constants.SHUFFLE_WINDOW_SIZE_NAME, type=int, default=100000, required=False,
+                        help='number of data shuffled together when ' + constants.SHUFFLE_BLOCK_SIZE_NAME + ' is positive')
+    parser.add_argument('--' + constants.READ_BUDGET_NAME, type=int, default=0, required=False,
+                        help='if positive, form training batches of at most this many ref and alt reads in total instead of '
+                             + constants.BATCH_SIZE_NAME + ' data, so that memory and time per batch are predictable.  '
+                             'Requires fully random shuffling.')
+    parser.add_argument('--' + constants.BUCKET_BY_READ_COUNT_NAME, action='store_true',
+                        help='flag for forming read-budgeted training batches of data with similar read counts')
+    parser.add_argument('--' + constants.DATASET_MEMORY_BUDGET_NAME, type=int, default=None, required=False,
+                        help='bytes of RAM the training dataset may occupy.  Datasets that exceed it are partly or fully '
+                             'memory-mapped.  Default is 80%% of the available RAM.')
+    parser.add_argument('--' + constants.DISTRIBUTED_TIMEOUT_HOURS_NAME, type=float, default=DEFAULT_DISTRIBUTED_TIMEOUT_HOURS,
+                        required=False, help='in data-parallel training, hours that a process may wait for the others, eg '
+                                             'while the main process alone prunes a fold, before failing')
+    add_precision_to_parser(parser)
+
+
+def add_precision_to_parser(parser):
+    parser.add_argument('--' + constants.PRECISION_NAME, type=str, default=Precision.FP32.value, required=False,
+                        choices=[precision.value for precision in Precision],
+                        help='precision of the artifact model feature computation.  bf16 and fp16 use mixed precision, '
+                             'with feature clustering and calibration kept in fp32.  fp16 requires a GPU, while bf16 '
+                             'also speeds up CPUs with native bf16 support.')
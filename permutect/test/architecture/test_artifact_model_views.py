@@ -0,0 +1,74 @@
+import tempfile
+
+import pytest
+import torch
+
+from permutect.architecture.artifact_model import ArtifactModel
+from permutect.data import plain_text_data
+from permutect.data.reads_batch import ReadsBatch, DownsampledReadsBatch
+from permutect.parameters import ModelParameters
+from permutect.test.test_utils.artificial_data import write_random_plain_text_dataset
+from permutect.training.balancer import Balancer
+from permutect.utils.enums import Precision
+
+REF_SEQ_LAYER_STRINGS = ['convolution/kernel_size=3/out_channels=8', 'leaky_relu', 'flatten', 'linear/out_features=6']
+
+
+def make_small_model_and_batch(num_data: int = 20):
+    torch.manual_seed(0)
+    with tempfile.NamedTemporaryFile(suffix='.dataset') as dataset_file:
+        write_random_plain_text_dataset(dataset_file.name, num_data=num_data)
+        data = list(plain_text_data.read_data(dataset_file.name))
+
+    params = ModelParameters(read_layers=[10, 10], self_attention_hidden_dimension=12, num_self_attention_layers=2,
+        info_layers=[10], aggregation_layers=[8], num_artifact_clusters=2, calibration_layers=[4],
+        ref_seq_layers_strings=REF_SEQ_LAYER_STRINGS, dropout_p=0.1, reweighting_range=0.3)
+    model = ArtifactModel(params, num_read_features=data[0].get_ref_reads_re().shape[1],
+        num_info_features=len(data[0].get_info_1d()), haplotypes_length=len(data[0].get_haplotypes_1d()), device=torch.device('cpu'))
+    return model, ReadsBatch(data).copy_to(torch.device('cpu'), model._dtype)
+
+
+def test_fused_views_match_separate_forward_passes():
+    model, parent_batch = make_small_model_and_batch()
+    model.eval()    # dropout masks are shared between views in the fused pass
+
+    half_b = torch.full((parent_batch.size(), ), 0.5)
+    downsampled_batches = [DownsampledReadsBatch(parent_batch, ref_fracs_b=half_b, alt_fracs_b=half_b) for _ in range(2)]
+
+    separate_balancer, fused_balancer = Balancer(num_sources=1, device=torch.device('cpu')), Balancer(num_sources=1, device=torch.device('cpu'))
+    with torch.no_grad():
+        separate_outputs = [model.compute_batch_output(batch, separate_balancer) for batch in downsampled_batches]
+        separate_outputs = [model.compute_batch_output(parent_batch, separate_balancer)] + separate_outputs
+        fused_outputs = model.compute_batch_outputs_of_views(parent_batch, downsampled_batches, fused_balancer)
+
+    assert len(fused_outputs) == 3
+    for separate, fused in zip(separate_outputs, fused_outputs):
+        assert torch.allclose(separate.features_be, fused.features_be, atol=1e-5)
+        assert torch.allclose(separate.calibrated_logits_b, fused.calibrated_logits_b, atol=1e-4)
+        assert torch.allclose(separate.uncalibrated_logits_b, fused.uncalibrated_logits_b, atol=1e-4)
+        assert torch.equal(separate.weights, fused.weights)
+
+
+def test_bf16_mixed_precision():
+    model, batch = make_small_model_and_batch()
+    model.eval()
+    with torch.no_grad():
+        logits_b, _, _, features_be = model.calculate_logits(batch)
+
+    model.set_precision(Precision.BF16)
+    with torch.no_grad():
+        bf16_logits_b, _, _, bf16_features_be = model.calculate_logits(batch)
+    assert bf16_features_be.dtype == torch.float32 and bf16_logits_b.dtype == torch.float32
+    assert torch.norm(bf16_features_be - features_be) < 0.02 * torch.norm(features_be)
+    assert torch.norm(bf16_logits_b - logits_b) < 0.02 * torch.norm(logits_b)
+
+    # gradients reach the full-precision parameters
+    model.train()
+    bf16_logits_b, _, _, _ = model.calculate_logits(batch)
+    torch.sum(bf16_logits_b).backward()
+    gradient = model.read_embedding.parameters().__next__().grad
+    assert gradient.dtype == torch.float32 and torch.all(torch.isfinite(gradient))
+
+    model.set_precision(Precision.FP16)
+    with pytest.raises(Exception):
+        model.calculate_logits(batch)    # fp16 requires a GPU
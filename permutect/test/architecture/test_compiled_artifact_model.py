@@ -0,0 +1,26 @@
+import tempfile
+
+import torch
+
+from permutect.architecture.compiled_artifact_model import compile_artifact_model, save_compiled_artifact_model, \
+    is_compiled_artifact_model, CompiledArtifactModel
+from permutect.test.architecture.test_artifact_model_views import make_small_model_and_batch
+
+
+def test_compiled_model_matches_eager_model():
+    # the batch has a different shape from the examples that the graph was traced on
+    model, batch = make_small_model_and_batch(num_data=30)
+    model.eval()
+    with tempfile.NamedTemporaryFile(suffix='.pt') as compiled_file, tempfile.NamedTemporaryFile(suffix='.pt') as model_file:
+        save_compiled_artifact_model(compile_artifact_model(model), model, compiled_file.name)
+        model.save_model(model_file.name)
+        assert is_compiled_artifact_model(compiled_file.name)
+        assert not is_compiled_artifact_model(model_file.name)
+        compiled_model = CompiledArtifactModel(compiled_file.name)
+
+    with torch.no_grad():
+        logits_b, _, _, features_be = model.calculate_logits(batch)
+        compiled_logits_b, _, _, compiled_features_be = compiled_model.calculate_logits(batch)
+    assert compiled_model.pooling_dimension() == model.pooling_dimension()
+    assert torch.allclose(logits_b, compiled_logits_b, atol=1e-4)
+    assert torch.allclose(features_be, compiled_features_be, atol=1e-4)
@@ -0,0 +1,56 @@
+import tempfile
+
+import numpy as np
+import torch
+
+from permutect.architecture.posterior_model import PosteriorModel, load_posterior_model
+from permutect.data import plain_text_data
+from permutect.data.posterior_data import PosteriorDataset, PosteriorBatch
+from permutect.test.test_utils.artificial_data import write_random_plain_text_dataset
+from permutect.utils.enums import Variation
+
+
+def make_posterior_dataset(num_data: int) -> PosteriorDataset:
+    with tempfile.NamedTemporaryFile(suffix='.dataset') as dataset_file:
+        write_random_plain_text_dataset(dataset_file.name, num_data=num_data)
+        data_be = np.vstack([datum.get_array_1d() for datum in plain_text_data.read_data(dataset_file.name)])
+    float_array_be = np.zeros((len(data_be), PosteriorBatch.NUM_FLOATS), dtype=np.float32)
+    float_array_be[:, PosteriorBatch.ALLELE_FREQUENCY] = 0.001
+    float_array_be[:, PosteriorBatch.ARTIFACT_LOGIT] = np.random.randn(len(data_be))
+    float_array_be[:, PosteriorBatch.MAF] = 0.5
+    float_array_be[:, PosteriorBatch.NORMAL_MAF] = 0.5
+    return PosteriorDataset(data_be, float_array_be, torch.zeros(len(data_be), 3))
+
+
+def test_full_batch_spectra_fitting_reduces_loss_and_converges():
+    dataset = make_posterior_dataset(300)
+    model = PosteriorModel(-10.0, -10.0, num_base_features=3, device=torch.device('cpu'))
+
+    def total_loss():
+        with torch.no_grad():
+            batch = dataset.get_batch(0, len(dataset)).copy_to(torch.device('cpu'), torch.float32)
+            log_evidence = torch.logsumexp(model.log_relative_posteriors_bc(batch), dim=1)
+            return (-torch.mean(log_evidence) + model.missing_sites_loss(10.0)).item()
+
+    initial_loss = total_loss()
+    # small chunks so that gradients are accumulated over several of them; a loose tolerance so that it stops early
+    model.learn_priors_and_spectra_full_batch(dataset, max_iterations=500, ignored_to_non_ignored_ratio=10.0,
+                                              learning_rate=0.01, chunk_size=64, tolerance=0.01, patience=2)
+    assert total_loss() < initial_loss
+
+
+def test_save_and_load_posterior_model():
+    dataset = make_posterior_dataset(100)
+    model = PosteriorModel(-10.0, -10.0, num_base_features=3, no_germline_mode=True, device=torch.device('cpu'), het_beta=5.0)
+    model.learn_priors_and_spectra_full_batch(dataset, max_iterations=3, ignored_to_non_ignored_ratio=10.0)
+    thresholds = {var_type: 0.1 * var_type for var_type in Variation}
+
+    with tempfile.NamedTemporaryFile() as model_file:
+        model.save_model(model_file.name, thresholds, germline_mode=False)
+        loaded_model, loaded_thresholds, germline_mode = load_posterior_model(model_file.name, device=torch.device('cpu'))
+
+    assert loaded_thresholds == thresholds and not germline_mode
+    assert loaded_model.no_germline_mode and loaded_model.het_beta == 5.0
+    batch = dataset.get_batch(0, len(dataset)).copy_to(torch.device('cpu'), torch.float32)
+    with torch.no_grad():
+        assert torch.equal(loaded_model.log_relative_posteriors_bc(batch), model.log_relative_posteriors_bc(batch))
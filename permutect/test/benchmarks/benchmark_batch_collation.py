@@ -0,0 +1,46 @@
+"""
+Throughput benchmark of batched gathering from a memory-mapped dataset against per-datum collation.
+
+Usage: python -m permutect.test.benchmarks.benchmark_batch_collation [num_data] [batch_size]
+"""
+import random
+import sys
+import tempfile
+import time
+
+from permutect.data import plain_text_data
+from permutect.data.memory_mapped_data import MemoryMappedDataWriter
+from permutect.data.reads_batch import ReadsBatch
+from permutect.data.reads_dataset import ReadsDataset, chunk
+from permutect.test.test_utils.artificial_data import write_random_plain_text_dataset
+
+
+def time_batches(collate, batches) -> float:
+    start = time.perf_counter()
+    num_reads = sum(len(collate(batch).get_reads_re()) for batch in batches)
+    return num_reads, time.perf_counter() - start
+
+
+def main(num_data: int = 20000, batch_size: int = 64):
+    with tempfile.NamedTemporaryFile(suffix='.dataset') as dataset_file, tempfile.NamedTemporaryFile(suffix='.tar') as dataset_tar:
+        write_random_plain_text_dataset(dataset_file.name, num_data=num_data)
+        with MemoryMappedDataWriter(dataset_tar.name) as writer:
+            writer.write(list(plain_text_data.read_data(dataset_file.name)))
+
+        for budget, mode in [(None, "in RAM"), (0, "memory-mapped")]:
+            dataset = ReadsDataset(data_tarfile=dataset_tar.name, memory_budget=budget)
+            indices = list(range(len(dataset)))
+            random.shuffle(indices)
+            batches = chunk(indices, batch_size)
+
+            results = {}
+            for name, collate in [("per datum", lambda batch: ReadsBatch([dataset[n] for n in batch])),
+                                  ("gathered", dataset.__getitems__)]:
+                num_reads, elapsed = time_batches(collate, batches)
+                results[name] = elapsed
+                print(f"{mode}, {name}: {len(batches)} batches, {num_reads} reads in {elapsed:.2f} s, {len(batches) / elapsed:.0f} batches/s")
+            print(f"{mode} speedup: {results['per datum'] / results['gathered']:.2f}x")
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20000, int(sys.argv[2]) if len(sys.argv) > 2 else 64)
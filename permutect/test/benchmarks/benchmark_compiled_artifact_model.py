@@ -0,0 +1,61 @@
+"""
+CPU latency of artifact model inference, eager against the compiled TorchScript graph, per 10k variants.
+
+Usage: python -m permutect.test.benchmarks.benchmark_compiled_artifact_model [num_data] [batch_size]
+"""
+import sys
+import tempfile
+import time
+
+import torch
+
+from permutect.architecture.artifact_model import ArtifactModel
+from permutect.architecture.compiled_artifact_model import compile_artifact_model, save_compiled_artifact_model, CompiledArtifactModel
+from permutect.data import plain_text_data
+from permutect.data.reads_batch import ReadsBatch
+from permutect.data.reads_dataset import chunk
+from permutect.parameters import ModelParameters
+from permutect.test.test_utils.artificial_data import write_random_plain_text_dataset
+
+REF_SEQ_LAYER_STRINGS = ['convolution/kernel_size=3/out_channels=64', 'pool/kernel_size=2', 'leaky_relu',
+                         'convolution/kernel_size=3/dilation=2/out_channels=5', 'leaky_relu', 'flatten', 'linear/out_features=10']
+
+
+@torch.inference_mode()
+def time_inference(model, batches) -> float:
+    start = time.perf_counter()
+    for batch in batches:
+        model.calculate_logits(batch)
+    return time.perf_counter() - start
+
+
+def main(num_data: int = 10000, batch_size: int = 64):
+    with tempfile.NamedTemporaryFile(suffix='.dataset') as dataset_file:
+        write_random_plain_text_dataset(dataset_file.name, num_data=num_data)
+        data = list(plain_text_data.read_data(dataset_file.name))
+
+    params = ModelParameters(read_layers=[10, 10, 10], self_attention_hidden_dimension=20, num_self_attention_layers=3,
+        info_layers=[30, 30, 30], aggregation_layers=[30, 30, 30, 30], num_artifact_clusters=4, calibration_layers=[6, 6],
+        ref_seq_layers_strings=REF_SEQ_LAYER_STRINGS, dropout_p=0.0, reweighting_range=0.3)
+    device = torch.device('cpu')
+    model = ArtifactModel(params, num_read_features=data[0].get_ref_reads_re().shape[1],
+        num_info_features=len(data[0].get_info_1d()), haplotypes_length=len(data[0].get_haplotypes_1d()), device=device)
+    model.eval()
+
+    with tempfile.NamedTemporaryFile(suffix='.pt') as compiled_file:
+        save_compiled_artifact_model(compile_artifact_model(model), model, compiled_file.name)
+        compiled_model = CompiledArtifactModel(compiled_file.name)
+
+    batches = [ReadsBatch([data[n] for n in indices]) for indices in chunk(list(range(len(data))), batch_size)]
+    time_inference(compiled_model, batches[:10])    # warm up the TorchScript profiling executor
+
+    results = {}
+    for name, inference_model in [("eager", model), ("compiled", compiled_model)]:
+        elapsed = time_inference(inference_model, batches)
+        results[name] = elapsed
+        print(f"{name}: {len(data)} variants in {elapsed:.2f} s, {elapsed * 10000 / len(data):.2f} s per 10k variants")
+    print(f"speedup: {results['eager'] / results['compiled']:.2f}x")
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10000, int(sys.argv[2]) if len(sys.argv) > 2 else 64)
@@ -0,0 +1,93 @@
+"""
+Microbenchmark of the vectorized normalization core against the previous per-element and per-datum implementations
+on a synthetic chunk of data.  The default chunk size of 2 GB needs a machine with plenty of RAM.
+
+Usage: python -m permutect.test.benchmarks.benchmark_normalization [gigabytes]
+"""
+import sys
+import time
+
+import numpy as np
+from sklearn.preprocessing import QuantileTransformer
+
+from permutect.data import plain_text_data
+from permutect.data.datum import Datum
+from permutect.data.reads_datum import ReadsDatum
+
+NUM_READ_FEATURES = 11
+NUM_INFO_FEATURES = 9
+HAPLOTYPES_LENGTH = 42
+
+
+def make_synthetic_chunk(gigabytes: float):
+    """
+    list of ReadsDatum with random reads, about half of whose columns are binary
+    """
+    buffer, total_bytes = [], 0
+    datum_length = Datum.HAPLOTYPES_START_IDX + HAPLOTYPES_LENGTH + NUM_INFO_FEATURES
+    while total_bytes < gigabytes * 1e9:
+        ref_counts, alt_counts = np.random.randint(0, 11, size=10000), np.random.randint(1, 16, size=10000)
+        all_reads = np.random.randn(np.sum(ref_counts + alt_counts), NUM_READ_FEATURES).astype(np.float16)
+        all_reads[:, ::2] = all_reads[:, ::2] > 0
+        read_ends = np.cumsum(ref_counts + alt_counts)
+        for ref_count, alt_count, read_end in zip(ref_counts, alt_counts, read_ends):
+            datum_array = np.zeros(datum_length, dtype=np.int64)
+            datum_array[Datum.REF_COUNT_IDX], datum_array[Datum.ALT_COUNT_IDX] = ref_count, alt_count
+            datum_array[Datum.HAPLOTYPES_LENGTH_IDX], datum_array[Datum.INFO_LENGTH_IDX] = HAPLOTYPES_LENGTH, NUM_INFO_FEATURES
+            datum_array[-NUM_INFO_FEATURES:] = np.random.randint(0, 10 * Datum.FLOAT_TO_LONG_MULTIPLIER, size=NUM_INFO_FEATURES)
+            datum = ReadsDatum(datum_array, all_reads[read_end - ref_count - alt_count:read_end])
+            buffer.append(datum)
+            total_bytes += datum.size_in_bytes()
+    return buffer
+
+
+# the previous implementations, for comparison
+def legacy_is_binary(column_tensor_1d: np.ndarray):
+    return all(el.item() == 0 or el.item() == 1 for el in column_tensor_1d)
+
+
+def legacy_binary_column_indices(tensor_2d: np.ndarray):
+    return [n for n in range(tensor_2d.shape[1]) if legacy_is_binary(tensor_2d[:, n])]
+
+
+def legacy_alt_means_and_medians(buffer):
+    alt_means = [np.mean(datum.get_alt_reads_re(), axis=0) for datum in buffer]
+    alt_medians = [np.median(datum.get_alt_reads_re(), axis=0) for datum in buffer]
+    return np.vstack(alt_means), np.vstack(alt_medians)
+
+
+def timed(label: str, func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    print(f"{label}: {time.perf_counter() - start:.2f} s")
+    return result
+
+
+def main(gigabytes: float = 2.0):
+    buffer = make_synthetic_chunk(gigabytes)
+    all_reads = np.vstack([datum.reads_re for datum in buffer])
+    print(f"Synthetic chunk of {len(buffer)} data and {len(all_reads)} reads")
+
+    # the legacy binary check is far too slow to run on the whole chunk, so time a sample and extrapolate
+    sample_rows = min(len(all_reads), 1000000)
+    legacy_elapsed = time.perf_counter()
+    legacy_columns = legacy_binary_column_indices(all_reads[:sample_rows])
+    legacy_elapsed = (time.perf_counter() - legacy_elapsed) * len(all_reads) / sample_rows
+    print(f"legacy binary columns (extrapolated from {sample_rows} reads): {legacy_elapsed:.2f} s")
+    columns = timed("vectorized binary columns", plain_text_data.binary_column_indices, all_reads)
+    assert columns == legacy_columns
+
+    legacy_means, legacy_medians = timed("legacy per-datum alt means and medians", legacy_alt_means_and_medians, buffer)
+    read_ends = np.cumsum([len(datum.reads_re) for datum in buffer])
+    alt_counts = np.array([datum.get_alt_count() for datum in buffer])
+    means, medians = timed("segment-reduction alt means and medians", plain_text_data.alt_means_and_medians,
+                           all_reads, read_ends, alt_counts)
+    assert np.allclose(means, legacy_means, atol=1e-2) and np.allclose(medians, legacy_medians)
+
+    read_qt = QuantileTransformer(n_quantiles=100, output_distribution='normal')
+    info_qt = QuantileTransformer(n_quantiles=100, output_distribution='normal')
+    timed("normalize_buffer", plain_text_data.normalize_buffer, buffer, read_qt, info_qt)
+
+
+if __name__ == '__main__':
+    main(float(sys.argv[1]) if len(sys.argv) > 1 else 2.0)
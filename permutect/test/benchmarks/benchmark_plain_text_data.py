@@ -0,0 +1,38 @@
+"""
+Throughput benchmark of the block-oriented plain text parser against the line-by-line parser.
+
+Usage: python -m permutect.test.benchmarks.benchmark_plain_text_data [num_data]
+"""
+import os
+import sys
+import tempfile
+import time
+
+from permutect.data import plain_text_data
+from permutect.test.test_utils.artificial_data import write_random_plain_text_dataset
+
+
+def time_parser(parser, dataset_file) -> float:
+    start = time.perf_counter()
+    count = sum(1 for _ in parser(dataset_file))
+    elapsed = time.perf_counter() - start
+    return count, elapsed
+
+
+def main(num_data: int = 20000):
+    with tempfile.NamedTemporaryFile(suffix='.dataset') as dataset_file:
+        write_random_plain_text_dataset(dataset_file.name, num_data=num_data)
+        megabytes = os.path.getsize(dataset_file.name) / 1e6
+        print(f"Synthetic dataset: {num_data} records, {megabytes:.1f} MB")
+
+        results = {}
+        for name, parser in [("line by line", plain_text_data.read_data_line_by_line), ("block", plain_text_data.read_data)]:
+            count, elapsed = time_parser(parser, dataset_file.name)
+            results[name] = elapsed
+            print(f"{name} parser: {count} data in {elapsed:.2f} s, {count / elapsed:.0f} data/s, {megabytes / elapsed:.1f} MB/s")
+
+        print(f"speedup: {results['line by line'] / results['block']:.2f}x")
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20000)
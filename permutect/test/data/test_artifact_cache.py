@@ -0,0 +1,53 @@
+import os
+import tempfile
+
+import numpy as np
+import torch
+
+from permutect.data.artifact_cache import artifact_cache_file, cache_artifact_model_outputs, generate_cached_artifact_model_outputs, \
+    cached_feature_dimension
+from permutect.data.datum import Datum
+
+
+def test_artifact_cache_round_trip():
+    num_data = 10
+    batches = [(np.arange(n * (Datum.NUM_SCALAR_ELEMENTS + 3), (n + 1) * (Datum.NUM_SCALAR_ELEMENTS + 3)).reshape(1, -1).repeat(2, axis=0),
+                np.array([n, -n], dtype=np.float32), torch.full((2, 4), float(n))) for n in range(num_data // 2)]
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        cache_file = os.path.join(cache_dir, "cache")
+        # the cache is only written once the outputs are exhausted
+        passed_through = cache_artifact_model_outputs(iter(batches), cache_file, feature_dimension=4)
+        assert next(passed_through) is not None and not os.path.exists(cache_file)
+        assert len(list(passed_through)) == len(batches) - 1 and os.path.exists(cache_file)
+
+        cached = list(generate_cached_artifact_model_outputs(cache_file, batch_size=4))
+        assert cached_feature_dimension(cache_file) == 4
+
+        # outputs of an empty dataset are cached with their feature dimension
+        empty_cache_file = os.path.join(cache_dir, "empty_cache")
+        assert len(list(cache_artifact_model_outputs(iter([]), empty_cache_file, feature_dimension=7))) == 0
+        assert len(list(generate_cached_artifact_model_outputs(empty_cache_file, batch_size=4))) == 0
+        assert cached_feature_dimension(empty_cache_file) == 7
+
+    assert [len(logits) for _, logits, _ in cached] == [4, 4, 2]
+    data_be = np.vstack([data for data, _, _ in cached])
+    assert np.array_equal(data_be, np.vstack([data[:, :Datum.NUM_SCALAR_ELEMENTS] for data, _, _ in batches]))
+    assert np.array_equal(np.concatenate([logits for _, logits, _ in cached]), np.concatenate([logits for _, logits, _ in batches]))
+    assert torch.equal(torch.vstack([features for _, _, features in cached]).float(), torch.vstack([features for _, _, features in batches]))
+
+
+def test_artifact_cache_file_depends_on_contents():
+    with tempfile.NamedTemporaryFile() as dataset, tempfile.NamedTemporaryFile() as model:
+        dataset.write(b"dataset")
+        dataset.flush()
+        model.write(b"model")
+        model.flush()
+        cache_file = artifact_cache_file("cache", dataset.name, model.name, chunk_size=100)
+        assert cache_file == artifact_cache_file("cache", dataset.name, model.name, chunk_size=100)
+        assert cache_file != artifact_cache_file("cache", dataset.name, model.name, chunk_size=200)
+        assert cache_file != artifact_cache_file("cache", model.name, dataset.name, chunk_size=100)
+
+        model.write(b" retrained")
+        model.flush()
+        assert cache_file != artifact_cache_file("cache", dataset.name, model.name, chunk_size=100)
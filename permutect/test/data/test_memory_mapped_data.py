@@ -0,0 +1,223 @@
+import os
+import tarfile
+import tempfile
+
+import numpy as np
+import torch
+
+from permutect.data import plain_text_data
+from permutect.data.batch import BatchIndexedTensor
+from permutect.data.count_binning import MAX_REF_COUNT, MAX_ALT_COUNT
+from permutect.data.memory_mapped_data import MemoryMappedData, MemoryMappedDataWriter, is_memory_mapped_dataset
+from permutect.data.reads_batch import ReadsBatch
+from permutect.data.reads_dataset import ReadsDataset, MemoryMode, BlockShuffleBatchSampler, SemiSupervisedBatchSampler, \
+    ReadBudgetBatchSampler, DistributedSemiSupervisedBatchSampler, pack_into_budget
+from permutect.test.test_utils.artificial_data import write_random_plain_text_dataset
+from permutect.utils.enums import Label
+
+
+def test_memory_mapped_data_roundtrip():
+    with tempfile.NamedTemporaryFile(suffix='.dataset') as dataset_file, tempfile.NamedTemporaryFile(suffix='.tar') as output_tar, \
+            tempfile.TemporaryDirectory() as temp_dir:
+        # small counts so that no reads are downsampled when written
+        write_random_plain_text_dataset(dataset_file.name, num_data=300, max_ref_count=MAX_REF_COUNT, max_alt_count=MAX_ALT_COUNT)
+        original_data = list(plain_text_data.read_data(dataset_file.name))
+
+        extra_file = os.path.join(temp_dir, 'extra.txt')
+        with open(extra_file, 'w') as f:
+            f.write("extra")
+
+        with MemoryMappedDataWriter(output_tar.name) as writer:
+            for n in range(0, len(original_data), 70):
+                writer.write(original_data[n:n + 70])
+            writer.add_file(extra_file, arcname='extra.txt')
+
+        assert is_memory_mapped_dataset(output_tar.name)
+        with tarfile.open(output_tar.name) as tar:
+            assert 'extra.txt' in tar.getnames()
+
+        data = MemoryMappedData(output_tar.name)
+        assert len(data) == len(original_data)
+        assert isinstance(data.reads_re, np.memmap)
+        for n, original_datum in enumerate(original_data):
+            datum = data.get_reads_datum(n)
+            assert np.array_equal(datum.get_array_1d(), original_datum.get_array_1d())
+            assert np.array_equal(datum.reads_re, original_datum.reads_re)
+
+        dataset = ReadsDataset(data_tarfile=output_tar.name, num_folds=3)
+        assert len(dataset) == len(original_data)
+        assert dataset.num_read_features == original_data[0].reads_re.shape[1]
+        assert np.array_equal(dataset[5].get_array_1d(), original_data[5].get_array_1d())
+
+
+def test_writer_downsamples_reads():
+    with tempfile.NamedTemporaryFile(suffix='.dataset') as dataset_file, tempfile.NamedTemporaryFile(suffix='.tar') as output_tar:
+        write_random_plain_text_dataset(dataset_file.name, num_data=100, max_ref_count=50, max_alt_count=50)
+        with MemoryMappedDataWriter(output_tar.name) as writer:
+            writer.write(list(plain_text_data.read_data(dataset_file.name)))
+
+        dataset = ReadsDataset(data_tarfile=output_tar.name)
+        for datum in dataset:
+            assert datum.get_ref_count() <= MAX_REF_COUNT and datum.get_alt_count() <= MAX_ALT_COUNT
+            assert len(datum.reads_re) == datum.get_ref_count() + datum.get_alt_count()
+
+
+def test_memory_budget_modes():
+    with tempfile.NamedTemporaryFile(suffix='.dataset') as dataset_file, tempfile.NamedTemporaryFile(suffix='.tar') as output_tar:
+        write_random_plain_text_dataset(dataset_file.name, num_data=100, max_ref_count=MAX_REF_COUNT, max_alt_count=MAX_ALT_COUNT)
+        original_data = list(plain_text_data.read_data(dataset_file.name))
+        with MemoryMappedDataWriter(output_tar.name) as writer:
+            writer.write(original_data)
+
+        data = MemoryMappedData(output_tar.name)
+        assert data.reads_size_in_bytes() == data.reads_re.nbytes
+        assert data.data_size_in_bytes() == data.data_be.nbytes + data.read_offsets.nbytes + data.metadata.nbytes
+
+        budgets_and_modes = [(data.reads_size_in_bytes() + data.data_size_in_bytes(), MemoryMode.RAM),
+                             (data.data_size_in_bytes(), MemoryMode.HYBRID), (0, MemoryMode.MMAP)]
+        for budget, mode in budgets_and_modes:
+            dataset = ReadsDataset(data_tarfile=output_tar.name, memory_budget=budget)
+            assert dataset.memory_mode == mode
+            assert isinstance(dataset._memory_mapped_data.reads_re, np.memmap) == (mode != MemoryMode.RAM)
+            assert isinstance(dataset._memory_mapped_data.data_be, np.memmap) == (mode == MemoryMode.MMAP)
+            assert np.array_equal(dataset[7].reads_re, original_data[7].reads_re)
+
+
+def test_gathered_batch_matches_collated_batch():
+    with tempfile.NamedTemporaryFile(suffix='.dataset') as dataset_file, tempfile.NamedTemporaryFile(suffix='.tar') as output_tar:
+        write_random_plain_text_dataset(dataset_file.name, num_data=200)
+        with MemoryMappedDataWriter(output_tar.name) as writer:
+            writer.write(list(plain_text_data.read_data(dataset_file.name)))
+
+        for budget in [0, None]:
+            dataset = ReadsDataset(data_tarfile=output_tar.name, memory_budget=budget)
+            indices = [17, 3, 150, 3, 99, 0]
+            gathered = dataset.__getitems__(indices)
+            assert isinstance(gathered, ReadsBatch)
+            expected = ReadsBatch([dataset[index] for index in indices])
+            assert torch.equal(gathered.data, expected.data)
+            assert torch.equal(gathered.get_reads_re(), expected.get_reads_re())
+            assert torch.equal(gathered.get_info_be(), expected.get_info_be())
+
+            loader = dataset.make_data_loader(dataset.all_folds(), batch_size=32)
+            assert sum(batch.size() for batch in loader) == len(dataset)
+
+
+def test_block_shuffle_batch_sampler():
+    with tempfile.NamedTemporaryFile(suffix='.dataset') as dataset_file, tempfile.NamedTemporaryFile(suffix='.tar') as output_tar:
+        write_random_plain_text_dataset(dataset_file.name, num_data=500, max_ref_count=5, max_alt_count=5)
+        with MemoryMappedDataWriter(output_tar.name) as writer:
+            writer.write(list(plain_text_data.read_data(dataset_file.name)))
+        dataset = ReadsDataset(data_tarfile=output_tar.name, num_folds=2, memory_budget=0)
+
+        sampler = BlockShuffleBatchSampler(dataset, batch_size=16, folds_to_use=[0], block_size=20, window_size=50)
+        assert sampler.blocks_per_window == 3
+        batches = list(sampler)
+        assert len(batches) == len(sampler)
+        sampled = [idx for batch in batches for idx in batch]
+        assert np.array_equal(np.sort(sampled), dataset.indices_by_fold[0])
+
+        # walking through the sampled indices, each window covers at most 3 blocks completely before the next begins
+        block_of_index = {idx: n // 20 for n, idx in enumerate(dataset.indices_by_fold[0])}
+        block_sizes = np.bincount(list(block_of_index.values()))
+        window_counts = {}
+        for idx in sampled:
+            block = block_of_index[idx]
+            window_counts[block] = window_counts.get(block, 0) + 1
+            assert len(window_counts) <= 3
+            if len(window_counts) == 3 and all(count == block_sizes[b] for b, count in window_counts.items()):
+                window_counts = {}
+
+        loader = dataset.make_data_loader([0, 1], batch_size=16, shuffle_block_size=20, shuffle_window_size=50)
+        assert sum(batch.size() for batch in loader) == len(dataset)
+
+        # fetches are counted in bytes of datum arrays and float16 reads, including fetches in data loader workers
+        datum_bytes = dataset[0].get_array_1d().nbytes
+        total_bytes = sum(datum_bytes + dataset[n].get_reads_re().shape[0] * dataset.num_read_features * 2 for n in range(len(dataset)))
+        dataset.fetch_seconds_and_bytes.zero_()
+        for _ in dataset.make_data_loader([0, 1], batch_size=16, num_workers=2):
+            pass
+        assert dataset.fetch_seconds_and_bytes[1].item() == total_bytes
+
+
+def test_read_budget_batch_sampler():
+    with tempfile.NamedTemporaryFile(suffix='.dataset') as dataset_file:
+        write_random_plain_text_dataset(dataset_file.name, num_data=500, max_ref_count=20, max_alt_count=20)
+        dataset = ReadsDataset(data_in_ram=list(plain_text_data.read_data(dataset_file.name)), num_folds=2)
+    read_counts = dataset.metadata['ref_count'].astype(int) + dataset.metadata['alt_count'].astype(int)
+    budget = 100
+
+    for bucket_by_read_count in [False, True]:
+        sampler = ReadBudgetBatchSampler(dataset, read_budget=budget, folds_to_use=[0], bucket_by_read_count=bucket_by_read_count)
+        batches = list(sampler)
+        sampled = [idx for batch in batches for idx in batch]
+        assert np.array_equal(np.sort(sampled), dataset.indices_by_fold[0])
+        batch_reads = [np.sum(read_counts[batch]) for batch in batches]
+        assert all(reads <= budget or len(batch) == 1 for batch, reads in zip(batches, batch_reads))
+        if bucket_by_read_count:
+            assert len(batches) == len(sampler)
+        else:
+            assert abs(len(batches) - len(sampler)) <= 0.2 * len(sampler)
+
+        if bucket_by_read_count:
+            # batches are sorted ranges of read counts, so their spans don't overlap
+            spans = sorted((np.min(read_counts[batch]), np.max(read_counts[batch])) for batch in batches)
+            assert all(previous[1] <= current[0] for previous, current in zip(spans[:-1], spans[1:]))
+
+    loader = dataset.make_data_loader([0, 1], batch_size=16, read_budget=budget, bucket_by_read_count=True)
+    assert sum(batch.size() for batch in loader) == len(dataset)
+
+    # packing is greedy: no batch has room for the first datum of the next
+    sizes = np.array([30, 50, 20, 120, 10, 90, 5, 0, 100, 1])
+    batches = pack_into_budget(np.arange(len(sizes)), sizes, budget)
+    assert [batch.tolist() for batch in batches] == [[0, 1, 2], [3], [4, 5], [6, 7], [8], [9]]
+
+
+def test_distributed_batch_sampler():
+    with tempfile.NamedTemporaryFile(suffix='.dataset') as dataset_file:
+        write_random_plain_text_dataset(dataset_file.name, num_data=250)
+        dataset = ReadsDataset(data_in_ram=list(plain_text_data.read_data(dataset_file.name)), num_folds=2)
+    fold_size = len(dataset.indices_by_fold[0])
+
+    world_size, batch_size = 3, 16
+    samplers = [DistributedSemiSupervisedBatchSampler(dataset, batch_size, folds_to_use=[0], rank=rank, world_size=world_size)
+                for rank in range(world_size)]
+    for epoch in range(2):
+        batches_by_rank = [list(sampler) for sampler in samplers]
+        assert all(len(batches) == len(samplers[0]) for batches in batches_by_rank)
+
+        # at each step the shards are disjoint, non-empty, and together make a batch of the full batch size
+        combined_batches = [np.concatenate(shards) for shards in zip(*batches_by_rank)]
+        assert all(min(len(shard) for shard in shards) > 0 for shards in zip(*batches_by_rank))
+        assert sum(len(batch) != batch_size for batch in combined_batches) <= 1
+        sampled = np.concatenate(combined_batches)
+        assert len(np.unique(sampled)) == len(sampled)
+        assert set(sampled.tolist()) <= set(dataset.indices_by_fold[0].tolist())
+        assert fold_size - len(sampled) < world_size    # only a final batch smaller than the number of processes is dropped
+
+    # the order changes between epochs
+    assert not np.array_equal(np.concatenate(list(samplers[0])), np.concatenate(list(samplers[0])))
+
+
+def test_metadata_and_totals_match_data():
+    with tempfile.NamedTemporaryFile(suffix='.dataset') as dataset_file, tempfile.NamedTemporaryFile(suffix='.tar') as output_tar:
+        write_random_plain_text_dataset(dataset_file.name, num_data=300)
+        original_data = list(plain_text_data.read_data(dataset_file.name, source=1))
+        with MemoryMappedDataWriter(output_tar.name) as writer:
+            writer.write(original_data)
+
+        memory_mapped_dataset = ReadsDataset(data_tarfile=output_tar.name, num_folds=3, memory_budget=0)
+        in_ram_dataset = ReadsDataset(data_in_ram=list(memory_mapped_dataset), num_folds=3)
+        for dataset in [memory_mapped_dataset, in_ram_dataset]:
+            expected_totals = BatchIndexedTensor.make_zeros(num_sources=1, device=torch.device('cpu'))
+            for n, datum in enumerate(dataset):
+                expected_totals.record_datum(datum)
+                assert dataset.metadata['label'][n] == datum.get_label()
+                assert dataset.metadata['position'][n] == datum.get_position()
+                assert n in dataset.indices_by_fold[n % 3]
+            assert torch.equal(dataset.totals_slvra, expected_totals)
+            assert dataset.num_sources() == 2
+
+            sampler = SemiSupervisedBatchSampler(dataset, batch_size=8, folds_to_use=[0, 2], labeled_only=True)
+            expected_indices = [n for n in range(len(dataset)) if n % 3 != 1 and dataset[n].get_label() != Label.UNLABELED]
+            assert sorted(idx for batch in sampler for idx in batch) == expected_indices
@@ -0,0 +1,90 @@
+import tempfile
+
+import numpy as np
+import torch
+
+from permutect.data import plain_text_data
+from permutect.test.test_utils.artificial_data import write_random_plain_text_dataset
+from permutect.utils.allele_utils import get_str_info_array
+
+
+def test_block_parser_matches_line_by_line_parser():
+    with tempfile.NamedTemporaryFile(suffix='.dataset') as dataset_file:
+        write_random_plain_text_dataset(dataset_file.name, num_data=300, num_info_features=7)
+        # the parser appends short tandem repeat features to the GATK info
+        info_length = 7 + len(get_str_info_array("ACGTACGTACGTACGTACGTA", "A", "G"))
+
+        # small blocks force many records to straddle block boundaries
+        for block_bytes in [1000, 100000, plain_text_data.READ_BLOCK_BYTES]:
+            for only_artifacts in [False, True]:
+                torch.manual_seed(0)
+                expected = list(plain_text_data.read_data_line_by_line(dataset_file.name, only_artifacts=only_artifacts, source=1))
+                torch.manual_seed(0)
+                actual = list(plain_text_data.read_data(dataset_file.name, only_artifacts=only_artifacts, source=1, block_bytes=block_bytes))
+
+                assert len(expected) == len(actual)
+                for expected_datum, actual_datum in zip(expected, actual):
+                    assert len(actual_datum.get_info_1d()) == info_length
+                    assert np.array_equal(expected_datum.get_array_1d(), actual_datum.get_array_1d())
+                    assert expected_datum.reads_re.dtype == actual_datum.reads_re.dtype
+                    assert np.array_equal(expected_datum.reads_re, actual_datum.reads_re)
+
+
+def test_reservoir_sketch_quantiles():
+    data = np.random.randn(200000, 3)
+    sketch = plain_text_data.ReservoirSketch(capacity=20000)
+    for chunk in np.array_split(data, 37):
+        sketch.update(chunk)
+    assert sketch.num_seen == len(data)
+    assert len(sketch.sample) == 20000
+    assert np.allclose(np.quantile(sketch.sample, [0.1, 0.5, 0.9], axis=0), np.quantile(data, [0.1, 0.5, 0.9], axis=0), atol=0.05)
+
+    # merging a sketch of a shifted stream gives the quantiles of the combined stream
+    other_data = np.random.randn(100000, 3) + 10
+    other_sketch = plain_text_data.ReservoirSketch(capacity=20000)
+    other_sketch.update(other_data)
+    sketch.merge(other_sketch)
+    assert sketch.num_seen == len(data) + len(other_data)
+    combined_data = np.vstack((data, other_data))
+    assert np.allclose(np.quantile(sketch.sample, [0.1, 0.5, 0.9], axis=0), np.quantile(combined_data, [0.1, 0.5, 0.9], axis=0), atol=0.1)
+    assert abs(np.mean(sketch.sample[:, 0] > 5) - 1/3) < 0.02
+
+
+def test_two_pass_normalization_is_independent_of_chunk_size():
+    with tempfile.NamedTemporaryFile(suffix='.dataset') as dataset_file:
+        write_random_plain_text_dataset(dataset_file.name, num_data=300)
+        normalization = plain_text_data.fit_normalization([dataset_file.name], max_bytes_per_chunk=10000)
+
+        with tempfile.NamedTemporaryFile() as normalization_file:
+            normalization.save(normalization_file.name)
+            normalization = plain_text_data.Normalization.load(normalization_file.name)
+
+        def normalized_reads(chunk_size):
+            np.random.seed(0)
+            torch.manual_seed(0)
+            chunks = list(plain_text_data.generate_normalized_data([dataset_file.name], chunk_size, normalization=normalization))
+            return np.vstack([datum.reads_re for chunk in chunks for datum in chunk])
+
+        # up to random jitter of tied values, the normalization of a datum doesn't depend on the rest of its chunk
+        assert np.mean(np.isclose(normalized_reads(5000), normalized_reads(1000000), atol=0.01)) > 0.99
+
+
+def test_binary_columns():
+    tensor_2d = np.array([[0, 1, 0.5, 1], [1, 1, 0, 2], [0, 0, 1, 1]], dtype=np.float16)
+    assert plain_text_data.binary_column_indices(tensor_2d) == [0, 1]
+    assert plain_text_data.non_binary_column_indices(tensor_2d) == [2, 3]
+    assert plain_text_data.is_binary(tensor_2d[:, 0])
+    assert not plain_text_data.is_binary(tensor_2d[:, 3])
+
+
+def test_alt_means_and_medians():
+    ref_counts = np.array([3, 0, 5, 2])
+    alt_counts = np.array([2, 4, 1, 4])
+    read_ends = np.cumsum(ref_counts + alt_counts)
+    all_reads = np.random.randn(read_ends[-1], 6)
+
+    alt_means, alt_medians = plain_text_data.alt_means_and_medians(all_reads, read_ends, alt_counts)
+    for n in range(len(ref_counts)):
+        alt_reads = all_reads[read_ends[n] - alt_counts[n]:read_ends[n]]
+        assert np.allclose(alt_means[n], np.mean(alt_reads, axis=0))
+        assert np.allclose(alt_medians[n], np.median(alt_reads, axis=0))
@@ -0,0 +1,55 @@
+import tempfile
+
+import numpy as np
+import torch
+
+from permutect.data.datum import Datum
+from permutect.data.posterior_data import PosteriorDataset, PosteriorBatch
+
+
+def test_posterior_dataset_batches_are_slices():
+    num_data, datum_length = 100, Datum.HAPLOTYPES_START_IDX + 4
+    data_be = np.zeros((num_data, datum_length), dtype=np.int64)
+    data_be[:, Datum.HAPLOTYPES_LENGTH_IDX] = 4
+    data_be[:, Datum.ALT_COUNT_IDX] = np.arange(num_data)
+    float_array_be = np.zeros((num_data, PosteriorBatch.NUM_FLOATS), dtype=np.float32)
+    float_array_be[:, PosteriorBatch.ARTIFACT_LOGIT] = np.arange(num_data) / 10
+    embeddings_be = torch.arange(num_data, dtype=torch.float32).view(-1, 1).repeat(1, 3)
+
+    dataset = PosteriorDataset(data_be, float_array_be, embeddings_be, shuffle=True)
+    assert len(dataset) == num_data
+    # only the scalar datum elements are kept
+    assert dataset.data_be.shape[1] == Datum.NUM_SCALAR_ELEMENTS
+    assert dataset.size_in_bytes() == 8 * num_data * Datum.NUM_SCALAR_ELEMENTS + 2 * float_array_be.size + 2 * embeddings_be.nelement()
+
+    loader = dataset.make_data_loader(batch_size=32)
+    batches = list(loader)
+    assert len(batches) == len(loader) == 4
+    assert [batch.size() for batch in batches] == [32, 32, 32, 4]
+
+    # shuffling permutes the rows of all tensors together, and is the same every epoch
+    alt_counts = torch.cat([batch.get_alt_counts() for batch in batches])
+    assert sorted(alt_counts.tolist()) == list(range(num_data))
+    assert torch.allclose(torch.cat([batch.get_artifact_logits() for batch in batches]).float(), alt_counts / 10, atol=0.01)
+    assert torch.equal(torch.cat([batch.embeddings[:, 0] for batch in batches]).long(), alt_counts)
+    assert torch.equal(torch.cat([batch.get_alt_counts() for batch in loader]), alt_counts)
+
+    cpu_batch = batches[0].copy_to(torch.device('cpu'), dtype=torch.float32)
+    assert cpu_batch.float_tensor.dtype == torch.float32 and cpu_batch.data.dtype == torch.long
+
+
+def test_posterior_dataset_shards():
+    num_data = 10
+    data_be = np.zeros((num_data, Datum.NUM_SCALAR_ELEMENTS), dtype=np.int64)
+    data_be[:, Datum.ALT_COUNT_IDX] = np.arange(num_data)
+    float_array_be = np.zeros((num_data, PosteriorBatch.NUM_FLOATS), dtype=np.float32)
+    embeddings_be = torch.arange(num_data, dtype=torch.float32).view(-1, 1)
+
+    with tempfile.NamedTemporaryFile() as shard1, tempfile.NamedTemporaryFile() as shard2:
+        PosteriorDataset(data_be[:6], float_array_be[:6], embeddings_be[:6]).save(shard1.name)
+        PosteriorDataset(data_be[6:], float_array_be[6:], embeddings_be[6:]).save(shard2.name)
+        dataset = PosteriorDataset.load([shard1.name, shard2.name], shuffle=False)
+
+    assert len(dataset) == num_data
+    assert sorted(dataset.data_be[:, Datum.ALT_COUNT_IDX].tolist()) == list(range(num_data))
+    assert torch.equal(dataset.embeddings[:, 0].long(), dataset.data_be[:, Datum.ALT_COUNT_IDX])
@@ -0,0 +1,74 @@
+import time
+
+import pytest
+import torch
+
+from permutect.data.prefetch_generator import prefetch_generator, background_generator
+
+
+class FakeBatch:
+    def __init__(self, n: int):
+        self.values = torch.tensor([n])
+
+    def copy_to(self, device, dtype):
+        return self
+
+
+class SlowLoader:
+    def __init__(self, num_batches: int, delay: float = 0.0, fail_at: int = None):
+        self.num_batches, self.delay, self.fail_at = num_batches, delay, fail_at
+
+    def __len__(self):
+        return self.num_batches
+
+    def __iter__(self):
+        for n in range(self.num_batches):
+            time.sleep(self.delay)
+            if n == self.fail_at:
+                raise ValueError("loader failure")
+            yield FakeBatch(n)
+
+
+def test_prefetcher_yields_all_batches_in_order():
+    prefetcher = prefetch_generator(SlowLoader(20), device=torch.device('cpu'), depth=3)
+    assert len(prefetcher) == 20
+    assert [batch.values.item() for batch in prefetcher] == list(range(20))
+    assert prefetcher.num_batches == 20
+
+    # the prefetcher can be iterated again, eg for another epoch
+    assert sum(1 for _ in prefetcher) == 20
+
+
+def test_prefetcher_counts_starvation():
+    prefetcher = prefetch_generator(SlowLoader(5, delay=0.05), device=torch.device('cpu'))
+    for _ in prefetcher:
+        pass
+    assert prefetcher.num_starved > 0
+    assert 0 < prefetcher.starved_fraction() <= 1
+
+
+def test_prefetcher_reraises_loader_exceptions_and_stops_early():
+    with pytest.raises(ValueError):
+        for _ in prefetch_generator(SlowLoader(10, fail_at=4), device=torch.device('cpu')):
+            pass
+
+    prefetcher = prefetch_generator(SlowLoader(1000), device=torch.device('cpu'), depth=2)
+    for n, _ in enumerate(prefetcher):
+        if n == 3:
+            break
+    assert prefetcher.num_batches == 4
+
+
+def test_background_generator_chains_stages():
+    def double(values):
+        for value in values:
+            yield 2 * value
+
+    assert list(background_generator(double(background_generator(iter(range(100)), depth=2)), depth=3)) == list(range(0, 200, 2))
+
+    def failing():
+        yield 1
+        raise ValueError("stage failure")
+
+    with pytest.raises(ValueError):
+        list(background_generator(failing()))
@@ -168,3 +168,31 @@ def make_wide_and_narrow_gaussian_data(num_data, is_training_data=True, vaf=0.5,
                             alt_downsampling=alt_downsampling, downsample_variants_to_match_artifacts=downsample_variants_to_match_artifacts)
 
 
+def write_random_plain_text_dataset(file, num_data: int, num_read_features: int = 11, num_info_features: int = 9,
+                                    max_ref_count: int = 20, max_alt_count: int = 20, unlabeled_fraction=0.1):
+    """
+    write random data in the plain text dataset format produced by GATK, for exercising the plain text parser.
+    Read vectors include the read group in their first column.
+    """
+    with open(file, 'w') as out:
+        for n in range(num_data):
+            unlabeled = random.uniform(0, 1) < unlabeled_fraction
+            label = Label.UNLABELED if unlabeled else (Label.ARTIFACT if random.uniform(0, 1) < 0.5 else Label.VARIANT)
+            ref_allele, alt_allele = random.choice([("A", "G"), ("C", "T"), ("CA", "C"), ("T", "TG"), ("GAT", "G")])
+            ref_count, alt_count = random.randint(0, max_ref_count), random.randint(0, max_alt_count)
+            # the reference context is centered on the ref allele
+            ref_context = "".join(random.choice("ACGT") for _ in range(10)) + ref_allele + \
+                "".join(random.choice("ACGT") for _ in range(11 - len(ref_allele)))
+
+            out.write(f"{label.name}\n")
+            out.write(f"{random.randint(0, 24)}:{random.randint(1, 10000000)},{ref_allele}->{alt_allele}\n")
+            out.write(f"{ref_context}\n")
+            out.write(" ".join(f"{x:.2f}" for x in (5 * torch.rand(num_info_features)).tolist()) + "\n")
+            out.write(f"{ref_count} {alt_count} 0 0\n")
+            for _ in range(ref_count + alt_count):
+                read_group = random.randint(0, 2)
+                features = [random.randint(-50, 400) for _ in range(num_read_features)]
+                out.write(" ".join(str(x) for x in [read_group] + features) + "\n")
+            out.write(f"{ref_count + alt_count + 10} {alt_count + 2} 0 0\n")
+            out.write(f"{-100 * random.uniform(0, 1):.3f}\n")
+            out.write(f"{-random.uniform(0, 1):.3f}\n")
@@ -0,0 +1,96 @@
+from argparse import Namespace
+import os
+import tarfile
+import tempfile
+
+import numpy as np
+
+from permutect import constants
+from permutect.data import plain_text_data
+from permutect.data.count_binning import MAX_REF_COUNT, MAX_ALT_COUNT
+from permutect.data.memory_mapped_data import is_memory_mapped_dataset, MemoryMappedData
+from permutect.data.reads_dataset import ReadsDataset, make_base_data_generator_from_tarfile
+from permutect.data.reads_datum import ReadsDatum
+from permutect.misc_utils import write_tar_index, read_tar_index
+from permutect.test.test_utils.artificial_data import write_random_plain_text_dataset
+from permutect.tools import edit_dataset
+from permutect.utils.enums import Label
+
+
+def write_legacy_tarfile(data, tar_file, temp_dir, num_chunks: int):
+    with tarfile.open(tar_file, "w") as tar:
+        for n, chunk in enumerate(np.array_split(np.arange(len(data)), num_chunks)):
+            chunk_file = os.path.join(temp_dir, f"chunk{n}")
+            ReadsDatum.save_list([data[i] for i in chunk], chunk_file)
+            tar.add(chunk_file, arcname=os.path.basename(chunk_file))
+
+
+def test_streaming_legacy_tarfile_with_and_without_index():
+    with tempfile.NamedTemporaryFile(suffix='.dataset') as dataset_file, tempfile.TemporaryDirectory() as temp_dir:
+        # small counts so that no reads are downsampled when loaded
+        write_random_plain_text_dataset(dataset_file.name, num_data=200, max_ref_count=MAX_REF_COUNT, max_alt_count=MAX_ALT_COUNT)
+        original_data = list(plain_text_data.read_data(dataset_file.name))
+        legacy_tar = os.path.join(temp_dir, 'legacy.tar')
+        write_legacy_tarfile(original_data, legacy_tar, temp_dir, num_chunks=4)
+
+        assert read_tar_index(legacy_tar) is None
+        streamed = list(make_base_data_generator_from_tarfile(legacy_tar))
+        write_tar_index(legacy_tar)
+        assert len(read_tar_index(legacy_tar)) == 4
+        indexed = list(make_base_data_generator_from_tarfile(legacy_tar))
+
+        for data in [streamed, indexed]:
+            assert len(data) == len(original_data)
+            for datum, original_datum in zip(data, original_data):
+                assert np.array_equal(datum.get_array_1d(), original_datum.get_array_1d())
+                assert np.array_equal(datum.reads_re, original_datum.reads_re)
+
+
+def test_edit_dataset():
+    with tempfile.NamedTemporaryFile(suffix='.dataset') as dataset_file, tempfile.TemporaryDirectory() as temp_dir:
+        write_random_plain_text_dataset(dataset_file.name, num_data=200)
+        original_data = list(plain_text_data.read_data(dataset_file.name))
+        legacy_tar = os.path.join(temp_dir, 'legacy.tar')
+        write_legacy_tarfile(original_data, legacy_tar, temp_dir, num_chunks=3)
+        output_tar = os.path.join(temp_dir, 'edited.tar')
+
+        edit_args = Namespace()
+        setattr(edit_args, constants.TRAIN_TAR_NAME, [legacy_tar, legacy_tar])
+        setattr(edit_args, constants.OUTPUT_NAME, output_tar)
+        setattr(edit_args, constants.CHUNK_SIZE_NAME, 100000)
+        setattr(edit_args, constants.DATASET_EDIT_TYPE_NAME, edit_dataset.EditType.REMOVE_ARTIFACTS.value)
+        setattr(edit_args, constants.SOURCE_NAME, 2)
+        edit_dataset.main_without_parsing(edit_args)
+
+        # the output is indexed, and the index agrees with the tar headers
+        with tarfile.open(output_tar) as tar:
+            members = [(member.name, member.offset_data, member.size) for member in tar.getmembers()]
+        assert read_tar_index(output_tar) == members
+        assert is_memory_mapped_dataset(output_tar)
+
+        edited = ReadsDataset(data_tarfile=output_tar)
+        num_non_artifacts = len([datum for datum in original_data if datum.get_label() != Label.ARTIFACT])
+        assert len(edited) == 2 * num_non_artifacts
+        assert all(datum.get_source() == 2 and datum.get_label() != Label.ARTIFACT for datum in edited)
+
+
+def test_edit_dataset_removing_everything():
+    with tempfile.NamedTemporaryFile(suffix='.dataset') as dataset_file, tempfile.TemporaryDirectory() as temp_dir:
+        write_random_plain_text_dataset(dataset_file.name, num_data=100)
+        artifacts = [datum for datum in plain_text_data.read_data(dataset_file.name) if datum.get_label() == Label.ARTIFACT]
+        legacy_tar = os.path.join(temp_dir, 'legacy.tar')
+        write_legacy_tarfile(artifacts, legacy_tar, temp_dir, num_chunks=2)
+        output_tar = os.path.join(temp_dir, 'edited.tar')
+
+        edit_args = Namespace()
+        setattr(edit_args, constants.TRAIN_TAR_NAME, [legacy_tar])
+        setattr(edit_args, constants.OUTPUT_NAME, output_tar)
+        setattr(edit_args, constants.CHUNK_SIZE_NAME, 100000)
+        setattr(edit_args, constants.DATASET_EDIT_TYPE_NAME, edit_dataset.EditType.REMOVE_ARTIFACTS.value)
+        setattr(edit_args, constants.SOURCE_NAME, None)
+        edit_dataset.main_without_parsing(edit_args)
+
+        # the output is a valid, empty dataset
+        assert is_memory_mapped_dataset(output_tar)
+        assert len(MemoryMappedData(output_tar)) == 0
+        assert len(list(make_base_data_generator_from_tarfile(output_tar))) == 0
@@ -1,8 +1,25 @@
 import tempfile
 from argparse import Namespace
 
+import cyvcf2
+import numpy as np
+import torch
+
 from permutect import constants
+from permutect.architecture.artifact_model import ArtifactModel
+from permutect.architecture.posterior_model import load_posterior_model
+from permutect.data import plain_text_data
+from permutect.data.datum import Datum
+from permutect.data.posterior_data import PosteriorBatch, PosteriorDataset
+from permutect.metrics.evaluation_metrics import EmbeddingMetrics
+from permutect.parameters import ModelParameters
+from permutect.test.architecture.test_artifact_model_views import REF_SEQ_LAYER_STRINGS
+from permutect.test.architecture.test_posterior_model import make_posterior_dataset
+from permutect.test.test_utils.artificial_data import write_random_plain_text_dataset
 from permutect.tools import filter_variants
+from permutect.utils.enums import Label, Call, Variation, Precision
+from permutect.utils.segmentation import Segmentation
+from permutect.utils.variant_keys import VariantKeyIndex, variant_keys_from_data_array
 
 
 def test_filtering_on_dream1_chr20():
@@ -40,6 +57,181 @@ def test_filtering_on_dream1_chr20():
     setattr(filtering_args, constants.NORMAL_MAF_SEGMENTS_NAME, None)
     setattr(filtering_args, constants.GERMLINE_MODE_NAME, False)
     setattr(filtering_args, constants.NO_GERMLINE_MODE_NAME, False)
+    setattr(filtering_args, constants.TRAINING_NORMALIZATION_NAME, None)
+    setattr(filtering_args, constants.FULL_BATCH_SPECTRA_NAME, False)
+    setattr(filtering_args, constants.MAX_SPECTRUM_ITERATIONS_NAME, 1000)
+    setattr(filtering_args, constants.SPECTRUM_TOLERANCE_NAME, 1e-5)
+    setattr(filtering_args, constants.NO_ROC_PLOTS_NAME, False)
+    setattr(filtering_args, constants.FILTER_MODE_NAME, filter_variants.FilterMode.FULL.value)
+    setattr(filtering_args, constants.POSTERIOR_SHARDS_NAME, None)
+    setattr(filtering_args, constants.POSTERIOR_MODEL_NAME, None)
+    setattr(filtering_args, constants.ARTIFACT_CACHE_DIR_NAME, None)
+    setattr(filtering_args, constants.PRECISION_NAME, Precision.FP32.value)
 
     filter_variants.main_without_parsing(filtering_args)
-    h = 9
\ No newline at end of file
+    h = 9
+
+
+def write_vcf_and_contigs_table_for_data(data, vcf_file, contigs_table):
+    """
+    write a Mutect2-like VCF with a record for each datum, every fourth one filtered by Mutect2 for contamination, and a
+    contigs table naming contig n chr<n>
+    """
+    contigs = sorted(set(datum.get_contig() for datum in data))
+    with open(contigs_table, 'w') as table:
+        for contig in contigs:
+            table.write(f"chr{contig}\t{contig}\n")
+
+    variants = sorted(set((datum.get_contig(), datum.get_position(), datum.get_ref_allele(), datum.get_alt_allele()) for datum in data))
+    with open(vcf_file, 'w') as vcf:
+        vcf.write("##fileformat=VCFv4.2\n")
+        vcf.write('##FILTER=<ID=contamination,Description="contamination">\n')
+        vcf.write('##INFO=<ID=POPAF,Number=A,Type=Float,Description="negative log10 population allele frequency">\n')
+        for contig in contigs:
+            vcf.write(f"##contig=<ID=chr{contig},length=20000000>\n")
+        vcf.write("#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n")
+        for n, (contig, position, ref, alt) in enumerate(variants):
+            vcf.write(f"chr{contig}\t{position}\t.\t{ref}\t{alt}\t.\t{'contamination' if n % 4 == 0 else 'PASS'}\tPOPAF=3.0\n")
+    return len(variants)
+
+
+def make_filtering_args(mode: filter_variants.FilterMode, output, tensorboard_dir, input_vcf=None, test_dataset=None,
+                        artifact_model=None, contigs_table=None, posterior_shards=None, posterior_model=None):
+    filtering_args = Namespace()
+    setattr(filtering_args, constants.FILTER_MODE_NAME, mode.value)
+    setattr(filtering_args, constants.INPUT_NAME, input_vcf)
+    setattr(filtering_args, constants.TEST_DATASET_NAME, test_dataset)
+    setattr(filtering_args, constants.ARTIFACT_MODEL_NAME, artifact_model)
+    setattr(filtering_args, constants.CONTIGS_TABLE_NAME, contigs_table)
+    setattr(filtering_args, constants.POSTERIOR_SHARDS_NAME, posterior_shards)
+    setattr(filtering_args, constants.POSTERIOR_MODEL_NAME, posterior_model)
+    setattr(filtering_args, constants.OUTPUT_NAME, output)
+    setattr(filtering_args, constants.TENSORBOARD_DIR_NAME, tensorboard_dir)
+    setattr(filtering_args, constants.BATCH_SIZE_NAME, 16)
+    setattr(filtering_args, constants.NUM_WORKERS_NAME, 0)
+    setattr(filtering_args, constants.CHUNK_SIZE_NAME, 100000)
+    setattr(filtering_args, constants.ARTIFACT_CACHE_DIR_NAME, None)
+    setattr(filtering_args, constants.PRECISION_NAME, Precision.FP32.value)
+    setattr(filtering_args, constants.TRAINING_NORMALIZATION_NAME, None)
+    setattr(filtering_args, constants.NUM_SPECTRUM_ITERATIONS_NAME, 1)
+    setattr(filtering_args, constants.SPECTRUM_LEARNING_RATE_NAME, 0.001)
+    setattr(filtering_args, constants.FULL_BATCH_SPECTRA_NAME, False)
+    setattr(filtering_args, constants.MAX_SPECTRUM_ITERATIONS_NAME, 1000)
+    setattr(filtering_args, constants.SPECTRUM_TOLERANCE_NAME, 1e-5)
+    setattr(filtering_args, constants.INITIAL_LOG_VARIANT_PRIOR_NAME, -10.0)
+    setattr(filtering_args, constants.INITIAL_LOG_ARTIFACT_PRIOR_NAME, -10.0)
+    setattr(filtering_args, constants.GENOMIC_SPAN_NAME, 100000)
+    setattr(filtering_args, constants.MAF_SEGMENTS_NAME, None)
+    setattr(filtering_args, constants.NORMAL_MAF_SEGMENTS_NAME, None)
+    setattr(filtering_args, constants.GERMLINE_MODE_NAME, False)
+    setattr(filtering_args, constants.HET_BETA_NAME, None)
+    setattr(filtering_args, constants.NO_ROC_PLOTS_NAME, True)
+    setattr(filtering_args, constants.NO_GERMLINE_MODE_NAME, False)
+    return filtering_args
+
+
+def test_filter_variants_full_and_scatter_gather_annotate_modes():
+    dataset_file, vcf_file, contigs_table = tempfile.NamedTemporaryFile(suffix='.dataset'), \
+        tempfile.NamedTemporaryFile(suffix='.vcf'), tempfile.NamedTemporaryFile()
+    model_file, shard_file, posterior_model_file = tempfile.NamedTemporaryFile(suffix='.pt'), tempfile.NamedTemporaryFile(), \
+        tempfile.NamedTemporaryFile()
+    full_vcf, annotated_vcf = tempfile.NamedTemporaryFile(suffix='.vcf'), tempfile.NamedTemporaryFile(suffix='.vcf')
+    tensorboard_dir = tempfile.TemporaryDirectory()
+
+    write_random_plain_text_dataset(dataset_file.name, num_data=200)
+    data = [datum for chunk in plain_text_data.generate_normalized_data([dataset_file.name], 100000) for datum in chunk]
+    num_variants = write_vcf_and_contigs_table_for_data(data, vcf_file.name, contigs_table.name)
+    params = ModelParameters(read_layers=[10, 10], self_attention_hidden_dimension=12, num_self_attention_layers=2,
+        info_layers=[10], aggregation_layers=[8], num_artifact_clusters=2, calibration_layers=[4],
+        ref_seq_layers_strings=REF_SEQ_LAYER_STRINGS, dropout_p=0.1, reweighting_range=0.3)
+    ArtifactModel(params, num_read_features=data[0].get_reads_re().shape[1], num_info_features=len(data[0].get_info_1d()),
+        haplotypes_length=len(data[0].get_haplotypes_1d()), device=torch.device('cpu')).save_model(model_file.name)
+
+    Mode = filter_variants.FilterMode
+    filter_variants.main_without_parsing(make_filtering_args(Mode.FULL, full_vcf.name, tensorboard_dir.name, input_vcf=vcf_file.name,
+        test_dataset=dataset_file.name, artifact_model=model_file.name, contigs_table=contigs_table.name))
+    filter_variants.main_without_parsing(make_filtering_args(Mode.SCATTER, shard_file.name, tensorboard_dir.name, input_vcf=vcf_file.name,
+        test_dataset=dataset_file.name, artifact_model=model_file.name, contigs_table=contigs_table.name))
+    filter_variants.main_without_parsing(make_filtering_args(Mode.GATHER, posterior_model_file.name, tensorboard_dir.name,
+        posterior_shards=[shard_file.name]))
+    filter_variants.main_without_parsing(make_filtering_args(Mode.ANNOTATE, annotated_vcf.name, tensorboard_dir.name,
+        input_vcf=vcf_file.name, contigs_table=contigs_table.name, posterior_shards=[shard_file.name],
+        posterior_model=posterior_model_file.name))
+
+    # every record is written to the output, but only those in the posterior data, ie not filtered by Mutect2, are annotated
+    num_posterior_data = len(PosteriorDataset.load([shard_file.name]))
+    assert 0 < num_posterior_data < num_variants
+    for output_vcf in (full_vcf, annotated_vcf):
+        records = list(cyvcf2.VCF(output_vcf.name))
+        assert len(records) == num_variants
+        annotated = [v for v in records if v.INFO.get(filter_variants.POST_PROB_INFO_KEY) is not None]
+        assert len(annotated) == num_posterior_data
+        assert not any('contamination' in v.FILTER for v in annotated if v.FILTER is not None)
+
+
+def test_assemble_posterior_arrays_matches_per_datum_assembly():
+    with tempfile.NamedTemporaryFile(suffix='.dataset') as dataset_file:
+        write_random_plain_text_dataset(dataset_file.name, num_data=100)
+        data = list(plain_text_data.read_data(dataset_file.name))
+    data_be = np.vstack([datum.get_array_1d() for datum in data])
+    contig_index_to_name_map = {contig: f"chr{contig}" for contig in set(data_be[:, Datum.CONTIG_IDX].tolist())}
+    keys = variant_keys_from_data_array(data_be)
+
+    # every third datum is missing from the VCF and every fifth is filtered by Mutect2
+    in_vcf = [n for n in range(len(data)) if n % 3 != 0]
+    vcf_index = VariantKeyIndex(keys[in_vcf])
+    allele_frequencies = np.array([n / 1000 for n in in_vcf], dtype=np.float32)
+    m2_filtered_index = VariantKeyIndex(keys[[n for n in range(len(data)) if n % 5 == 0]])
+    first_contig, first_position = contig_index_to_name_map[data[1].get_contig()], data[1].get_position()
+    segmentation = Segmentation({first_contig: [(first_position - 1, first_position + 1, 0.3)]})
+    logits_b = np.linspace(-3, 3, len(data), dtype=np.float32)
+    features_be = torch.randn(len(data), 5)
+
+    kept_data_be, float_array_b4, kept_features_be = filter_variants.assemble_posterior_arrays(data_be, logits_b, features_be,
+        contig_index_to_name_map, vcf_index, allele_frequencies, m2_filtered_index, segmentation, Segmentation())
+
+    expected = [n for n in in_vcf if n % 5 != 0]
+    assert np.array_equal(kept_data_be, data_be[expected])
+    assert torch.equal(kept_features_be, features_be[expected])
+    assert np.allclose(float_array_b4[:, PosteriorBatch.ALLELE_FREQUENCY], [n / 1000 for n in expected])
+    assert np.allclose(float_array_b4[:, PosteriorBatch.ARTIFACT_LOGIT], logits_b[expected])
+    assert np.allclose(float_array_b4[:, PosteriorBatch.NORMAL_MAF], 0.5)
+    expected_mafs = [0.3 if (contig_index_to_name_map[data[n].get_contig()], data[n].get_position()) == (first_contig, first_position)
+                     else 0.5 for n in expected]
+    assert np.allclose(float_array_b4[:, PosteriorBatch.MAF], expected_mafs)
+
+
+def test_format_info_strings_and_evaluate_calls():
+    probs_bc = torch.tensor([[0.25, 0.75], [1.0, 0.0]])
+    info_strings = filter_variants.format_info_strings(probs_bc, torch.log(probs_bc), -probs_bc, torch.tensor([1.5, -2.0]), 2 * probs_bc)
+    assert info_strings[0] == "0.250,0.750\t-1.386,-0.288\t-0.250,-0.750\t1.500\t0.500,1.500"
+    assert info_strings[1].split('\t')[3] == "-2.000"
+
+    labels = np.array([Label.VARIANT, Label.VARIANT, Label.ARTIFACT, Label.ARTIFACT, Label.UNLABELED])
+    called_as_error = np.array([False, True, True, False, True])
+    error_calls = np.array([Call.ARTIFACT, Call.ARTIFACT, Call.ARTIFACT, Call.SEQ_ERROR, Call.ARTIFACT])
+    correctness_labels, mistakes = filter_variants.evaluate_calls(labels, called_as_error, error_calls)
+    assert correctness_labels == [EmbeddingMetrics.TRUE_POSITIVE, EmbeddingMetrics.FALSE_NEGATIVE_ARTIFACT,
+                                  EmbeddingMetrics.TRUE_NEGATIVE_ARTIFACT, EmbeddingMetrics.FALSE_POSITIVE, EmbeddingMetrics.UNKNOWN]
+    assert mistakes == [1, 3]
+
+
+def test_gather_posterior_model_from_shards():
+    shards = [tempfile.NamedTemporaryFile() for _ in range(2)]
+    posterior_model_file = tempfile.NamedTemporaryFile()
+    tensorboard_dir = tempfile.TemporaryDirectory()
+    shard_datasets = [make_posterior_dataset(100) for _ in shards]
+    for shard, shard_dataset in zip(shards, shard_datasets):
+        shard_dataset.save(shard.name)
+
+    filter_variants.gather_posterior_model([shard.name for shard in shards], posterior_model_file.name, initial_log_variant_prior=-10.0,
+        initial_log_artifact_prior=-10.0, batch_size=64, num_spectrum_iterations=1, spectrum_learning_rate=0.001,
+        tensorboard_dir=tensorboard_dir.name, genomic_span=100000, germline_mode=True, make_roc_plots=False)
+    posterior_model, thresholds, germline_mode = load_posterior_model(posterior_model_file.name, device=torch.device('cpu'))
+    assert germline_mode and set(thresholds.keys()) == set(Variation)
+
+    dataset = PosteriorDataset.load([shard.name for shard in shards], shuffle=False)
+    batch = dataset.get_batch(0, len(dataset)).copy_to(torch.device('cpu'), torch.float32)
+    with torch.no_grad():
+        log_posteriors_bc = posterior_model.log_relative_posteriors_bc(batch)
+    assert len(dataset) == sum(len(shard_dataset) for shard_dataset in shard_datasets) and not torch.any(torch.isnan(log_posteriors_bc))
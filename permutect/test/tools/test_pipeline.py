@@ -3,6 +3,8 @@ import tempfile
 
 from permutect.tools import preprocess_dataset, filter_variants
 from permutect import constants
+from permutect.misc_utils import DEFAULT_DISTRIBUTED_TIMEOUT_HOURS
+from permutect.utils.enums import Precision
 
 
 def test_on_dream1():
@@ -28,6 +30,8 @@ def test_on_dream1():
     setattr(preprocess_args, constants.TRAINING_DATASETS_NAME, training_datasets)
     setattr(preprocess_args, constants.OUTPUT_NAME, training_data_tarfile.name)
     setattr(preprocess_args, constants.SOURCES_NAME, [0])
+    setattr(preprocess_args, constants.NUM_WORKERS_NAME, 0)
+    setattr(preprocess_args, constants.TWO_PASS_NORMALIZATION_NAME, False)
     preprocess_dataset.main_without_parsing(preprocess_args)
 
     # STEP 2: train a model
@@ -49,6 +53,13 @@ def test_on_dream1():
     setattr(train_model_args, constants.DROPOUT_P_NAME, 0.0)
     setattr(train_model_args, constants.LEARNING_RATE_NAME, 0.001)
     setattr(train_model_args, constants.WEIGHT_DECAY_NAME, 0.01)
+    setattr(train_model_args, constants.SHUFFLE_BLOCK_SIZE_NAME, 0)
+    setattr(train_model_args, constants.SHUFFLE_WINDOW_SIZE_NAME, 0)
+    setattr(train_model_args, constants.PRECISION_NAME, Precision.FP32.value)
+    setattr(train_model_args, constants.DATASET_MEMORY_BUDGET_NAME, None)
+    setattr(train_model_args, constants.DISTRIBUTED_TIMEOUT_HOURS_NAME, DEFAULT_DISTRIBUTED_TIMEOUT_HOURS)
+    setattr(train_model_args, constants.READ_BUDGET_NAME, 0)
+    setattr(train_model_args, constants.BUCKET_BY_READ_COUNT_NAME, False)
     setattr(train_model_args, constants.BATCH_NORMALIZE_NAME, False)
     setattr(train_model_args, constants.LEARN_ARTIFACT_SPECTRA_NAME, True)  # could go either way
     setattr(train_model_args, constants.GENOMIC_SPAN_NAME, 100000)
@@ -1,11 +1,13 @@
 from argparse import Namespace
 import tempfile
 
+import numpy as np
+
 from permutect.data.reads_dataset import ReadsDataset
-from permutect.data.reads_datum import ReadsDatum
 from permutect.tools import preprocess_dataset
 from permutect import constants
-from permutect.misc_utils import extract_to_temp_dir
+from permutect.data.plain_text_data import Normalization
+from permutect.test.test_utils.artificial_data import write_random_plain_text_dataset
 
 
 def test_on_10_megabases_singular():
@@ -17,11 +19,60 @@ def test_on_10_megabases_singular():
     setattr(preprocess_args, constants.TRAINING_DATASETS_NAME, training_datasets)
     setattr(preprocess_args, constants.OUTPUT_NAME, training_data_tarfile.name)
     setattr(preprocess_args, constants.SOURCES_NAME, [0])
+    setattr(preprocess_args, constants.NUM_WORKERS_NAME, 0)
+    setattr(preprocess_args, constants.TWO_PASS_NORMALIZATION_NAME, False)
+    preprocess_dataset.main_without_parsing(preprocess_args)
+
+    dataset = ReadsDataset(data_tarfile=training_data_tarfile.name, num_folds=10)
+
+
+def preprocess_random_datasets(training_datasets, num_workers: int, two_pass_normalization: bool = False):
+    training_data_tarfile = tempfile.NamedTemporaryFile(suffix='.tar')
+    preprocess_args = Namespace()
+    setattr(preprocess_args, constants.CHUNK_SIZE_NAME, 100000)
+    setattr(preprocess_args, constants.TRAINING_DATASETS_NAME, training_datasets)
+    setattr(preprocess_args, constants.OUTPUT_NAME, training_data_tarfile.name)
+    setattr(preprocess_args, constants.SOURCES_NAME, [0, 1])
+    setattr(preprocess_args, constants.NUM_WORKERS_NAME, num_workers)
+    setattr(preprocess_args, constants.TWO_PASS_NORMALIZATION_NAME, two_pass_normalization)
     preprocess_dataset.main_without_parsing(preprocess_args)
+    return training_data_tarfile
+
+
+def test_parallel_preprocessing_matches_serial():
+    with tempfile.NamedTemporaryFile() as dataset1, tempfile.NamedTemporaryFile() as dataset2:
+        write_random_plain_text_dataset(dataset1.name, num_data=200, max_ref_count=5, max_alt_count=5)
+        write_random_plain_text_dataset(dataset2.name, num_data=300, max_ref_count=5, max_alt_count=5)
+
+        serial_tar = preprocess_random_datasets([dataset1.name, dataset2.name], num_workers=0)
+        parallel_tar = preprocess_random_datasets([dataset1.name, dataset2.name], num_workers=2)
+
+        # order of data may differ, so sort by source, contig, and position
+        def sorted_data(tar):
+            data = list(ReadsDataset(data_tarfile=tar.name, num_folds=1))
+            return sorted(data, key=lambda datum: (datum.get_source(), datum.get_contig(), datum.get_position(), datum.get_alt_allele()))
+
+        serial_data, parallel_data = sorted_data(serial_tar), sorted_data(parallel_tar)
+        assert len(serial_data) == len(parallel_data)
+        for serial_datum, parallel_datum in zip(serial_data, parallel_data):
+            assert serial_datum.get_source() == parallel_datum.get_source()
+            assert serial_datum.get_label() == parallel_datum.get_label()
+            assert serial_datum.get_ref_count() == parallel_datum.get_ref_count()
+            assert serial_datum.get_alt_count() == parallel_datum.get_alt_count()
+            assert np.array_equal(serial_datum.get_haplotypes_1d(), parallel_datum.get_haplotypes_1d())
+            # normalization jitters the data randomly, so normalized values are not reproducible
+            assert serial_datum.reads_re.shape == parallel_datum.reads_re.shape
+
+
+def test_two_pass_normalization_is_saved():
+    with tempfile.NamedTemporaryFile() as dataset1, tempfile.NamedTemporaryFile() as dataset2:
+        write_random_plain_text_dataset(dataset1.name, num_data=200, max_ref_count=5, max_alt_count=5)
+        write_random_plain_text_dataset(dataset2.name, num_data=300, max_ref_count=5, max_alt_count=5)
 
-    with tempfile.TemporaryDirectory() as train_temp_dir:
-        training_files = extract_to_temp_dir(training_data_tarfile.name, train_temp_dir)
-        for training_file in training_files:
-            base_data_list = ReadsDatum.load_list(training_file)
+        for num_workers in [0, 2]:
+            training_tar = preprocess_random_datasets([dataset1.name, dataset2.name], num_workers=num_workers, two_pass_normalization=True)
+            normalization = Normalization.load_from_tarfile(training_tar.name)
+            assert normalization.read_quantile_transform.n_features_in_ == 11
 
-    dataset = ReadsDataset(data_tarfile=training_data_tarfile.name, num_folds=10)
\ No newline at end of file
+            dataset = ReadsDataset(data_tarfile=training_tar.name, num_folds=1)
+            assert len(dataset) > 0
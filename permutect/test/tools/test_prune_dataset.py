@@ -3,6 +3,8 @@ from argparse import Namespace
 
 from tensorboard.backend.event_processing.event_accumulator import EventAccumulator
 from permutect import constants
+from permutect.misc_utils import DEFAULT_DISTRIBUTED_TIMEOUT_HOURS
+from permutect.utils.enums import Precision
 from permutect.data.reads_dataset import ReadsDataset
 from permutect.tools import prune_dataset
 
@@ -38,6 +40,13 @@ def test_prune_dataset():
     setattr(prune_dataset_args, constants.NUM_CALIBRATION_EPOCHS_NAME, 1)
     setattr(prune_dataset_args, constants.LEARNING_RATE_NAME, 0.001)
     setattr(prune_dataset_args, constants.WEIGHT_DECAY_NAME, 0.01)
+    setattr(prune_dataset_args, constants.SHUFFLE_BLOCK_SIZE_NAME, 0)
+    setattr(prune_dataset_args, constants.SHUFFLE_WINDOW_SIZE_NAME, 0)
+    setattr(prune_dataset_args, constants.PRECISION_NAME, Precision.FP32.value)
+    setattr(prune_dataset_args, constants.DATASET_MEMORY_BUDGET_NAME, None)
+    setattr(prune_dataset_args, constants.DISTRIBUTED_TIMEOUT_HOURS_NAME, DEFAULT_DISTRIBUTED_TIMEOUT_HOURS)
+    setattr(prune_dataset_args, constants.READ_BUDGET_NAME, 0)
+    setattr(prune_dataset_args, constants.BUCKET_BY_READ_COUNT_NAME, False)
 
     # path to saved model
     setattr(prune_dataset_args, constants.OUTPUT_NAME, pruned_dataset.name)
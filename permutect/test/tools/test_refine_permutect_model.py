@@ -3,6 +3,8 @@ from argparse import Namespace
 
 from tensorboard.backend.event_processing.event_accumulator import EventAccumulator
 from permutect import constants
+from permutect.misc_utils import DEFAULT_DISTRIBUTED_TIMEOUT_HOURS
+from permutect.utils.enums import Precision
 from permutect.architecture.artifact_model import load_model
 from permutect.tools import refine_artifact_model
 
@@ -35,6 +37,13 @@ def test_refine_artifact_model():
     setattr(train_model_args, constants.NUM_CALIBRATION_EPOCHS_NAME, 1)
     setattr(train_model_args, constants.LEARNING_RATE_NAME, 0.001)
     setattr(train_model_args, constants.WEIGHT_DECAY_NAME, 0.01)
+    setattr(train_model_args, constants.SHUFFLE_BLOCK_SIZE_NAME, 0)
+    setattr(train_model_args, constants.SHUFFLE_WINDOW_SIZE_NAME, 0)
+    setattr(train_model_args, constants.PRECISION_NAME, Precision.FP32.value)
+    setattr(train_model_args, constants.DATASET_MEMORY_BUDGET_NAME, None)
+    setattr(train_model_args, constants.DISTRIBUTED_TIMEOUT_HOURS_NAME, DEFAULT_DISTRIBUTED_TIMEOUT_HOURS)
+    setattr(train_model_args, constants.READ_BUDGET_NAME, 0)
+    setattr(train_model_args, constants.BUCKET_BY_READ_COUNT_NAME, False)
 
     # path to saved model
     setattr(train_model_args, constants.OUTPUT_NAME, saved_model.name)
@@ -0,0 +1,109 @@
+import os
+import tempfile
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch.utils.tensorboard import SummaryWriter
+
+from permutect.data import plain_text_data
+from permutect.data.memory_mapped_data import MemoryMappedDataWriter
+from permutect.data.reads_batch import ReadsBatch
+from permutect.data.reads_dataset import ReadsDataset
+from permutect.metrics.loss_metrics import LossMetrics
+from permutect.misc_utils import init_distributed_from_environment, get_world_size, backpropagate, broadcast_module
+from permutect.parameters import TrainingParameters
+from permutect.test.architecture.test_artifact_model_views import make_small_model_and_batch
+from permutect.test.test_utils.artificial_data import write_random_plain_text_dataset
+from permutect.training.balancer import Balancer
+from permutect.training.model_training import train_artifact_model
+
+WORLD_SIZE = 2
+
+
+def join_process_group(rank: int, store_dir: str):
+    # a file store, unlike the default TCP store, has no server process that must outlive the others.  The group is left
+    # to be torn down when the process exits, because destroy_process_group with gloo occasionally hangs.
+    dist.init_process_group(backend='gloo', init_method='file://' + os.path.join(store_dir, 'store'), rank=rank, world_size=WORLD_SIZE)
+    assert init_distributed_from_environment() and get_world_size() == WORLD_SIZE
+
+
+def run_in_processes(function, *args):
+    with tempfile.TemporaryDirectory() as store_dir:
+        mp.spawn(function, args=(store_dir, *args), nprocs=WORLD_SIZE, join=True)
+
+
+def write_random_dataset_tarfile(tarfile, num_data: int):
+    # parsing downsamples reads at random, so all processes must load the same parsed data
+    with tempfile.NamedTemporaryFile(suffix='.dataset') as dataset_file:
+        write_random_plain_text_dataset(dataset_file.name, num_data=num_data)
+        with MemoryMappedDataWriter(tarfile) as writer:
+            writer.write(list(plain_text_data.read_data(dataset_file.name)))
+
+
+def balancer_and_metrics_worker(rank: int, store_dir: str, dataset_tarfile: str):
+    Balancer.DATA_BEFORE_RECOMPUTE = 0     # recompute weights after every batch
+    cpu = torch.device('cpu')
+    model, _ = make_small_model_and_batch()
+    model.eval()
+    data = list(ReadsDataset(data_tarfile=dataset_tarfile, num_folds=1))
+    batch = ReadsBatch(data).copy_to(cpu, model._dtype)
+    shard = ReadsBatch(data[rank::WORLD_SIZE]).copy_to(cpu, model._dtype)
+
+    # single-process reference on the whole batch, computed before joining the process group
+    single_balancer, single_metrics = Balancer(num_sources=1, device=cpu), LossMetrics(num_sources=1, device=cpu)
+    for _ in range(2):
+        weights_b, _ = single_balancer.process_batch_and_compute_weights(batch)
+        single_metrics.record(batch, batch.get_alt_counts().float(), weights_b)
+
+    join_process_group(rank, store_dir)
+    balancer, metrics = Balancer(num_sources=1, device=cpu), LossMetrics(num_sources=1, device=cpu)
+    for _ in range(2):
+        weights_b, _ = balancer.process_batch_and_compute_weights(shard)
+        metrics.record(shard, shard.get_alt_counts().float(), weights_b)
+    metrics.all_reduce()
+    assert torch.equal(balancer.counts_slvra, single_balancer.counts_slvra)
+    assert torch.allclose(balancer.weights_slvra, single_balancer.weights_slvra, equal_nan=True)
+    assert torch.allclose(metrics.totals_slvra, single_metrics.totals_slvra)
+    assert torch.allclose(metrics.counts_slvra, single_metrics.counts_slvra)
+
+    # summed gradients of the shards are the gradients of the whole batch, and unused parameters still have none
+    broadcast_module(model)     # the random data made along with the model consumes a varying amount of randomness
+    torch.sum(model.calculate_logits(batch)[0]).backward()
+    single_grads = [None if param.grad is None else param.grad.clone() for param in model.parameters()]
+    optimizer = torch.optim.SGD(model.parameters(), lr=0)
+    backpropagate(optimizer, torch.sum(model.calculate_logits(shard)[0]), distributed=True)
+    assert any(single_grad is None for single_grad in single_grads)
+    for param, single_grad in zip(model.parameters(), single_grads):
+        assert (param.grad is None) if single_grad is None else torch.allclose(param.grad, single_grad, atol=1e-5)
+
+
+def training_worker(rank: int, store_dir: str, dataset_tarfile: str, tensorboard_dir: str):
+    dataset = ReadsDataset(data_tarfile=dataset_tarfile, num_folds=10)
+    model, _ = make_small_model_and_batch()
+    torch.manual_seed(rank)     # different random initialization in each process
+    model.reset_source_predictor(num_sources=1)
+
+    join_process_group(rank, store_dir)
+    summary_writer = SummaryWriter(tensorboard_dir) if rank == 0 else None
+    training_params = TrainingParameters(batch_size=16, num_epochs=1, num_calibration_epochs=1, inference_batch_size=16)
+    train_artifact_model(model, dataset, training_params, summary_writer)
+
+    # every process ends up with the same model
+    for param in model.state_dict().values():
+        main_param = param.clone()
+        dist.broadcast(main_param, src=0)
+        assert torch.equal(param, main_param)
+
+
+def test_balancer_metrics_and_gradients_match_single_process():
+    with tempfile.NamedTemporaryFile(suffix='.tar') as dataset_tarfile:
+        write_random_dataset_tarfile(dataset_tarfile.name, num_data=40)
+        run_in_processes(balancer_and_metrics_worker, dataset_tarfile.name)
+
+
+def test_distributed_training_keeps_models_identical():
+    with tempfile.NamedTemporaryFile(suffix='.tar') as dataset_tarfile, tempfile.TemporaryDirectory() as tensorboard_dir:
+        write_random_dataset_tarfile(dataset_tarfile.name, num_data=200)
+        run_in_processes(training_worker, dataset_tarfile.name, tensorboard_dir)
+        assert len(os.listdir(tensorboard_dir)) > 0
@@ -1,6 +1,7 @@
 import torch
 
-from permutect.utils.math_utils import find_factors, add_in_log_space, subtract_in_log_space
+from permutect.metrics.plotting import get_theoretical_roc_data
+from permutect.utils.math_utils import find_factors, add_in_log_space, subtract_in_log_space, theoretical_f1_thresholds
 
 
 def test_find_factors():
@@ -28,3 +29,16 @@ def test_subtract_in_log_space():
     calc = torch.exp(subtract_in_log_space(logx, logy))
     assert torch.sum(torch.abs(exact - calc)).item() < 10**(-5)
     p = 9
+
+
+def test_theoretical_f1_thresholds():
+    num_groups = 4
+    error_probs = torch.rand(500) ** 2
+    groups = torch.randint(0, num_groups - 1, (500, ))     # the last group is empty
+    thresholds, precisions, sensitivities = theoretical_f1_thresholds(error_probs, groups, num_groups)
+
+    for group in range(num_groups):
+        _, (threshold, precision, sensitivity) = get_theoretical_roc_data(error_probs[groups == group].double().tolist())
+        assert abs(thresholds[group].item() - threshold) < 10**(-9)
+        assert abs(precisions[group].item() - precision) < 10**(-9)
+        assert abs(sensitivities[group].item() - sensitivity) < 10**(-9)
@@ -0,0 +1,26 @@
+import tempfile
+
+import numpy as np
+
+from permutect.utils.segmentation import Segmentation
+
+
+def test_segmentation_from_file():
+    with tempfile.NamedTemporaryFile(mode='w', suffix='.table') as segments_file:
+        segments_file.write("#SAMPLE=tumor\n")
+        segments_file.write("contig\tstart\tend\tminor_allele_fraction\tminor_allele_fraction_low\n")
+        segments_file.write("chr1\t200\t300\t0.2\t0.1\n")
+        segments_file.write("chr1\t100\t200\t0.4\t0.3\n")
+        segments_file.write("chr1\t400\t400\t0.1\t0.1\n")     # empty segment is ignored
+        segments_file.write("chr2\t1\t1000\t0.3\t0.2\n")
+        segments_file.flush()
+        segmentation = Segmentation.from_file(segments_file.name)
+
+    mafs = segmentation.get_mafs("chr1", np.array([50, 100, 199, 200, 299, 300, 400, 1000]))
+    assert np.allclose(mafs, [0.5, 0.4, 0.4, 0.2, 0.2, 0.5, 0.5, 0.5])
+    assert np.allclose(segmentation.get_mafs("chr3", np.array([100])), [0.5])
+
+    contig_index_to_name_map = {0: "chr1", 1: "chr2", 2: "chr3"}
+    mafs = segmentation.get_mafs_by_contig_index(np.array([1, 0, 2, 0]), np.array([150, 150, 150, 250]), contig_index_to_name_map)
+    assert np.allclose(mafs, [0.3, 0.4, 0.5, 0.2])
+    assert np.allclose(Segmentation.from_file(None).get_mafs("chr1", np.array([150])), [0.5])
@@ -0,0 +1,42 @@
+import random
+from types import SimpleNamespace
+
+import numpy as np
+
+from permutect.utils.allele_utils import trim_alleles_on_right, bases_as_base5_int, bases5_as_base_string
+from permutect.utils.variant_keys import trimmed_alt_alleles_base5, make_variant_keys, variant_keys_from_vcf_records, \
+    VariantKeyIndex
+
+
+def test_trimmed_alt_alleles_base5_matches_string_trimming():
+    random.seed(0)
+    refs, alts = [], []
+    for _ in range(1000):
+        suffix = ''.join(random.choices('ACGT', k=random.randint(0, 5)))
+        refs.append(''.join(random.choices('ACGT', k=random.randint(1, 4))) + suffix)
+        alts.append(''.join(random.choices('ACGT', k=random.randint(1, 4))) + suffix)
+
+    # as in Datum, the alleles are truncated before trimming
+    refs_base5 = np.array([bases_as_base5_int(ref) for ref in refs])
+    alts_base5 = np.array([bases_as_base5_int(alt) for alt in alts])
+    expected = [bases_as_base5_int(trim_alleles_on_right(bases5_as_base_string(ref), bases5_as_base_string(alt))[1])
+                for ref, alt in zip(refs_base5.tolist(), alts_base5.tolist())]
+    assert trimmed_alt_alleles_base5(refs_base5, alts_base5).tolist() == expected
+
+
+def test_variant_keys_from_vcf_records():
+    records = [SimpleNamespace(CHROM='chr1', start=99, REF='AT', ALT=['GT']),
+               SimpleNamespace(CHROM='chrUn', start=99, REF='A', ALT=['G'])]
+    keys = variant_keys_from_vcf_records(records, {'chr1': 0})
+    assert keys[0] == make_variant_keys([0], [100], [bases_as_base5_int('G')])[0]
+    assert keys[1]['locus'] < 0     # unknown contig
+
+
+def test_variant_key_index():
+    # the same position on two contigs, two alleles at one locus, and a duplicate key whose last row wins
+    keys = make_variant_keys([1, 0, 0, 0, 1], [5, 5, 5, 7, 5], [3, 2, 4, 2, 3])
+    index = VariantKeyIndex(keys)
+    queries = make_variant_keys([0, 0, 1, 0, 2], [5, 5, 5, 6, 5], [2, 4, 3, 2, 3])
+    assert index.find(queries).tolist() == [1, 2, 4, -1, -1]
+    assert index.contains(queries).tolist() == [True, True, True, False, False]
+    assert VariantKeyIndex(keys[:0]).find(queries).tolist() == [-1] * 5
@@ -0,0 +1,32 @@
+import argparse
+
+from permutect import constants
+from permutect.architecture.artifact_model import load_model
+from permutect.architecture.compiled_artifact_model import compile_artifact_model, save_compiled_artifact_model
+from permutect.misc_utils import gpu_if_available
+
+
+def main_without_parsing(args):
+    model, _, _ = load_model(getattr(args, constants.ARTIFACT_MODEL_NAME), device=gpu_if_available())
+    print("compiling artifact model")
+    compiled = compile_artifact_model(model)
+    save_compiled_artifact_model(compiled, model, getattr(args, constants.OUTPUT_NAME))
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='compile the inference graph of a Permutect artifact model with TorchScript.  '
+                                                 'The compiled model can be given to filter_variants in place of the original.')
+    parser.add_argument('--' + constants.ARTIFACT_MODEL_NAME, type=str, required=True,
+                        help='Permutect artifact model from train_artifact_model.py')
+    parser.add_argument('--' + constants.OUTPUT_NAME, type=str, required=True,
+                        help='output compiled artifact model file.  It runs on the device it was compiled on.')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    main_without_parsing(args)
+
+
+if __name__ == '__main__':
+    main()
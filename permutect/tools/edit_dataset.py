@@ -1,16 +1,12 @@
 import argparse
-import os
-import tarfile
-import tempfile
+import itertools
 from enum import Enum
 
-import torch.utils.data
-
 from tqdm.autonotebook import tqdm
 
 from permutect import constants
-from permutect.data.reads_dataset import ReadsDataset
-from permutect.data.reads_datum import ReadsDatum
+from permutect.data.memory_mapped_data import MemoryMappedDataWriter
+from permutect.data.reads_dataset import make_base_data_generator_from_tarfile
 from permutect.misc_utils import report_memory_usage
 from permutect.utils.enums import Label
 
@@ -24,9 +20,10 @@ class EditType(Enum):
     KEEP_EVERYTHING = "keep_everything"
 
 
-# generates BaseDatum(s) from the original dataset that *pass* the pruning thresholds
-def generate_edited_data(base_datasets, edit_type: str, source: int):
-    pbar = tqdm(enumerate(torch.utils.data.ConcatDataset(base_datasets)), mininterval=60)
+# generates BaseDatum(s) from the original datasets that *pass* the pruning thresholds
+def generate_edited_data(original_tarfiles, edit_type: str, source: int):
+    # stream the data rather than loading each dataset
+    pbar = tqdm(enumerate(itertools.chain.from_iterable(map(make_base_data_generator_from_tarfile, original_tarfiles))), mininterval=60)
 
     for n, reads_datum in pbar:
         if source is not None:
@@ -75,16 +72,9 @@ def generate_output_data_buffers(output_data_generator, max_bytes_per_chunk: int
 
 
 def make_output_training_dataset(pruned_data_buffer_generator, output_tarfile):
-    pruned_data_files = []
-    for base_data_list in pruned_data_buffer_generator:
-        with tempfile.NamedTemporaryFile(delete=False) as train_data_file:
-            ReadsDatum.save_list(base_data_list, train_data_file)
-            pruned_data_files.append(train_data_file.name)
-
-    # bundle them in a tarfile
-    with tarfile.open(output_tarfile, "w") as train_tar:
-        for train_file in pruned_data_files:
-            train_tar.add(train_file, arcname=os.path.basename(train_file))
+    with MemoryMappedDataWriter(output_tarfile) as writer:
+        for base_data_list in pruned_data_buffer_generator:
+            writer.write(base_data_list)
 
 
 def parse_arguments():
@@ -109,10 +99,9 @@ def main_without_parsing(args):
     chunk_size = getattr(args, constants.CHUNK_SIZE_NAME)
     edit_type = getattr(args, constants.DATASET_EDIT_TYPE_NAME)
     new_source = getattr(args, constants.SOURCE_NAME)
-    base_datasets = map(lambda original_tarfile: ReadsDataset(data_tarfile=original_tarfile), original_tarfiles)
 
     # generate ReadSets
-    output_data_generator = generate_edited_data(base_datasets, edit_type, new_source)
+    output_data_generator = generate_edited_data(original_tarfiles, edit_type, new_source)
 
     # generate List[ReadSet]s
     output_data_buffer_generator = generate_output_data_buffers(output_data_generator, chunk_size)
@@ -1,22 +1,27 @@
 import argparse
-from collections import defaultdict
+import os
+from enum import Enum
 from typing import Set
 
 import cyvcf2
 import numpy as np
 import torch
-from intervaltree import IntervalTree
 from torch.utils.tensorboard import SummaryWriter
 from tqdm.autonotebook import tqdm
 
 from permutect import constants
-from permutect.architecture.posterior_model import PosteriorModel
+from permutect.parameters import add_precision_to_parser
+from permutect.architecture.posterior_model import PosteriorModel, DEFAULT_SPECTRUM_TOLERANCE, load_posterior_model
 from permutect.architecture.artifact_model import ArtifactModel, load_model
+from permutect.architecture.compiled_artifact_model import CompiledArtifactModel, is_compiled_artifact_model
 from permutect.data import plain_text_data
+from permutect.data.artifact_cache import artifact_cache_file, cache_artifact_model_outputs, generate_cached_artifact_model_outputs, \
+    cached_feature_dimension
+from permutect.data.plain_text_data import Normalization
 from permutect.data.batch import BatchIndexedTensor
 from permutect.data.datum import Datum
-from permutect.data.posterior_data import PosteriorDataset, PosteriorDatum, PosteriorBatch
-from permutect.data.prefetch_generator import prefetch_generator
+from permutect.data.posterior_data import PosteriorDataset, PosteriorBatch
+from permutect.data.prefetch_generator import prefetch_generator, background_generator
 from permutect.data.reads_batch import ReadsBatch
 from permutect.data.reads_dataset import ReadsDataset
 from permutect.data.count_binning import MAX_ALT_COUNT, alt_count_bin_index, alt_count_bin_name
@@ -24,42 +29,44 @@ from permutect.metrics.evaluation_metrics import EvaluationMetrics, EmbeddingMet
 from permutect.metrics.loss_metrics import AccuracyMetrics
 from permutect.metrics.posterior_result import PosteriorResult
 from permutect.misc_utils import report_memory_usage, gpu_if_available
-from permutect.utils.allele_utils import trim_alleles_on_right, find_variant_type, truncate_bases_if_necessary
-from permutect.utils.enums import Variation, Call, Epoch, Label
+from permutect.utils.enums import Variation, Call, Epoch, Label, Precision
 from permutect.utils.math_utils import prob_to_logit, inverse_sigmoid
+from permutect.utils.segmentation import Segmentation
+from permutect.utils.variant_keys import VARIANT_KEY_DTYPE, VariantKeyIndex, variant_keys_from_data_array, variant_keys_from_vcf_records
 
 TRUSTED_M2_FILTERS = {'contamination'}
 
+
+class FilterMode(Enum):
+    FULL = "full"
+    SCATTER = "scatter"
+    GATHER = "gather"
+    ANNOTATE = "annotate"
+
+
 POST_PROB_INFO_KEY = 'POST'
 ARTIFACT_LOD_INFO_KEY = 'ARTLOD'
 LOG_PRIOR_INFO_KEY = 'PRIOR'
 SPECTRA_LOG_LIKELIHOOD_INFO_KEY = 'SPECLL'
 NORMAL_LOG_LIKELIHOOD_INFO_KEY = 'NORMLL'
+INFO_KEYS_IN_ORDER = [POST_PROB_INFO_KEY, LOG_PRIOR_INFO_KEY, SPECTRA_LOG_LIKELIHOOD_INFO_KEY, ARTIFACT_LOD_INFO_KEY, NORMAL_LOG_LIKELIHOOD_INFO_KEY]
 
 FILTER_NAMES = [call_type.name.lower() for call_type in Call]
 
+# bounded queue sizes between the stages of the posterior data pipeline
+PIPELINE_CHUNK_QUEUE_DEPTH = 1
+PIPELINE_BATCH_QUEUE_DEPTH = 16
 
-def get_first_numeric_element(variant, key):
-    tuple_or_scalar = variant.INFO[key]
-    return tuple_or_scalar[0] if type(tuple_or_scalar) is tuple else tuple_or_scalar
-
+# number of VCF records whose keys are computed and looked up together
+VCF_CHUNK_SIZE = 10000
 
-# TODO: contigs stored as integer index must be converted back to string to compare VCF variants with dataset variants!!!
-def encode(contig: str, position: int, ref: str, alt: str):
-    trimmed_ref, trimmed_alt = trim_alleles_on_right(ref, alt)
-    return contig + ':' + str(position) + ':' + truncate_bases_if_necessary(trimmed_alt)
+# maximum fraction of free GPU memory that the posterior dataset may occupy in order to be kept on the GPU
+POSTERIOR_DATASET_GPU_MEMORY_FRACTION = 0.5
 
 
-def encode_datum(datum: Datum, contig_index_to_name_map):
-    contig_name = contig_index_to_name_map[datum.get_contig()]
-    return encode(contig_name, datum.get_position(), datum.get_ref_allele(), datum.get_alt_allele())
-
-
-def encode_variant(v: cyvcf2.Variant, zero_based=False):
-    alt = v.ALT[0]  # TODO: we're assuming biallelic
-    ref = v.REF
-    start = (v.start + 1) if zero_based else v.start
-    return encode(v.CHROM, start, ref, alt)
+def get_first_numeric_element(variant, key):
+    tuple_or_scalar = variant.INFO[key]
+    return tuple_or_scalar[0] if type(tuple_or_scalar) is tuple else tuple_or_scalar
 
 
 def filters_to_keep_from_m2(v: cyvcf2.Variant) -> Set[str]:
@@ -68,29 +75,59 @@ def filters_to_keep_from_m2(v: cyvcf2.Variant) -> Set[str]:
 
 def parse_arguments():
     parser = argparse.ArgumentParser()
-    parser.add_argument('--' + constants.INPUT_NAME, required=True, help='unfiltered input Mutect2 VCF')
-    parser.add_argument('--' + constants.TEST_DATASET_NAME, required=True,
-                        help='plain text dataset file corresponding to variants in input VCF')
-    parser.add_argument('--' + constants.ARTIFACT_MODEL_NAME, required=True, help='Permutect artifact model from train_artifact_model.py')
-    parser.add_argument('--' + constants.CONTIGS_TABLE_NAME, required=True, help='table of contig names vs integer indices')
-    parser.add_argument('--' + constants.OUTPUT_NAME, required=True, help='path to output filtered VCF')
+    parser.add_argument('--' + constants.FILTER_MODE_NAME, type=str, default=FilterMode.FULL.value, required=False,
+                        choices=[mode.value for mode in FilterMode],
+                        help='full: filter a VCF in one process.  Otherwise filtering is split into three steps so that the '
+                             'expensive artifact model inference can run in parallel on shards of the VCF and dataset, '
+                             'eg one for each genomic interval.  scatter: compute the posterior features of one shard.  '
+                             'gather: fit priors, spectra, and thresholds to the features of all shards.  annotate: '
+                             'filter the VCF of one shard using the gathered posterior model.')
+    parser.add_argument('--' + constants.INPUT_NAME, required=False, help='unfiltered input Mutect2 VCF (full, scatter, annotate)')
+    parser.add_argument('--' + constants.TEST_DATASET_NAME, required=False,
+                        help='plain text dataset file corresponding to variants in input VCF (full, scatter)')
+    parser.add_argument('--' + constants.ARTIFACT_MODEL_NAME, required=False,
+                        help='Permutect artifact model from train_artifact_model.py or compile_artifact_model.py (full, scatter)')
+    parser.add_argument('--' + constants.CONTIGS_TABLE_NAME, required=False, help='table of contig names vs integer indices (full, scatter, annotate)')
+    parser.add_argument('--' + constants.POSTERIOR_SHARDS_NAME, nargs='+', type=str, required=False,
+                        help='posterior feature shards from scatter mode: all of them (gather) or the one for the input VCF (annotate)')
+    parser.add_argument('--' + constants.POSTERIOR_MODEL_NAME, required=False, help='posterior model from gather mode (annotate)')
+    parser.add_argument('--' + constants.OUTPUT_NAME, required=True,
+                        help='path to output filtered VCF (full, annotate), posterior feature shard (scatter), or posterior model (gather)')
     parser.add_argument('--' + constants.TENSORBOARD_DIR_NAME, type=str, default='tensorboard', required=False, help='path to output tensorboard')
     parser.add_argument('--' + constants.BATCH_SIZE_NAME, type=int, default=64, required=False, help='batch size')
     parser.add_argument('--' + constants.NUM_WORKERS_NAME, type=int, default=0, required=False,
                         help='number of subprocesses devoted to data loading, which includes reading from memory map, '
                              'collating batches, and transferring to GPU.')
     parser.add_argument('--' + constants.CHUNK_SIZE_NAME, type=int, default=100000, required=False, help='size in bytes of intermediate binary datasets')
+    parser.add_argument('--' + constants.ARTIFACT_CACHE_DIR_NAME, required=False,
+                        help='directory for caching the artifact logits and embeddings of datasets, keyed by checksums of the '
+                             'dataset, artifact model, and normalization.  Later runs with the same inputs, eg to try different '
+                             'posterior model settings, skip the artifact model.  (full, scatter)')
+    add_precision_to_parser(parser)
+    parser.add_argument('--' + constants.TRAINING_NORMALIZATION_NAME, required=False,
+                        help='training tarfile from preprocess_dataset with two-pass normalization.  If given, its saved '
+                             'normalization is applied to the test dataset instead of fitting quantile transforms to each chunk.')
     parser.add_argument('--' + constants.NUM_SPECTRUM_ITERATIONS_NAME, type=int, default=10, required=False,
                         help='number of epochs for fitting allele fraction spectra')
     parser.add_argument('--' + constants.SPECTRUM_LEARNING_RATE_NAME, type=float, default=0.001, required=False,
                         help='learning rate for fitting allele fraction spectra')
+    parser.add_argument('--' + constants.FULL_BATCH_SPECTRA_NAME, action='store_true',
+                        help='flag for fitting allele fraction spectra and priors with the whole filtering dataset on the '
+                             'device, taking one optimizer step per pass over the data and stopping at convergence rather '
+                             'than after a fixed number of epochs')
+    parser.add_argument('--' + constants.MAX_SPECTRUM_ITERATIONS_NAME, type=int, default=1000, required=False,
+                        help='maximum number of iterations for full-batch fitting of allele fraction spectra')
+    parser.add_argument('--' + constants.SPECTRUM_TOLERANCE_NAME, type=float, default=DEFAULT_SPECTRUM_TOLERANCE, required=False,
+                        help='relative change in loss below which full-batch fitting of allele fraction spectra is '
+                             'considered converged')
     parser.add_argument('--' + constants.INITIAL_LOG_VARIANT_PRIOR_NAME, type=float, default=-10.0, required=False,
                         help='initial value for natural log prior of somatic variants')
     parser.add_argument('--' + constants.INITIAL_LOG_ARTIFACT_PRIOR_NAME, type=float, default=-10.0, required=False,
                         help='initial value for natural log prior of artifacts')
-    parser.add_argument('--' + constants.GENOMIC_SPAN_NAME, type=float, required=True,
+    parser.add_argument('--' + constants.GENOMIC_SPAN_NAME, type=float, required=False,
                         help='number of sites considered by Mutect2, including those lacking variation or artifacts, hence absent from input dataset.  '
-                             'Necessary for learning priors since otherwise rates of artifacts and variants would be overinflated.')
+                             'Necessary for learning priors since otherwise rates of artifacts and variants would be overinflated.  '
+                             'In gather mode this is the span of all shards together.  (full, gather)')
     parser.add_argument('--' + constants.MAF_SEGMENTS_NAME, required=False,
                         help='copy-number segmentation file from GATK containing minor allele fractions.  '
                              'Useful for modeling germline variation as the minor allele fraction determines the distribution of germline allele counts.')
@@ -103,6 +140,9 @@ def parse_arguments():
     parser.add_argument('--' + constants.HET_BETA_NAME, type=float, required=False,
                         help='beta shape parameter for germline spectrum beta binomial if we want to override binomial')
 
+    parser.add_argument('--' + constants.NO_ROC_PLOTS_NAME, action='store_true',
+                        help='flag for skipping the theoretical ROC curve plots, which are slow for large callsets')
+
     parser.add_argument('--' + constants.NO_GERMLINE_MODE_NAME, action='store_true',
                         help='flag for not genotyping germline events so that the only possibilities considered are '
                              'somatic, artifact, and sequencing error.  This is useful for certain validation where '
@@ -110,148 +150,361 @@ def parse_arguments():
     return parser.parse_args()
 
 
-def get_segmentation(segments_file) -> defaultdict:
-
-    result = defaultdict(IntervalTree)
-    if segments_file is None:
-        return result
-
-    print("reading segmentation file")
-    with open(segments_file, 'r') as file:
-        for line in file:
-            if line.startswith("#") or (line.startswith("contig") and "minor_allele_fraction" in line):
-                continue
-            tokens = line.split()
-            contig, start, stop, maf = tokens[0], int(tokens[1]), int(tokens[2]), float(tokens[3])
-            if stop > start:    # IntervalTree throws error if start == stop
-                result[contig][start:stop] = maf
-
-    return result
+# arguments required by each mode, in addition to the output
+REQUIRED_ARGUMENTS = {FilterMode.FULL: [constants.INPUT_NAME, constants.TEST_DATASET_NAME, constants.ARTIFACT_MODEL_NAME,
+                                        constants.CONTIGS_TABLE_NAME, constants.GENOMIC_SPAN_NAME],
+                      FilterMode.SCATTER: [constants.INPUT_NAME, constants.TEST_DATASET_NAME, constants.ARTIFACT_MODEL_NAME,
+                                           constants.CONTIGS_TABLE_NAME],
+                      FilterMode.GATHER: [constants.POSTERIOR_SHARDS_NAME, constants.GENOMIC_SPAN_NAME],
+                      FilterMode.ANNOTATE: [constants.INPUT_NAME, constants.POSTERIOR_SHARDS_NAME, constants.POSTERIOR_MODEL_NAME,
+                                            constants.CONTIGS_TABLE_NAME]}
 
 
 def main_without_parsing(args):
-    make_filtered_vcf(artifact_model_path=getattr(args, constants.ARTIFACT_MODEL_NAME),
-                      initial_log_variant_prior=getattr(args, constants.INITIAL_LOG_VARIANT_PRIOR_NAME),
-                      initial_log_artifact_prior=getattr(args, constants.INITIAL_LOG_ARTIFACT_PRIOR_NAME),
-                      test_dataset_file=getattr(args, constants.TEST_DATASET_NAME),
-                      contigs_table=getattr(args, constants.CONTIGS_TABLE_NAME),
-                      input_vcf=getattr(args, constants.INPUT_NAME),
-                      output_vcf=getattr(args, constants.OUTPUT_NAME),
-                      batch_size=getattr(args, constants.BATCH_SIZE_NAME),
-                      num_workers=getattr(args, constants.NUM_WORKERS_NAME),
-                      chunk_size=getattr(args, constants.CHUNK_SIZE_NAME),
-                      num_spectrum_iterations=getattr(args, constants.NUM_SPECTRUM_ITERATIONS_NAME),
-                      spectrum_learning_rate=getattr(args, constants.SPECTRUM_LEARNING_RATE_NAME),
-                      tensorboard_dir=getattr(args, constants.TENSORBOARD_DIR_NAME),
-                      genomic_span=getattr(args, constants.GENOMIC_SPAN_NAME),
-                      germline_mode=getattr(args, constants.GERMLINE_MODE_NAME),
-                      no_germline_mode=getattr(args, constants.NO_GERMLINE_MODE_NAME),
-                      het_beta=getattr(args, constants.HET_BETA_NAME),
-                      segmentation=get_segmentation(getattr(args, constants.MAF_SEGMENTS_NAME)),
-                      normal_segmentation=get_segmentation(getattr(args, constants.NORMAL_MAF_SEGMENTS_NAME)))
+    mode = FilterMode(getattr(args, constants.FILTER_MODE_NAME))
+    for name in REQUIRED_ARGUMENTS[mode]:
+        if getattr(args, name) is None:
+            raise Exception(f"--{name} is required in {mode.value} mode")
+
+    if mode == FilterMode.SCATTER or mode == FilterMode.FULL:
+        training_normalization_tar = getattr(args, constants.TRAINING_NORMALIZATION_NAME)
+        normalization = None if training_normalization_tar is None else Normalization.load_from_tarfile(training_normalization_tar)
+        segmentation = Segmentation.from_file(getattr(args, constants.MAF_SEGMENTS_NAME))
+        normal_segmentation = Segmentation.from_file(getattr(args, constants.NORMAL_MAF_SEGMENTS_NAME))
+        precision = Precision(getattr(args, constants.PRECISION_NAME))
+        cache_dir = getattr(args, constants.ARTIFACT_CACHE_DIR_NAME)
+        cache_file = None if cache_dir is None else artifact_cache_file(cache_dir, getattr(args, constants.TEST_DATASET_NAME),
+            getattr(args, constants.ARTIFACT_MODEL_NAME), training_normalization_tar, getattr(args, constants.CHUNK_SIZE_NAME), precision)
+
+    if mode == FilterMode.SCATTER:
+        scatter_posterior_data(artifact_model_path=getattr(args, constants.ARTIFACT_MODEL_NAME),
+                               test_dataset_file=getattr(args, constants.TEST_DATASET_NAME),
+                               contigs_table=getattr(args, constants.CONTIGS_TABLE_NAME),
+                               input_vcf=getattr(args, constants.INPUT_NAME),
+                               output_shard=getattr(args, constants.OUTPUT_NAME),
+                               batch_size=getattr(args, constants.BATCH_SIZE_NAME),
+                               num_workers=getattr(args, constants.NUM_WORKERS_NAME),
+                               chunk_size=getattr(args, constants.CHUNK_SIZE_NAME),
+                               segmentation=segmentation, normal_segmentation=normal_segmentation, normalization=normalization,
+                               artifact_cache_file=cache_file, precision=precision)
+    elif mode == FilterMode.GATHER:
+        gather_posterior_model(posterior_shards=getattr(args, constants.POSTERIOR_SHARDS_NAME),
+                               output_model=getattr(args, constants.OUTPUT_NAME),
+                               initial_log_variant_prior=getattr(args, constants.INITIAL_LOG_VARIANT_PRIOR_NAME),
+                               initial_log_artifact_prior=getattr(args, constants.INITIAL_LOG_ARTIFACT_PRIOR_NAME),
+                               batch_size=getattr(args, constants.BATCH_SIZE_NAME),
+                               num_spectrum_iterations=getattr(args, constants.NUM_SPECTRUM_ITERATIONS_NAME),
+                               spectrum_learning_rate=getattr(args, constants.SPECTRUM_LEARNING_RATE_NAME),
+                               full_batch_spectra=getattr(args, constants.FULL_BATCH_SPECTRA_NAME),
+                               max_spectrum_iterations=getattr(args, constants.MAX_SPECTRUM_ITERATIONS_NAME),
+                               spectrum_tolerance=getattr(args, constants.SPECTRUM_TOLERANCE_NAME),
+                               make_roc_plots=not getattr(args, constants.NO_ROC_PLOTS_NAME),
+                               tensorboard_dir=getattr(args, constants.TENSORBOARD_DIR_NAME),
+                               genomic_span=getattr(args, constants.GENOMIC_SPAN_NAME),
+                               germline_mode=getattr(args, constants.GERMLINE_MODE_NAME),
+                               no_germline_mode=getattr(args, constants.NO_GERMLINE_MODE_NAME),
+                               het_beta=getattr(args, constants.HET_BETA_NAME))
+    elif mode == FilterMode.ANNOTATE:
+        posterior_shards = getattr(args, constants.POSTERIOR_SHARDS_NAME)
+        assert len(posterior_shards) == 1, "annotate mode takes the single posterior shard of the input VCF"
+        annotate_vcf_shard(posterior_model_path=getattr(args, constants.POSTERIOR_MODEL_NAME),
+                           posterior_shard=posterior_shards[0],
+                           contigs_table=getattr(args, constants.CONTIGS_TABLE_NAME),
+                           input_vcf=getattr(args, constants.INPUT_NAME),
+                           output_vcf=getattr(args, constants.OUTPUT_NAME),
+                           batch_size=getattr(args, constants.BATCH_SIZE_NAME),
+                           tensorboard_dir=getattr(args, constants.TENSORBOARD_DIR_NAME))
+    else:
+        make_filtered_vcf(artifact_model_path=getattr(args, constants.ARTIFACT_MODEL_NAME),
+                          initial_log_variant_prior=getattr(args, constants.INITIAL_LOG_VARIANT_PRIOR_NAME),
+                          initial_log_artifact_prior=getattr(args, constants.INITIAL_LOG_ARTIFACT_PRIOR_NAME),
+                          test_dataset_file=getattr(args, constants.TEST_DATASET_NAME),
+                          contigs_table=getattr(args, constants.CONTIGS_TABLE_NAME),
+                          input_vcf=getattr(args, constants.INPUT_NAME),
+                          output_vcf=getattr(args, constants.OUTPUT_NAME),
+                          batch_size=getattr(args, constants.BATCH_SIZE_NAME),
+                          num_workers=getattr(args, constants.NUM_WORKERS_NAME),
+                          chunk_size=getattr(args, constants.CHUNK_SIZE_NAME),
+                          num_spectrum_iterations=getattr(args, constants.NUM_SPECTRUM_ITERATIONS_NAME),
+                          spectrum_learning_rate=getattr(args, constants.SPECTRUM_LEARNING_RATE_NAME),
+                          full_batch_spectra=getattr(args, constants.FULL_BATCH_SPECTRA_NAME),
+                          max_spectrum_iterations=getattr(args, constants.MAX_SPECTRUM_ITERATIONS_NAME),
+                          spectrum_tolerance=getattr(args, constants.SPECTRUM_TOLERANCE_NAME),
+                          make_roc_plots=not getattr(args, constants.NO_ROC_PLOTS_NAME),
+                          tensorboard_dir=getattr(args, constants.TENSORBOARD_DIR_NAME),
+                          genomic_span=getattr(args, constants.GENOMIC_SPAN_NAME),
+                          germline_mode=getattr(args, constants.GERMLINE_MODE_NAME),
+                          no_germline_mode=getattr(args, constants.NO_GERMLINE_MODE_NAME),
+                          het_beta=getattr(args, constants.HET_BETA_NAME),
+                          segmentation=segmentation, normal_segmentation=normal_segmentation, normalization=normalization,
+                          artifact_cache_file=cache_file, precision=precision)
 
 
 def make_filtered_vcf(artifact_model_path, initial_log_variant_prior: float, initial_log_artifact_prior: float,
                       test_dataset_file, contigs_table, input_vcf, output_vcf, batch_size: int, num_workers: int, chunk_size: int, num_spectrum_iterations: int,
                       spectrum_learning_rate: float, tensorboard_dir, genomic_span: int, germline_mode: bool = False, no_germline_mode: bool = False, het_beta: float = None,
-                      segmentation=defaultdict(IntervalTree), normal_segmentation=defaultdict(IntervalTree)):
+                      segmentation: Segmentation = Segmentation(), normal_segmentation: Segmentation = Segmentation(), normalization: Normalization = None,
+                      full_batch_spectra: bool = False, max_spectrum_iterations: int = 1000, spectrum_tolerance: float = DEFAULT_SPECTRUM_TOLERANCE,
+                      make_roc_plots: bool = True, artifact_cache_file=None, precision: Precision = Precision.FP32):
+    print("Loading artifact model and test dataset")
+    contig_index_to_name_map = read_contigs_table(contigs_table)
+    model = load_model_unless_cached(artifact_model_path, artifact_cache_file, precision)
+
+    posterior_dataset = make_posterior_dataset(test_dataset_file, input_vcf, contig_index_to_name_map,
+        model, batch_size, num_workers=num_workers, chunk_size=chunk_size, segmentation=segmentation, normal_segmentation=normal_segmentation,
+        normalization=normalization, artifact_cache_file=artifact_cache_file)
+    posterior_model = PosteriorModel(initial_log_variant_prior, initial_log_artifact_prior, no_germline_mode=no_germline_mode,
+        num_base_features=posterior_dataset.embeddings.shape[1], het_beta=het_beta)
+    posterior_data_loader = make_posterior_data_loader(posterior_dataset, batch_size)
+
+    summary_writer = SummaryWriter(tensorboard_dir)
+    error_probability_thresholds = fit_posterior_model(posterior_model, posterior_data_loader, genomic_span, summary_writer,
+        num_spectrum_iterations=num_spectrum_iterations, spectrum_learning_rate=spectrum_learning_rate, full_batch_spectra=full_batch_spectra,
+        max_spectrum_iterations=max_spectrum_iterations, spectrum_tolerance=spectrum_tolerance, germline_mode=germline_mode,
+        make_roc_plots=make_roc_plots)
+    apply_filtering_to_vcf(input_vcf, output_vcf, contig_index_to_name_map, error_probability_thresholds, posterior_data_loader, posterior_model, summary_writer=summary_writer, germline_mode=germline_mode)
+
+
+def scatter_posterior_data(artifact_model_path, test_dataset_file, contigs_table, input_vcf, output_shard, batch_size: int,
+                           num_workers: int, chunk_size: int, segmentation: Segmentation = Segmentation(),
+                           normal_segmentation: Segmentation = Segmentation(), normalization: Normalization = None,
+                           artifact_cache_file=None, precision: Precision = Precision.FP32):
+    """
+    run the artifact model on one shard of the dataset and VCF and save the posterior features of its variants
+    """
     print("Loading artifact model and test dataset")
+    contig_index_to_name_map = read_contigs_table(contigs_table)
+    model = load_model_unless_cached(artifact_model_path, artifact_cache_file, precision)
+    posterior_dataset = make_posterior_dataset(test_dataset_file, input_vcf, contig_index_to_name_map, model, batch_size,
+        num_workers=num_workers, chunk_size=chunk_size, segmentation=segmentation, normal_segmentation=normal_segmentation,
+        normalization=normalization, artifact_cache_file=artifact_cache_file)
+    print(f"Saving posterior features to {output_shard}")
+    posterior_dataset.save(output_shard)
+
+
+def gather_posterior_model(posterior_shards, output_model, initial_log_variant_prior: float, initial_log_artifact_prior: float,
+                           batch_size: int, num_spectrum_iterations: int, spectrum_learning_rate: float, tensorboard_dir,
+                           genomic_span: int, germline_mode: bool = False, no_germline_mode: bool = False, het_beta: float = None,
+                           full_batch_spectra: bool = False, max_spectrum_iterations: int = 1000,
+                           spectrum_tolerance: float = DEFAULT_SPECTRUM_TOLERANCE, make_roc_plots: bool = True):
+    """
+    fit priors, spectra, and thresholds to the posterior features of all shards and save them
+    """
+    print("Loading posterior feature shards")
+    posterior_dataset = PosteriorDataset.load(posterior_shards)
+    print(f"Size of filtering dataset: {len(posterior_dataset)}")
+    posterior_model = PosteriorModel(initial_log_variant_prior, initial_log_artifact_prior, no_germline_mode=no_germline_mode,
+        num_base_features=posterior_dataset.embeddings.shape[1], het_beta=het_beta)
+    posterior_data_loader = make_posterior_data_loader(posterior_dataset, batch_size)
+
+    summary_writer = SummaryWriter(tensorboard_dir)
+    error_probability_thresholds = fit_posterior_model(posterior_model, posterior_data_loader, genomic_span, summary_writer,
+        num_spectrum_iterations=num_spectrum_iterations, spectrum_learning_rate=spectrum_learning_rate, full_batch_spectra=full_batch_spectra,
+        max_spectrum_iterations=max_spectrum_iterations, spectrum_tolerance=spectrum_tolerance, germline_mode=germline_mode,
+        make_roc_plots=make_roc_plots)
+    summary_writer.close()
+    posterior_model.save_model(output_model, error_probability_thresholds, germline_mode=germline_mode)
+
+
+def annotate_vcf_shard(posterior_model_path, posterior_shard, contigs_table, input_vcf, output_vcf, batch_size: int, tensorboard_dir):
+    """
+    filter the VCF of one shard with a gathered posterior model and the shard's posterior features
+    """
+    contig_index_to_name_map = read_contigs_table(contigs_table)
+    posterior_model, error_probability_thresholds, germline_mode = load_posterior_model(posterior_model_path, device=gpu_if_available())
+    posterior_data_loader = make_posterior_data_loader(PosteriorDataset.load([posterior_shard], shuffle=False), batch_size)
+    summary_writer = SummaryWriter(tensorboard_dir)
+    apply_filtering_to_vcf(input_vcf, output_vcf, contig_index_to_name_map, error_probability_thresholds, posterior_data_loader,
+                           posterior_model, summary_writer=summary_writer, germline_mode=germline_mode)
+
+
+def load_model_unless_cached(artifact_model_path, artifact_cache_file=None, precision: Precision = Precision.FP32) -> ArtifactModel:
+    # if the artifact model outputs are cached we never need the model
+    if artifact_cache_file is not None and os.path.exists(artifact_cache_file):
+        return None
+    if is_compiled_artifact_model(artifact_model_path):
+        if precision != Precision.FP32:
+            raise Exception("compiled artifact models run in fp32")
+        return CompiledArtifactModel(artifact_model_path)
+    model, _, _ = load_model(artifact_model_path, device=gpu_if_available())
+    model.set_precision(precision)
+    return model
+
+
+def read_contigs_table(contigs_table):
     contig_index_to_name_map = {}
     with open(contigs_table) as file:
         while line := file.readline().strip():
             contig, index = line.split()
             contig_index_to_name_map[int(index)] = contig
+    return contig_index_to_name_map
 
-    device = gpu_if_available()
-    model, artifact_log_priors, artifact_spectra_state_dict = load_model(artifact_model_path, device=device)
-
-    posterior_model = PosteriorModel(initial_log_variant_prior, initial_log_artifact_prior, no_germline_mode=no_germline_mode, num_base_features=model.pooling_dimension(), het_beta=het_beta)
-    posterior_data_loader = make_posterior_data_loader(test_dataset_file, input_vcf, contig_index_to_name_map,
-        model, batch_size, num_workers=num_workers, chunk_size=chunk_size, segmentation=segmentation, normal_segmentation=normal_segmentation)
 
+def fit_posterior_model(posterior_model: PosteriorModel, posterior_data_loader, genomic_span: int, summary_writer: SummaryWriter,
+                        num_spectrum_iterations: int, spectrum_learning_rate: float, full_batch_spectra: bool = False,
+                        max_spectrum_iterations: int = 1000, spectrum_tolerance: float = DEFAULT_SPECTRUM_TOLERANCE,
+                        germline_mode: bool = False, make_roc_plots: bool = True):
+    """
+    learn priors and AF spectra and return the error probability thresholds for each variant type
+    """
     print("Learning AF spectra")
-    summary_writer = SummaryWriter(tensorboard_dir)
-
     num_ignored_sites = genomic_span - len(posterior_data_loader.dataset)
     # here is where pretrained artifact priors and spectra are used if given
 
-    posterior_model.learn_priors_and_spectra(posterior_data_loader, num_iterations=num_spectrum_iterations,
-        summary_writer=summary_writer, ignored_to_non_ignored_ratio=num_ignored_sites/len(posterior_data_loader.dataset),
-                                             learning_rate=spectrum_learning_rate)
+    ignored_to_non_ignored_ratio = num_ignored_sites / len(posterior_data_loader.dataset)
+    if full_batch_spectra:
+        posterior_model.learn_priors_and_spectra_full_batch(posterior_data_loader.dataset, max_iterations=max_spectrum_iterations,
+            ignored_to_non_ignored_ratio=ignored_to_non_ignored_ratio, summary_writer=summary_writer,
+            learning_rate=spectrum_learning_rate, tolerance=spectrum_tolerance)
+    else:
+        posterior_model.learn_priors_and_spectra(posterior_data_loader, num_iterations=num_spectrum_iterations,
+            summary_writer=summary_writer, ignored_to_non_ignored_ratio=ignored_to_non_ignored_ratio, learning_rate=spectrum_learning_rate)
 
     print("Calculating optimal logit threshold")
-    error_probability_thresholds = posterior_model.calculate_probability_thresholds(posterior_data_loader, summary_writer, germline_mode=germline_mode)
+    error_probability_thresholds = posterior_model.calculate_probability_thresholds(posterior_data_loader, summary_writer,
+        germline_mode=germline_mode, make_plots=make_roc_plots)
     print(f"Optimal probability threshold: {error_probability_thresholds}")
-    apply_filtering_to_vcf(input_vcf, output_vcf, contig_index_to_name_map, error_probability_thresholds, posterior_data_loader, posterior_model, summary_writer=summary_writer, germline_mode=germline_mode)
+    return error_probability_thresholds
+
+
+def make_posterior_data_loader(posterior_dataset: PosteriorDataset, batch_size: int):
+    # if it fits, keep the whole dataset on the GPU so that every pass over it is just slicing
+    if torch.cuda.is_available() and posterior_dataset.size_in_bytes() < POSTERIOR_DATASET_GPU_MEMORY_FRACTION * torch.cuda.mem_get_info()[0]:
+        posterior_dataset.to(gpu_if_available())
+    return posterior_dataset.make_data_loader(batch_size, pin_memory=torch.cuda.is_available())
 
 
 @torch.inference_mode()
-def make_posterior_data_loader(dataset_file, input_vcf, contig_index_to_name_map, model: ArtifactModel,
-                               batch_size: int, num_workers: int, chunk_size: int, segmentation=defaultdict(IntervalTree), normal_segmentation=defaultdict(IntervalTree)):
+def make_posterior_dataset(dataset_file, input_vcf, contig_index_to_name_map, model: ArtifactModel,
+                           batch_size: int, num_workers: int, chunk_size: int, segmentation: Segmentation = Segmentation(), normal_segmentation: Segmentation = Segmentation(),
+                           normalization: Normalization = None, artifact_cache_file=None) -> PosteriorDataset:
+    """
+    The model may be None if its outputs for the dataset are already in the artifact cache file.
+    """
     print("Reading test dataset")
 
-    m2_filtering_to_keep = set()
-    allele_frequencies = {}
-
     print("recording M2 filters and allele frequencies from input VCF")
-    pbar = tqdm(enumerate(cyvcf2.VCF(input_vcf)), mininterval=60)
-    for n, v in pbar:
-        encoding = encode_variant(v, zero_based=True)
-        if filters_to_keep_from_m2(v):
-            m2_filtering_to_keep.add(encoding)
-        allele_frequencies[encoding] = 10 ** (-get_first_numeric_element(v, "POPAF"))
-
-    # pass through the plain text dataset, normalizing and creating ReadSetDatasets as we go, running the artifact model
-    # to get artifact logits, which we record in a dict keyed by variant strings.  These will later be added to PosteriorDatum objects.
-    print("reading dataset and calculating artifact logits")
+    contig_name_to_index = {name: index for index, name in contig_index_to_name_map.items()}
+    vcf_keys, allele_frequencies, m2_filtered = [], [], []
+    for records in tqdm(generate_vcf_chunks(cyvcf2.VCF(input_vcf)), mininterval=60):
+        vcf_keys.append(variant_keys_from_vcf_records(records, contig_name_to_index))
+        allele_frequencies.extend(10 ** (-get_first_numeric_element(v, "POPAF")) for v in records)
+        m2_filtered.extend(bool(filters_to_keep_from_m2(v)) for v in records)
+    vcf_keys = np.concatenate(vcf_keys) if vcf_keys else np.zeros(0, dtype=VARIANT_KEY_DTYPE)
+    vcf_index = VariantKeyIndex(vcf_keys)
+    allele_frequencies = np.array(allele_frequencies, dtype=np.float32)
+    m2_filtered_index = VariantKeyIndex(vcf_keys[np.array(m2_filtered, dtype=bool)])
+
+    # pass through the plain text dataset as a pipeline of concurrent stages connected by bounded queues:
+    # 1) parsing and normalizing chunks, 2) collating batches and running the artifact model, and 3) (here in the
+    # calling thread) assembling posterior data arrays from each batch of model output.  If the model outputs are
+    # cached, the first two stages are replaced by reading the cache.
     report_memory_usage("Loading data.")
-    posterior_data = []
-    for list_of_base_data in plain_text_data.generate_normalized_data([dataset_file], chunk_size):
+    if artifact_cache_file is not None and os.path.exists(artifact_cache_file):
+        print(f"reading cached artifact logits from {artifact_cache_file}")
+        model_outputs = generate_cached_artifact_model_outputs(artifact_cache_file, batch_size)
+    else:
+        print("reading dataset and calculating artifact logits")
+        normalized_chunks = background_generator(plain_text_data.generate_normalized_data([dataset_file], chunk_size,
+            normalization=normalization), depth=PIPELINE_CHUNK_QUEUE_DEPTH)
+        model_outputs = background_generator(generate_artifact_model_outputs(normalized_chunks, model, batch_size, num_workers),
+            depth=PIPELINE_BATCH_QUEUE_DEPTH)
+        if artifact_cache_file is not None:
+            model_outputs = cache_artifact_model_outputs(model_outputs, artifact_cache_file, model.pooling_dimension())
+
+    data_arrays, float_arrays, embeddings = [], [], []
+    for data_be, artifact_logits_b, features_be in tqdm(model_outputs, mininterval=60):
+        kept_data_be, float_array_be, kept_features_be = assemble_posterior_arrays(data_be, artifact_logits_b, features_be,
+            contig_index_to_name_map, vcf_index, allele_frequencies, m2_filtered_index, segmentation, normal_segmentation)
+        data_arrays.append(kept_data_be)
+        float_arrays.append(float_array_be)
+        embeddings.append(kept_features_be)
+
+    print(f"Size of filtering dataset: {sum(len(arr) for arr in data_arrays)}")
+    if not data_arrays:     # eg a shard with no variants
+        data_arrays, float_arrays = [np.zeros((0, Datum.NUM_SCALAR_ELEMENTS), dtype=np.int64)], [np.zeros((0, PosteriorBatch.NUM_FLOATS), dtype=np.float32)]
+        feature_dimension = cached_feature_dimension(artifact_cache_file) if model is None else model.pooling_dimension()
+        embeddings = [torch.zeros(0, feature_dimension)]
+    posterior_dataset = PosteriorDataset(np.vstack(data_arrays), np.vstack(float_arrays), torch.vstack(embeddings))
+    report_memory_usage("Finished creating PosteriorDataset.")
+    return posterior_dataset
+
+
+@torch.inference_mode()
+def generate_artifact_model_outputs(normalized_chunks, model: ArtifactModel, batch_size: int, num_workers: int):
+    """
+    run the artifact model over chunks of normalized data, yielding (datum arrays, artifact logits, features) on the CPU
+    for each batch
+    """
+    for list_of_base_data in normalized_chunks:
         report_memory_usage("Creating BaseDataset.")
         dataset = ReadsDataset(data_in_ram=list_of_base_data)
         loader = dataset.make_data_loader(dataset.all_folds(), batch_size, pin_memory=torch.cuda.is_available(), num_workers=num_workers)
 
-        print("creating posterior data for this chunk...")
         batch: ReadsBatch
-        for batch in tqdm(prefetch_generator(loader), mininterval=60, total=len(loader)):
+        for batch in prefetch_generator(loader):
             artifact_logits_b, _, _, features_be = model.calculate_logits(batch)
-
-            for datum_array, logit, embedding in zip(batch.get_data_be(),
-                    artifact_logits_b.detach().tolist(), features_be.cpu()):
-                datum = Datum(datum_array)
-                contig_name = contig_index_to_name_map[datum.get_contig()]
-                position = datum.get_position()
-                encoding = encode(contig_name, position, datum.get_ref_allele(), datum.get_alt_allele())
-                if encoding in allele_frequencies and encoding not in m2_filtering_to_keep:
-                    allele_frequency = allele_frequencies[encoding]
-
-                    # these are default dicts, so if there's no segmentation for the contig we will get no overlaps but not an error
-                    # For a general IntervalTree there is a list of potentially multiple overlaps but here there is either one or zero
-                    segmentation_overlaps = segmentation[contig_name][position]
-                    normal_segmentation_overlaps = normal_segmentation[contig_name][position]
-                    maf = list(segmentation_overlaps)[0].data if segmentation_overlaps else 0.5
-                    normal_maf = list(normal_segmentation_overlaps)[0].data if normal_segmentation_overlaps else 0.5
-
-                    posterior_datum = PosteriorDatum(datum_array, allele_frequency, logit, maf, normal_maf, embedding)
-                    posterior_data.append(posterior_datum)
-
-    print(f"Size of filtering dataset: {len(posterior_data)}")
-    posterior_dataset = PosteriorDataset(posterior_data)
-    report_memory_usage("Finished creating PosteriorDataset.")
-    return posterior_dataset.make_data_loader(batch_size, pin_memory=torch.cuda.is_available(), num_workers=num_workers)
+            yield batch.get_data_be(), artifact_logits_b.float().cpu().numpy(), features_be.cpu()
+
+
+def assemble_posterior_arrays(data_be: np.ndarray, artifact_logits_b: np.ndarray, features_be: torch.Tensor, contig_index_to_name_map,
+                              vcf_index: VariantKeyIndex, allele_frequencies_v: np.ndarray, m2_filtered_index: VariantKeyIndex,
+                              segmentation: Segmentation, normal_segmentation: Segmentation):
+    """
+    for one batch of artifact model output, select the data that are in the input VCF and not filtered by Mutect2 and
+    return their datum arrays, (allele frequency, artifact logit, maf, normal maf) rows, and embeddings.  The allele
+    frequencies are indexed by the rows of the VCF index.
+    """
+    keys_b = variant_keys_from_data_array(data_be)
+    vcf_rows_b = vcf_index.find(keys_b)
+    keep_b = (vcf_rows_b >= 0) & ~m2_filtered_index.contains(keys_b)
+    contigs, positions = data_be[keep_b, Datum.CONTIG_IDX], data_be[keep_b, Datum.POSITION_IDX]
+
+    float_array_b4 = np.empty((len(contigs), PosteriorBatch.NUM_FLOATS), dtype=np.float32)
+    float_array_b4[:, PosteriorBatch.ALLELE_FREQUENCY] = allele_frequencies_v[vcf_rows_b[keep_b]]
+    float_array_b4[:, PosteriorBatch.ARTIFACT_LOGIT] = artifact_logits_b[keep_b]
+    float_array_b4[:, PosteriorBatch.MAF] = segmentation.get_mafs_by_contig_index(contigs, positions, contig_index_to_name_map)
+    float_array_b4[:, PosteriorBatch.NORMAL_MAF] = normal_segmentation.get_mafs_by_contig_index(contigs, positions, contig_index_to_name_map)
+    return data_be[keep_b], float_array_b4, features_be[torch.from_numpy(keep_b)]
+
+
+def generate_vcf_chunks(vcf, chunk_size: int = VCF_CHUNK_SIZE):
+    """
+    yield lists of consecutive records of a VCF, so that their keys can be computed and looked up together
+    """
+    chunk = []
+    for v in vcf:
+        chunk.append(v)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
 
 
 # error probability thresholds is a dict from Variant type to error probability threshold (float)
 @torch.inference_mode()
 def apply_filtering_to_vcf(input_vcf, output_vcf, contig_index_to_name_map, error_probability_thresholds,
                            posterior_loader, posterior_model, summary_writer: SummaryWriter, germline_mode: bool = False):
+    """
+    First compute the posterior results of every datum batch by batch, formatting their INFO fields and deciding their
+    filters up front, then annotate the input VCF in a single streaming pass.  If the output path ends in .gz the output
+    is bgzipped and tabix-indexed.
+    """
     print("Computing final error probabilities")
     passing_call_type = Call.GERMLINE if germline_mode else Call.SOMATIC
     evaluation_metrics = EvaluationMetrics(num_sources=1)
+    embedding_metrics = EmbeddingMetrics()  # only if there is labeled truth for evaluation
+    thresholds_v = torch.tensor([error_probability_thresholds[var_type] for var_type in Variation])
 
     # Note: using BatchIndexedTotals in a hacky way, with Call replacing Source!
     artifact_logit_metrics = AccuracyMetrics.create(num_sources=len(Call))
-    encoding_to_posterior_results = {}
+
+    # row n of the annotations is the tab-separated INFO values and the error call (or -1 if passing) of the nth datum,
+    # whose variant key is the nth key
+    data_keys = []
+    info_strings, error_calls = [], []
+    labeled_truth = False
 
     batch: PosteriorBatch
     for batch in tqdm(prefetch_generator(posterior_loader), mininterval=60, total=len(posterior_loader)):
@@ -273,32 +526,43 @@ def apply_filtering_to_vcf(input_vcf, output_vcf, contig_index_to_name_map, erro
         artifact_logit_metrics.record_with_sources_and_logits(batch, values=most_confident_probs_b,
             sources_override=most_confident_calls_b, logits=batch.get_artifact_logits())
 
-        artifact_logits = batch.get_artifact_logits().cpu().tolist()
-        data = [Datum(datum_array) for datum_array in batch.get_data_be()]
-        for datum, post_probs, logit, log_prior, log_spec, log_normal, embedding in zip(data, posterior_probs_bc, artifact_logits, log_priors_bc, spectra_log_lks_bc, normal_log_lks_bc, batch.embeddings):
-            encoding = encode_datum(datum, contig_index_to_name_map)
-            encoding_to_posterior_results[encoding] = PosteriorResult(artifact_logit=logit, posterior_probabilities=post_probs.tolist(),
-                log_priors=log_prior, spectra_lls=log_spec, normal_lls=log_normal, label=datum.get_label(),
-                alt_count=datum.get_original_alt_count(), depth=datum.get_original_depth(), var_type=datum.get_variant_type(), embedding=embedding)
+        # the error call is the error type with the largest posterior probability
+        data_be = batch.get_data_be()
+        var_types_b = data_be[:, Datum.VARIANT_TYPE_IDX]
+        called_as_error_b = (error_probs_b.cpu() > thresholds_v[var_types_b]).numpy()
+        error_calls_b = torch.argmax(posterior_probs_bc.index_fill(1, torch.tensor([passing_call_type], device=posterior_probs_bc.device), -1), dim=1).cpu().numpy()
+
+        data_keys.append(variant_keys_from_data_array(data_be))
+        error_calls.append(np.where(called_as_error_b, error_calls_b, -1).astype(np.int8))
+        info_strings.extend(format_info_strings(posterior_probs_bc, log_priors_bc, spectra_log_lks_bc,
+            batch.get_artifact_logits(), normal_log_lks_bc))
+
+        labels_b = data_be[:, Datum.LABEL_IDX]
+        labeled_truth = labeled_truth or bool(np.any(labels_b != Label.UNLABELED))
+        correctness_labels, mistakes = evaluate_calls(labels_b, called_as_error_b, error_calls_b)
+        for n in mistakes:
+            # TODO: this is only right for somatic calling
+            bad_call = list(Call)[error_calls_b[n]] if called_as_error_b[n] else Call.SOMATIC
+            evaluation_metrics.record_mistake(PosteriorResult(artifact_logit=batch.get_artifact_logits()[n].item(),
+                posterior_probabilities=posterior_probs_bc[n].tolist(), log_priors=log_priors_bc[n], spectra_lls=spectra_log_lks_bc[n],
+                normal_lls=normal_log_lks_bc[n], label=labels_b[n], alt_count=data_be[n, Datum.ORIGINAL_ALT_COUNT_IDX],
+                depth=data_be[n, Datum.ORIGINAL_DEPTH_IDX], var_type=var_types_b[n], embedding=batch.embeddings[n]), bad_call)
+
+        # note that this excludes the correctness part of embedding metrics, which is below
+        truncated_alt_counts_b = np.minimum(data_be[:, Datum.ORIGINAL_ALT_COUNT_IDX], MAX_ALT_COUNT)
+        embedding_metrics.label_metadata.extend(Label(label).name for label in labels_b.tolist())
+        embedding_metrics.type_metadata.extend(Variation(var_type).name for var_type in var_types_b.tolist())
+        embedding_metrics.truncated_count_metadata.extend(alt_count_bin_name(alt_count_bin_index(count)) for count in truncated_alt_counts_b.tolist())
+        embedding_metrics.features.append(batch.embeddings.cpu())
+        embedding_metrics.correct_metadata.extend(correctness_labels)
+
+    error_calls = np.concatenate(error_calls) if error_calls else np.zeros(0, dtype=np.int8)
+    data_index = VariantKeyIndex(np.concatenate(data_keys) if data_keys else np.zeros(0, dtype=VARIANT_KEY_DTYPE))
+    contig_name_to_index = {name: index for index, name in contig_index_to_name_map.items()}
 
     print("Applying threshold")
     unfiltered_vcf = cyvcf2.VCF(input_vcf)
 
-    # This is specific to Mutect2, which outputs a line:
-    # ##tumor_sample=___________
-    tumor_sample_name = ""
-    all_samples = []
-    for header_line in unfiltered_vcf.raw_header.split('\n'):
-        if header_line.startswith('##tumor_sample'):
-            tumor_sample_name = print(header_line.split('=')[-1])
-        elif header_line.startswith('#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\t'):
-            all_samples = header_line.lstrip('#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\t').split()
-    tumor_sample_index = 0
-    for n, sample in enumerate(all_samples):
-        if sample == tumor_sample_name:
-            print(f"tumor sample found in VCF header: name {sample}, index {n}")
-            tumor_sample_index = n
-
     all_types = [call_type.name for call_type in Call]
     unfiltered_vcf.add_format_to_header( {'ID': "DP", 'Description': "depth", 'Type': 'Integer', 'Number': '1'})
     unfiltered_vcf.add_info_to_header({'ID': POST_PROB_INFO_KEY, 'Description': 'Mutect3 posterior probability of {' + ', '.join(all_types) + '}',
@@ -316,88 +580,30 @@ def apply_filtering_to_vcf(input_vcf, output_vcf, contig_index_to_name_map, erro
         if n != passing_call_type:
             unfiltered_vcf.add_filter_to_header({'ID': filter_name, 'Description': filter_name})
 
-    writer = cyvcf2.Writer(output_vcf, unfiltered_vcf)  # input vcf is a template for the header
-    pbar = tqdm(enumerate(unfiltered_vcf), mininterval=60)
-    labeled_truth = False
-    embedding_metrics = EmbeddingMetrics() # only if there is labeled truth for evaluation
-
-    missing_encodings = []
-    for n, v in pbar:
-        filters = filters_to_keep_from_m2(v)
-
-        # TODO: in germline mode, somatic doesn't exist (or is just highly irrelevant) and germline is not an error!
-        encoding = encode_variant(v, zero_based=True)  # cyvcf2 is zero-based
-        if encoding in encoding_to_posterior_results:
-            posterior_result = encoding_to_posterior_results[encoding]
-            post_probs = posterior_result.posterior_probabilities
-            v.INFO[POST_PROB_INFO_KEY] = ','.join(map(lambda prob: "{:.3f}".format(prob), post_probs))
-            v.INFO[LOG_PRIOR_INFO_KEY] = ','.join(map(lambda pri: "{:.3f}".format(pri), posterior_result.log_priors))
-            v.INFO[SPECTRA_LOG_LIKELIHOOD_INFO_KEY] = ','.join(map(lambda ll: "{:.3f}".format(ll), posterior_result.spectra_lls))
-            v.INFO[ARTIFACT_LOD_INFO_KEY] = "{:.3f}".format(posterior_result.artifact_logit)
-            v.INFO[NORMAL_LOG_LIKELIHOOD_INFO_KEY] = ','.join(map(lambda ll: "{:.3f}".format(ll), posterior_result.normal_lls))
-
-            label = Label(posterior_result.label)    # this is the Label enum, might be UNLABELED
-            error_prob = 1 - post_probs[passing_call_type]
-            variant_type = find_variant_type(v)
-            called_as_error = error_prob > error_probability_thresholds[variant_type]
-
-            error_call = None
-
-            if called_as_error:
-                # get the error type with the largest posterior probability
-                highest_prob_indices = torch.topk(torch.tensor(post_probs), 2).indices.tolist()
-                highest_prob_index = highest_prob_indices[1] if highest_prob_indices[0] == passing_call_type else highest_prob_indices[0]
-                error_call = list(Call)[highest_prob_index]
-                filters.add(FILTER_NAMES[highest_prob_index])
-
-            # note that this excludes the correctness part of embedding metrics, which is below
-            embedding_metrics.label_metadata.append(label.name)
-            embedding_metrics.type_metadata.append(variant_type.name)
-            embedding_metrics.truncated_count_metadata.append(alt_count_bin_name(alt_count_bin_index(min(MAX_ALT_COUNT, posterior_result.alt_count))))
-            embedding_metrics.features.append(posterior_result.embedding)
-
-            correctness_label = "unknown"
-            if label != Label.UNLABELED:
-                labeled_truth = True
-                clipped_error_prob = 0.5 + 0.9999999 * (error_prob - 0.5)
-                error_logit = prob_to_logit(clipped_error_prob)
-
-                # TODO: this is sloppy -- it only works because when we label the posterior dataset (if truth is available)
-                # TODO: we stretch the definitions so that "Label.ARTIFACT" simply means "something we shouldn't call", including
-                # TODO: artifact or germline (in the somatic calling case), and "Label.VARIANT" means "something we should call"
-                is_correct = (called_as_error and label == Label.ARTIFACT) or (not called_as_error and label == Label.VARIANT)
-
-                # TODO: double-check the logic here
-                if is_correct:
-                    if label == Label.VARIANT:
-                        correctness_label = EmbeddingMetrics.TRUE_POSITIVE
-                    elif error_call == Call.ARTIFACT or error_call == Call.NORMAL_ARTIFACT:
-                        correctness_label = EmbeddingMetrics.TRUE_NEGATIVE_ARTIFACT
-                    #elif error_call == Call.SEQ_ERROR:
-                    #    correctness_label = EmbeddingMetrics.TRUE_NEGATIVE_SEQ_ERROR
-                    # we don't do anything for germline (in somatic mode) or seq error --
-                else:
-                    if called_as_error:
-                        if error_call == Call.ARTIFACT or error_call == Call.NORMAL_ARTIFACT:
-                            correctness_label = EmbeddingMetrics.FALSE_NEGATIVE_ARTIFACT
-                    else:
-                        correctness_label = EmbeddingMetrics.FALSE_POSITIVE
-                    # TODO: this is only right for somatic calling
-                    bad_call = error_call if called_as_error else Call.SOMATIC
-                    evaluation_metrics.record_mistake(posterior_result, bad_call)
-            embedding_metrics.correct_metadata.append(correctness_label)
-        else:
-            # It is possible due to various quirks of Mutect2 assembly and flags such as --genotype-germline-sites etc
-            # that a site with zero alt depth can end up in the output VCF.  However, Permutect exludes such sites from
-            # the test dataset.  Therefore, we manually check for such sites and make sure they get filtered!
-            total_alt_depth = np.sum(v.format('AD')[tumor_sample_index][1:])
-            filters.add(FILTER_NAMES[Call.SEQ_ERROR])
-            missing_encodings.append(encoding)
-        v.FILTER = ';'.join(filters) if filters else 'PASS'
-        writer.write_record(v)
+    writer = cyvcf2.Writer(output_vcf, unfiltered_vcf)  # input vcf is a template for the header; .gz output is bgzipped
+    for records in tqdm(generate_vcf_chunks(unfiltered_vcf), mininterval=60):
+        rows = data_index.find(variant_keys_from_vcf_records(records, contig_name_to_index)).tolist()
+        for v, row in zip(records, rows):
+            filters = filters_to_keep_from_m2(v)
+
+            # TODO: in germline mode, somatic doesn't exist (or is just highly irrelevant) and germline is not an error!
+            if row >= 0:
+                for key, value in zip(INFO_KEYS_IN_ORDER, info_strings[row].split('\t')):
+                    v.INFO[key] = value
+                if error_calls[row] >= 0:
+                    filters.add(FILTER_NAMES[error_calls[row]])
+            else:
+                # It is possible due to various quirks of Mutect2 assembly and flags such as --genotype-germline-sites etc
+                # that a site with zero alt depth can end up in the output VCF.  However, Permutect exludes such sites from
+                # the test dataset.  Therefore, we manually check for such sites and make sure they get filtered!
+                filters.add(FILTER_NAMES[Call.SEQ_ERROR])
+            v.FILTER = ';'.join(filters) if filters else 'PASS'
+            writer.write_record(v)
     print("closing resources")
     writer.close()
     unfiltered_vcf.close()
+    if output_vcf.endswith('.gz'):
+        index_vcf(output_vcf)
 
     embedding_metrics.output_to_summary_writer(summary_writer, is_filter_variants=True)
 
@@ -415,6 +621,51 @@ def apply_filtering_to_vcf(input_vcf, output_vcf, contig_index_to_name_map, erro
         evaluation_metrics.make_mistake_histograms(summary_writer)
 
 
+def format_info_strings(posterior_probs_bc: torch.Tensor, log_priors_bc: torch.Tensor, spectra_log_lks_bc: torch.Tensor,
+                        artifact_logits_b: torch.Tensor, normal_log_lks_bc: torch.Tensor):
+    """
+    the values of the INFO fields of each datum in a batch, in the order of INFO_KEYS_IN_ORDER, each formatted as
+    comma-separated numbers with three decimals, joined by tabs into a single string per datum
+    """
+    columns = [values.detach().cpu().float().numpy().reshape(len(artifact_logits_b), -1) for values in
+               (posterior_probs_bc, log_priors_bc, spectra_log_lks_bc, artifact_logits_b, normal_log_lks_bc)]
+    formatted_bk = np.char.mod('%.3f', np.hstack(columns))
+    separators = [(',' if col < width - 1 else '\t') for width in (column.shape[1] for column in columns) for col in range(width)]
+    result = formatted_bk[:, 0]
+    for k in range(1, formatted_bk.shape[1]):
+        result = np.char.add(np.char.add(result, separators[k - 1]), formatted_bk[:, k])
+    return result.tolist()
+
+
+def evaluate_calls(labels_b: np.ndarray, called_as_error_b: np.ndarray, error_calls_b: np.ndarray):
+    """
+    compare calls to labels, if any, returning the correctness label for embedding metrics of each datum and the
+    indices of mistakes
+    """
+    # TODO: this is sloppy -- it only works because when we label the posterior dataset (if truth is available)
+    # TODO: we stretch the definitions so that "Label.ARTIFACT" simply means "something we shouldn't call", including
+    # TODO: artifact or germline (in the somatic calling case), and "Label.VARIANT" means "something we should call"
+    labeled_b = labels_b != Label.UNLABELED
+    is_correct_b = (called_as_error_b & (labels_b == Label.ARTIFACT)) | (~called_as_error_b & (labels_b == Label.VARIANT))
+    artifact_call_b = (error_calls_b == Call.ARTIFACT) | (error_calls_b == Call.NORMAL_ARTIFACT)
+
+    # TODO: double-check the logic here
+    # we don't do anything for germline (in somatic mode) or seq error
+    correctness_labels_b = np.select(
+        [~labeled_b, is_correct_b & (labels_b == Label.VARIANT), is_correct_b & artifact_call_b, is_correct_b,
+         called_as_error_b & artifact_call_b, called_as_error_b],
+        [EmbeddingMetrics.UNKNOWN, EmbeddingMetrics.TRUE_POSITIVE, EmbeddingMetrics.TRUE_NEGATIVE_ARTIFACT, EmbeddingMetrics.UNKNOWN,
+         EmbeddingMetrics.FALSE_NEGATIVE_ARTIFACT, EmbeddingMetrics.UNKNOWN], default=EmbeddingMetrics.FALSE_POSITIVE)
+    return correctness_labels_b.tolist(), np.flatnonzero(labeled_b & ~is_correct_b).tolist()
+
+
+def index_vcf(vcf_gz):
+    # pysam is only needed for writing indexed output, so we import it lazily
+    import pysam
+    print("indexing output VCF")
+    pysam.tabix_index(vcf_gz, preset='vcf', force=True)
+
+
 def main():
     args = parse_arguments()
     main_without_parsing(args)
@@ -1,19 +1,25 @@
 import argparse
+import multiprocessing
 import os
-import tarfile
+import queue
 import tempfile
+from concurrent.futures import ProcessPoolExecutor
 from typing import List
 
 from permutect import constants
+from permutect.data.memory_mapped_data import MemoryMappedDataWriter
 from permutect.data.reads_datum import ReadsDatum
-from permutect.data.plain_text_data import generate_normalized_data
+from permutect.data.plain_text_data import generate_normalized_data, Normalization, NormalizationSketch, \
+    sketch_dataset_file, NORMALIZATION_FILE_NAME
 from permutect.misc_utils import ConsistentValue
 
 """
 This tool takes as input a list of text file Mutect3 training datasets, reads them in chunks that fit in memory,
-normalizes each chunk, outputs each chunk as a binary PyTorch file, and bundles the output as a tarfile.
+normalizes each chunk, and writes the chunks to a memory-mappable dataset tarfile (see permutect.data.memory_mapped_data).
 """
 
+QUEUE_POLLING_INTERVAL_SECONDS = 10
+
 
 def parse_arguments():
     parser = argparse.ArgumentParser(description='preprocess plain text training dataset into tarfile of nprmalized binary data')
@@ -25,27 +31,118 @@ def parse_arguments():
                         help='integer sources corresponding to plain text data files for distinguishing different sequencing conditions')
     parser.add_argument('--' + constants.OUTPUT_NAME, type=str, default=None, required=True,
                         help='path to output tarfile of training data')
+    parser.add_argument('--' + constants.NUM_WORKERS_NAME, type=int, default=0, required=False,
+                        help='number of worker processes, each normalizing one plain text file at a time.  0 means serial.')
+    parser.add_argument('--' + constants.TWO_PASS_NORMALIZATION_NAME, action='store_true',
+                        help='flag for fitting a single quantile normalization to all the data in a first pass, rather '
+                             'than fitting to each chunk.  The normalization is saved in the output tarfile.')
     return parser.parse_args()
 
 
-def do_work(training_datasets, training_output_file, chunk_size, sources: List[int]):
-    data_files = []
+def do_work(training_datasets, training_output_file, chunk_size, sources: List[int], num_workers: int = 0,
+            two_pass_normalization: bool = False):
     num_read_features, num_info_features, haplotypes_length = ConsistentValue(), ConsistentValue(), ConsistentValue()
 
-    # save all the lists of read sets to tempfiles. . .
-    for base_data_list in generate_normalized_data(training_datasets, max_bytes_per_chunk=chunk_size, sources=sources):
-        num_read_features.check(base_data_list[0].get_reads_re().shape[1])
-        num_info_features.check(base_data_list[0].get_info_1d().shape[0])
-        haplotypes_length.check(base_data_list[0].get_haplotypes_1d().shape[0])
-
-        with tempfile.NamedTemporaryFile(delete=False) as train_data_file:
-            ReadsDatum.save_list(base_data_list, train_data_file)
-            data_files.append(train_data_file.name)
-
-    # . . . and bundle them in a tarfile
-    with tarfile.open(training_output_file, "w") as train_tar:
-        for train_file in data_files:
-            train_tar.add(train_file, arcname=os.path.basename(train_file))
+    normalization = fit_normalization(training_datasets, chunk_size, num_workers) if two_pass_normalization else None
+
+    with tempfile.TemporaryDirectory() as temp_dir, MemoryMappedDataWriter(training_output_file) as writer:
+        if normalization is not None:
+            normalization_file = os.path.join(temp_dir, NORMALIZATION_FILE_NAME)
+            normalization.save(normalization_file)
+            writer.add_file(normalization_file, arcname=NORMALIZATION_FILE_NAME)
+
+        for base_data_list in generate_chunks(training_datasets, chunk_size, sources, num_workers, normalization):
+            first_datum = base_data_list[0]
+            num_read_features.check(first_datum.get_reads_re().shape[1])
+            num_info_features.check(first_datum.get_info_1d().shape[0])
+            haplotypes_length.check(first_datum.get_haplotypes_1d().shape[0])
+            writer.write(base_data_list)
+
+
+def fit_normalization(training_datasets, chunk_size, num_workers: int) -> Normalization:
+    """
+    first pass of two-pass normalization.  With more than one worker, each plain text file is sketched in its own
+    process and the sketches are merged.
+    """
+    print("Sketching the data for two-pass normalization")
+    if num_workers <= 1:
+        sketches = [sketch_dataset_file(dataset_file, chunk_size) for dataset_file in training_datasets]
+    else:
+        with multiprocessing.Pool(num_workers) as pool:
+            sketches = pool.starmap(sketch_dataset_file, [(dataset_file, chunk_size) for dataset_file in training_datasets])
+
+    merged_sketch = NormalizationSketch()
+    for sketch in sketches:
+        merged_sketch.merge(sketch)
+    return merged_sketch.fit()
+
+
+def generate_chunks(training_datasets, chunk_size, sources: List[int], num_workers: int, normalization: Normalization = None):
+    """
+    generate lists of normalized ReadsDatum, one list per chunk.  With more than one worker, plain text files are
+    sharded across a process pool, which passes chunks back via tempfiles, and chunks are generated in the order they
+    are finished.  Unless a fixed normalization is given, quantile transforms are fit separately for each
+    plain text file.
+    """
+    if num_workers <= 1:
+        for base_data_list in generate_normalized_data(training_datasets, max_bytes_per_chunk=chunk_size, sources=sources,
+                                                       normalization=normalization):
+            yield base_data_list
+        return
+
+    sources_by_file = [0 if sources is None else (sources[0] if len(sources) == 1 else sources[n]) for n in range(len(training_datasets))]
+    # unlike a multiprocessing.Pool, the executor notices if a worker dies abruptly (eg killed for running out of memory)
+    # and fails its futures, so that we raise instead of waiting forever for chunks that will never come
+    with multiprocessing.Manager() as manager, ProcessPoolExecutor(num_workers) as executor:
+        # bounded so that workers can't fill the disk with tempfiles faster than they are written to the output
+        chunk_queue = manager.Queue(maxsize=2 * num_workers)
+        futures = [executor.submit(normalize_file_to_chunk_files, dataset_file, source, chunk_size, chunk_queue, normalization)
+                   for dataset_file, source in zip(training_datasets, sources_by_file)]
+
+        num_files_finished = 0
+        while num_files_finished < len(training_datasets):
+            try:
+                chunk_file = chunk_queue.get(timeout=QUEUE_POLLING_INTERVAL_SECONDS)
+            except queue.Empty:
+                check_for_failed_workers(futures)
+                continue
+            if chunk_file is None:
+                num_files_finished += 1
+            else:
+                base_data_list = ReadsDatum.load_list(chunk_file)
+                os.remove(chunk_file)
+                yield base_data_list
+
+        for future in futures:
+            future.result()    # re-raise any exception from a worker
+
+
+def check_for_failed_workers(futures):
+    """
+    re-raise the exception of any worker that has failed, including a BrokenProcessPool if a worker process died
+    """
+    for future in futures:
+        if future.done() and future.exception() is not None:
+            raise future.exception()
+
+
+def normalize_file_to_chunk_files(dataset_file, source: int, chunk_size, chunk_queue, normalization: Normalization = None):
+    """
+    worker process function: normalize a single plain text file, put its chunk tempfile names on the queue, and put
+    None on the queue when finished, even if an exception occurs
+    """
+    try:
+        for base_data_list in generate_normalized_data([dataset_file], max_bytes_per_chunk=chunk_size, sources=[source],
+                                                       normalization=normalization):
+            chunk_queue.put(save_chunk_to_tempfile(base_data_list))
+    finally:
+        chunk_queue.put(None)
+
+
+def save_chunk_to_tempfile(base_data_list: List[ReadsDatum]) -> str:
+    with tempfile.NamedTemporaryFile(delete=False) as train_data_file:
+        ReadsDatum.save_list(base_data_list, train_data_file)
+    return train_data_file.name
 
 
 def main_without_parsing(args):
@@ -53,8 +150,10 @@ def main_without_parsing(args):
     training_datasets = getattr(args, constants.TRAINING_DATASETS_NAME)
     output_file = getattr(args, constants.OUTPUT_NAME)
     sources = getattr(args, constants.SOURCES_NAME)
+    num_workers = getattr(args, constants.NUM_WORKERS_NAME)
+    two_pass_normalization = getattr(args, constants.TWO_PASS_NORMALIZATION_NAME)
 
-    do_work(training_datasets, output_file, chunk_size, sources)
+    do_work(training_datasets, output_file, chunk_size, sources, num_workers, two_pass_normalization)
 
 
 def main():
@@ -1,7 +1,4 @@
 import argparse
-import os
-import tarfile
-import tempfile
 from typing import List
 
 from permutect.training.model_training import train_artifact_model
@@ -12,6 +9,7 @@ import torch
 from torch.utils.tensorboard import SummaryWriter
 
 from permutect import constants
+from permutect.data.memory_mapped_data import MemoryMappedDataWriter
 from permutect.data.reads_batch import ReadsBatch
 from permutect.data.reads_datum import ReadsDatum
 from permutect.data.prefetch_generator import prefetch_generator
@@ -19,7 +17,7 @@ from permutect.data.batch import BatchProperty
 from permutect.parameters import add_training_params_to_parser, TrainingParameters
 from permutect.data.reads_dataset import ReadsDataset
 from permutect.tools.refine_artifact_model import parse_training_params
-from permutect.misc_utils import report_memory_usage, StreamingAverage
+from permutect.misc_utils import report_memory_usage, StreamingAverage, init_distributed_from_environment, is_main_process
 from permutect.utils.enums import Label
 
 NUM_FOLDS = 3
@@ -130,12 +128,14 @@ def generate_pruned_data_for_all_folds(dataset: ReadsDataset, model: ArtifactMod
     use_gpu = torch.cuda.is_available()
 
     for pruning_fold in range(NUM_FOLDS):
-        summary_writer = SummaryWriter(tensorboard_dir + "/fold_" + str(pruning_fold))
+        summary_writer = SummaryWriter(tensorboard_dir + "/fold_" + str(pruning_fold)) if is_main_process() else None
         report_memory_usage(f"Pruning data from fold {pruning_fold} of {NUM_FOLDS}.")
 
         totals_l = dataset.totals_slvra.get_marginal((BatchProperty.LABEL,)) # totals by label
         label_art_frac = totals_l[Label.ARTIFACT].item() / (totals_l[Label.ARTIFACT].item() + totals_l[Label.VARIANT].item())
         train_artifact_model(model, dataset, training_params, summary_writer=summary_writer, training_folds=[pruning_fold])
+        if not is_main_process():
+            continue    # in data-parallel training the other processes only help to train
 
         # TODO: maybe this should be done by variant type and/or count
         # learn pruning thresholds on the held-out data
@@ -168,16 +168,9 @@ def generate_pruned_data_buffers(pruned_data_generator, max_bytes_per_chunk: int
 
 
 def make_pruned_training_dataset(pruned_data_buffer_generator, pruned_tarfile):
-    pruned_data_files = []
-    for base_data_list in pruned_data_buffer_generator:
-        with tempfile.NamedTemporaryFile(delete=False) as train_data_file:
-            ReadsDatum.save_list(base_data_list, train_data_file)
-            pruned_data_files.append(train_data_file.name)
-
-    # bundle them in a tarfile
-    with tarfile.open(pruned_tarfile, "w") as train_tar:
-        for train_file in pruned_data_files:
-            train_tar.add(train_file, arcname=os.path.basename(train_file))
+    with MemoryMappedDataWriter(pruned_tarfile) as writer:
+        for base_data_list in pruned_data_buffer_generator:
+            writer.write(base_data_list)
 
 
 def parse_arguments():
@@ -200,6 +193,8 @@ def parse_arguments():
 
 
 def main_without_parsing(args):
+    # data-parallel if launched as several processes, eg by torchrun
+    init_distributed_from_environment(getattr(args, constants.DISTRIBUTED_TIMEOUT_HOURS_NAME))
     training_params = parse_training_params(args)
 
     tensorboard_dir = getattr(args, constants.TENSORBOARD_DIR_NAME)
@@ -209,11 +204,17 @@ def main_without_parsing(args):
 
     model,  _, _ = load_model(getattr(args, constants.ARTIFACT_MODEL_NAME))
 
-    base_dataset = ReadsDataset(data_tarfile=original_tarfile, num_folds=NUM_FOLDS)
+    base_dataset = ReadsDataset(data_tarfile=original_tarfile, num_folds=NUM_FOLDS,
+                                memory_budget=getattr(args, constants.DATASET_MEMORY_BUDGET_NAME))
 
     # generate ReadSets passing pruning
     pruned_data_generator = generate_pruned_data_for_all_folds(base_dataset, model, training_params, tensorboard_dir)
 
+    if not is_main_process():
+        for _ in pruned_data_generator:     # trains on every fold but yields nothing
+            pass
+        return
+
     # generate List[ReadSet]s passing pruning
     pruned_data_buffer_generator = generate_pruned_data_buffers(pruned_data_generator, chunk_size)
 
@@ -11,7 +11,7 @@ from permutect.architecture.posterior_model import plot_artifact_spectra
 from permutect.data.reads_dataset import ReadsDataset
 from permutect.data.reads_datum import ReadsDatum
 from permutect.parameters import add_training_params_to_parser, parse_training_params
-from permutect.misc_utils import report_memory_usage
+from permutect.misc_utils import report_memory_usage, init_distributed_from_environment, is_main_process
 from permutect.utils.enums import Variation, Label
 
 
@@ -72,20 +72,25 @@ def parse_arguments():
 
 
 def main_without_parsing(args):
+    # data-parallel if launched as several processes, eg by torchrun
+    init_distributed_from_environment(getattr(args, constants.DISTRIBUTED_TIMEOUT_HOURS_NAME))
     training_params = parse_training_params(args)
     learn_artifact_spectra = getattr(args, constants.LEARN_ARTIFACT_SPECTRA_NAME)
     calibration_sources = getattr(args, constants.CALIBRATION_SOURCES_NAME)
     genomic_span = getattr(args, constants.GENOMIC_SPAN_NAME)
 
     tensorboard_dir = getattr(args, constants.TENSORBOARD_DIR_NAME)
-    summary_writer = SummaryWriter(tensorboard_dir)
+    summary_writer = SummaryWriter(tensorboard_dir) if is_main_process() else None
 
     # artifact models has already been trained.  We're just refining it here.
     model, _, _ = load_model(getattr(args, constants.PRETRAINED_ARTIFACT_MODEL_NAME))
     report_memory_usage("Creating ReadsDataset.")
-    dataset = ReadsDataset(data_tarfile=getattr(args, constants.TRAIN_TAR_NAME), num_folds=10)
+    dataset = ReadsDataset(data_tarfile=getattr(args, constants.TRAIN_TAR_NAME), num_folds=10,
+                           memory_budget=getattr(args, constants.DATASET_MEMORY_BUDGET_NAME))
 
     train_artifact_model(model, dataset, training_params, summary_writer, epochs_per_evaluation=10, calibration_sources=calibration_sources)
+    if not is_main_process():
+        return
 
     for var_type in Variation:
         cal_fig, cal_axes = model.feature_clustering.plot_distance_calibration(var_type=var_type, device=model._device, dtype=model._dtype)
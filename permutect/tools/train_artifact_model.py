@@ -5,12 +5,14 @@ from torch.utils.tensorboard import SummaryWriter
 from permutect import constants
 from permutect.architecture.artifact_model import ArtifactModel, load_model
 from permutect.training.model_training import train_artifact_model
-from permutect.misc_utils import gpu_if_available
+from permutect.misc_utils import gpu_if_available, init_distributed_from_environment, is_main_process
 from permutect.parameters import parse_training_params, parse_model_params, add_model_params_to_parser, add_training_params_to_parser
 from permutect.data.reads_dataset import ReadsDataset
 
 
 def main_without_parsing(args):
+    # data-parallel if launched as several processes, eg by torchrun
+    init_distributed_from_environment(getattr(args, constants.DISTRIBUTED_TIMEOUT_HOURS_NAME))
     params = parse_model_params(args)
     training_params = parse_training_params(args)
 
@@ -20,14 +22,17 @@ def main_without_parsing(args):
     pretrained_model, _, _ = (None, None, None) if pretrained_model_path is None else load_model(pretrained_model_path)
 
     tensorboard_dir = getattr(args, constants.TENSORBOARD_DIR_NAME)
-    summary_writer = SummaryWriter(tensorboard_dir)
-    dataset = ReadsDataset(data_tarfile=tarfile_data, num_folds=10)
+    summary_writer = SummaryWriter(tensorboard_dir) if is_main_process() else None
+    dataset = ReadsDataset(data_tarfile=tarfile_data, num_folds=10,
+                           memory_budget=getattr(args, constants.DATASET_MEMORY_BUDGET_NAME))
 
     model = pretrained_model if (pretrained_model is not None) else \
             ArtifactModel(params=params, num_read_features=dataset.num_read_features, num_info_features=dataset.num_info_features,
                           haplotypes_length=dataset.haplotypes_length, device=gpu_if_available())
 
     train_artifact_model(model, dataset, training_params, summary_writer=summary_writer, epochs_per_evaluation=10)
+    if not is_main_process():
+        return
     summary_writer.close()
 
     # TODO: this is currently wrong because we are using the separate artifact model, not the full model
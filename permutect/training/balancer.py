@@ -12,6 +12,7 @@ from permutect.data.batch import Batch, BatchIndexedTensor
 from permutect.data.reads_batch import ReadsBatch
 from permutect.data.count_binning import ALT_COUNT_BIN_BOUNDS, REF_COUNT_BIN_BOUNDS
 from permutect.metrics import plotting
+from permutect.misc_utils import is_distributed, all_reduce_sum
 from permutect.utils.enums import Label, Variation, Epoch
 
 
@@ -60,8 +61,17 @@ class Balancer(Module):
     def process_batch_and_compute_weights(self, batch: ReadsBatch):
         # this updates the counts that are used to compute weights, recomputes the weights, and returns the weights
         # increment counts by 1
-        batch.batch_indices().increment_tensor(self.counts_slvra, values=torch.ones(batch.size(), device=self.device))
-        self.count_since_last_recomputation += batch.size()
+        if is_distributed():
+            # add the counts of every process's batch so that all processes compute the same weights as a single
+            # process with their combined batch
+            increments_slvra = BatchIndexedTensor(torch.zeros_like(self.counts_slvra.data))
+            batch.batch_indices().increment_tensor(increments_slvra, values=torch.ones(batch.size(), device=self.device))
+            all_reduce_sum(increments_slvra)
+            self.counts_slvra.data += increments_slvra
+            self.count_since_last_recomputation += round(torch.sum(increments_slvra).item())
+        else:
+            batch.batch_indices().increment_tensor(self.counts_slvra, values=torch.ones(batch.size(), device=self.device))
+            self.count_since_last_recomputation += batch.size()
 
         if self.count_since_last_recomputation > Balancer.DATA_BEFORE_RECOMPUTE:
             art_to_nonart_ratios_svra = (self.counts_slvra[:, Label.ARTIFACT] + 0.01) / (self.counts_slvra[:, Label.VARIANT] + 0.01)
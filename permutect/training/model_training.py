@@ -22,15 +22,23 @@ from permutect.metrics.loss_metrics import LossMetrics
 from permutect.data.batch import BatchProperty
 from permutect.data.count_binning import alt_count_bin_index, round_alt_count_to_bin_center, alt_count_bin_name
 from permutect.parameters import TrainingParameters
-from permutect.misc_utils import report_memory_usage, backpropagate, freeze, unfreeze
-from permutect.utils.enums import Variation, Epoch, Label
+from permutect.misc_utils import report_memory_usage, backpropagate, freeze, unfreeze, is_distributed, is_main_process, \
+    broadcast_module
+from permutect.utils.enums import Variation, Epoch, Label, Precision
 
 WORST_OFFENDERS_QUEUE_SIZE = 100
 
 
 def train_artifact_model(model: ArtifactModel, dataset: ReadsDataset, training_params: TrainingParameters, summary_writer: SummaryWriter,
                          validation_fold: int = None, training_folds: List[int] = None, epochs_per_evaluation: int = None, calibration_sources: List[int] = None):
+    """
+    If a process group has been initialized, eg by init_distributed_from_environment, every process calls this with the
+    same dataset and training proceeds data-parallel: each process trains on its share of every batch, gradients, data
+    counts for balancing and loss metrics are summed over processes, and only the main process writes to the
+    summary writer, which may be None in the other processes.
+    """
     device, dtype = model._device, model._dtype
+    distributed, write_summaries = is_distributed(), is_main_process()
     bce = nn.BCEWithLogitsLoss(reduction='none')  # no reduction because we may want to first multiply by weights for unbalanced data
     ce = nn.CrossEntropyLoss(reduction='none')  # likewise
     balancer = Balancer(num_sources=dataset.num_sources(), device=device).to(device=device, dtype=dtype)
@@ -38,13 +46,19 @@ def train_artifact_model(model: ArtifactModel, dataset: ReadsDataset, training_p
 
     print("fitting downsampler parameters to the dataset")
     downsampler.optimize_downsampling_balance(dataset.totals_slvra.to(device=device))
+    broadcast_module(downsampler)
 
     num_sources = dataset.validate_sources()
     dataset.report_totals()
     model.reset_source_predictor(num_sources)
+    broadcast_module(model)     # processes start from identical parameters and, since gradients are summed, stay identical
     is_cuda = device.type == 'cuda'
     print(f"Is CUDA available? {is_cuda}")
 
+    model.set_precision(training_params.precision)
+    # fp16 gradients may underflow, so losses are scaled up before backpropagation.  bf16 has the range of fp32.
+    grad_scaler = torch.cuda.amp.GradScaler() if training_params.precision == Precision.FP16 else None
+
     train_optimizer = torch.optim.AdamW(model.parameters(), lr=training_params.learning_rate, weight_decay=training_params.weight_decay)
     train_scheduler = torch.optim.lr_scheduler.ReduceLROnPlateau(train_optimizer, factor=0.2, patience=5,
         threshold=0.001, min_lr=(training_params.learning_rate / 100), verbose=True)
@@ -52,18 +66,27 @@ def train_artifact_model(model: ArtifactModel, dataset: ReadsDataset, training_p
     validation_fold_to_use = (dataset.num_folds - 1) if validation_fold is None else validation_fold
     training_folds_to_use = dataset.all_but_one_fold(validation_fold_to_use) if training_folds is None else training_folds
 
-    train_loader = dataset.make_data_loader(training_folds_to_use, training_params.batch_size, is_cuda, training_params.num_workers)
+    shuffle_block_size, shuffle_window_size = training_params.shuffle_block_size, training_params.shuffle_window_size
+    # the read budget, if any, applies to training batches; validation batches have the inference batch size
+    read_budget, bucket_by_read_count = training_params.read_budget, training_params.bucket_by_read_count
+    train_loader = dataset.make_data_loader(training_folds_to_use, training_params.batch_size, is_cuda, training_params.num_workers,
+                                            shuffle_block_size=shuffle_block_size, shuffle_window_size=shuffle_window_size,
+                                            read_budget=read_budget, bucket_by_read_count=bucket_by_read_count, distributed=distributed)
     report_memory_usage(f"Train loader created.")
-    valid_loader = dataset.make_data_loader([validation_fold_to_use], training_params.inference_batch_size, is_cuda, training_params.num_workers)
+    valid_loader = dataset.make_data_loader([validation_fold_to_use], training_params.inference_batch_size, is_cuda, training_params.num_workers,
+                                            shuffle_block_size=shuffle_block_size, shuffle_window_size=shuffle_window_size, distributed=distributed)
     report_memory_usage(f"Validation loader created.")
 
     calibration_train_loader = train_loader if calibration_sources is None else \
         dataset.make_data_loader(training_folds_to_use, training_params.batch_size,
-                                 is_cuda, training_params.num_workers, sources_to_use=calibration_sources)
+                                 is_cuda, training_params.num_workers, sources_to_use=calibration_sources,
+                                 shuffle_block_size=shuffle_block_size, shuffle_window_size=shuffle_window_size,
+                                 read_budget=read_budget, bucket_by_read_count=bucket_by_read_count, distributed=distributed)
 
     calibration_valid_loader = valid_loader if calibration_sources is None else \
         dataset.make_data_loader([validation_fold_to_use], training_params.inference_batch_size,
-                                 is_cuda, training_params.num_workers, sources_to_use=calibration_sources)
+                                 is_cuda, training_params.num_workers, sources_to_use=calibration_sources,
+                                 shuffle_block_size=shuffle_block_size, shuffle_window_size=shuffle_window_size, distributed=distributed)
 
     first_epoch, last_epoch = 1, training_params.num_epochs + training_params.num_calibration_epochs
     for epoch in trange(1, last_epoch + 1, desc="Epoch"):
@@ -91,7 +114,8 @@ def train_artifact_model(model: ArtifactModel, dataset: ReadsDataset, training_p
                 (train_loader if epoch_type == Epoch.TRAIN else valid_loader)
 
             batch: ReadsBatch
-            for parent_batch in tqdm(prefetch_generator(loader), mininterval=60, total=len(loader)):
+            prefetcher = prefetch_generator(loader)
+            for parent_batch in tqdm(prefetcher, mininterval=60, total=len(loader)):
                 # TODO: really to get the assumed balance we should only train on downsampled batches.  But using one
                 # TODO: downsampled batch with the proper balance will still go a long way
                 ref_fracs_b, alt_fracs_b = downsampler.calculate_downsampling_fractions(parent_batch)
@@ -99,8 +123,7 @@ def train_artifact_model(model: ArtifactModel, dataset: ReadsDataset, training_p
                 ref_fracs_b, alt_fracs_b = downsampler.calculate_downsampling_fractions(parent_batch)
                 downsampled_batch2 = DownsampledReadsBatch(parent_batch, ref_fracs_b=ref_fracs_b, alt_fracs_b=alt_fracs_b)
                 batches = [downsampled_batch1, downsampled_batch2]
-                outputs = [model.compute_batch_output(batch, balancer) for batch in batches]
-                parent_output = model.compute_batch_output(parent_batch, balancer)
+                parent_output, *outputs = model.compute_batch_outputs_of_views(parent_batch, batches, balancer)
 
                 # distances to the second-nearest cluster (i.e. nearest wrong cluster, most likely) for normalizing
                 # the unsupervised consistency loss function
@@ -136,32 +159,41 @@ def train_artifact_model(model: ArtifactModel, dataset: ReadsDataset, training_p
                     alt_count_loss_metrics.record(batch, alt_count_losses_b, output.weights)
 
                 if epoch_type == Epoch.TRAIN:
-                    backpropagate(train_optimizer, loss)
+                    backpropagate(train_optimizer, loss, grad_scaler, distributed=distributed)
                 # done with this batch
             # done with one epoch type -- training or validation -- for this epoch
+            print(prefetcher.report())
+            # every process steps the scheduler with the loss over all processes' data
+            for metrics in (loss_metrics, alt_count_loss_metrics, source_prediction_loss_metrics):
+                metrics.all_reduce()
             if epoch_type == Epoch.TRAIN:
                 mean_over_labels = torch.mean(loss_metrics.get_marginal(BatchProperty.LABEL)).item()
                 train_scheduler.step(mean_over_labels)
 
-            loss_metrics.put_on_cpu()
-            alt_count_loss_metrics.put_on_cpu()
-            source_prediction_loss_metrics.put_on_cpu()
-            loss_metrics.write_to_summary_writer(epoch_type, epoch, summary_writer, prefix="semisupervised-loss")
-            alt_count_loss_metrics.write_to_summary_writer(epoch_type, epoch, summary_writer, prefix="alt-count-loss")
-            source_prediction_loss_metrics.write_to_summary_writer(epoch_type, epoch, summary_writer, prefix="source-loss")
-            loss_metrics.report_marginals(f"Semisupervised loss for {epoch_type.name} epoch {epoch}.")
-            source_prediction_loss_metrics.report_marginals(f"Source prediction loss for {epoch_type.name} epoch {epoch}.")
-
-            if (epochs_per_evaluation is not None and epoch % epochs_per_evaluation == 0) or (epoch == last_epoch):
-                balancer.make_plots(summary_writer, "log(label-balancing weights)", epoch_type, epoch, type_of_plot="weights")
-                balancer.make_plots(summary_writer, "unweighted data counts after downsampling", epoch_type, epoch, type_of_plot="counts")
-                loss_metrics.make_plots(summary_writer, "semisupervised loss", epoch_type, epoch)
-                loss_metrics.make_plots(summary_writer, "total weight of data vs alt and ref counts", epoch_type, epoch, type_of_plot="counts")
-                alt_count_loss_metrics.make_plots(summary_writer, "alt count prediction loss", epoch_type, epoch)
-                source_prediction_loss_metrics.make_plots(summary_writer, "source prediction loss", epoch_type, epoch)
-
+            is_evaluation_epoch = (epochs_per_evaluation is not None and epoch % epochs_per_evaluation == 0) or (epoch == last_epoch)
+            if write_summaries:
+                summary_writer.add_scalar(f"{epoch_type.name} fraction of time waiting on input", prefetcher.starved_fraction(), epoch)
+                loss_metrics.put_on_cpu()
+                alt_count_loss_metrics.put_on_cpu()
+                source_prediction_loss_metrics.put_on_cpu()
+                loss_metrics.write_to_summary_writer(epoch_type, epoch, summary_writer, prefix="semisupervised-loss")
+                alt_count_loss_metrics.write_to_summary_writer(epoch_type, epoch, summary_writer, prefix="alt-count-loss")
+                source_prediction_loss_metrics.write_to_summary_writer(epoch_type, epoch, summary_writer, prefix="source-loss")
+                loss_metrics.report_marginals(f"Semisupervised loss for {epoch_type.name} epoch {epoch}.")
+                source_prediction_loss_metrics.report_marginals(f"Source prediction loss for {epoch_type.name} epoch {epoch}.")
+
+                if is_evaluation_epoch:
+                    balancer.make_plots(summary_writer, "log(label-balancing weights)", epoch_type, epoch, type_of_plot="weights")
+                    balancer.make_plots(summary_writer, "unweighted data counts after downsampling", epoch_type, epoch, type_of_plot="counts")
+                    loss_metrics.make_plots(summary_writer, "semisupervised loss", epoch_type, epoch)
+                    loss_metrics.make_plots(summary_writer, "total weight of data vs alt and ref counts", epoch_type, epoch, type_of_plot="counts")
+                    alt_count_loss_metrics.make_plots(summary_writer, "alt count prediction loss", epoch_type, epoch)
+                    source_prediction_loss_metrics.make_plots(summary_writer, "source prediction loss", epoch_type, epoch)
+
+            if is_evaluation_epoch:
                 print(f"performing evaluation on epoch {epoch}")
                 if epoch_type == Epoch.VALID:
+                    # every process evaluates its share of the data
                     evaluate_model(model, epoch, dataset, balancer, downsampler, train_loader, valid_loader, summary_writer, collect_embeddings=False, report_worst=False)
 
         # done with training and validation for this epoch
@@ -169,7 +201,8 @@ def train_artifact_model(model: ArtifactModel, dataset: ReadsDataset, training_p
         print(f"Time elapsed(s): {time.time() - start_of_epoch:.1f}")
         # note that we have not learned the AF spectrum yet
     # done with training
-    record_embeddings(model, train_loader, summary_writer)
+    if write_summaries:
+        record_embeddings(model, train_loader, summary_writer)
 
 @torch.inference_mode()
 def collect_evaluation_data(model: ArtifactModel, dataset: ReadsDataset, balancer: Balancer, downsampler: Downsampler,
@@ -224,6 +257,9 @@ def evaluate_model(model: ArtifactModel, epoch: int, dataset: ReadsDataset, bala
 
     # self.freeze_all()
     evaluation_metrics, worst_offenders_by_label_and_alt_count = collect_evaluation_data(model, dataset, balancer, downsampler, train_loader, valid_loader, report_worst)
+    evaluation_metrics.all_reduce([Epoch.TRAIN, Epoch.VALID])
+    if not is_main_process():
+        return
     evaluation_metrics.put_on_cpu()
     evaluation_metrics.make_plots(summary_writer, epoch=epoch)
 
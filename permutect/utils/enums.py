@@ -27,6 +27,15 @@ class Call(enum.IntEnum):
     NORMAL_ARTIFACT = 4
 
 
+class Precision(enum.Enum):
+    """
+    floating point precision of autocast regions.  bf16 works on CPU and GPU, fp16 only on GPU
+    """
+    FP32 = "fp32"
+    BF16 = "bf16"
+    FP16 = "fp16"
+
+
 class Epoch(enum.IntEnum):
     TRAIN = 0
     VALID = 1
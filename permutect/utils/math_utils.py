@@ -58,4 +58,56 @@ def subtract_in_log_space(x: Tensor, y: Tensor):
     :return:
     """
     m = torch.maximum(x, y)
-    return m + torch.log(torch.exp(x-m) - torch.exp(y-m))
\ No newline at end of file
+    return m + torch.log(torch.exp(x-m) - torch.exp(y-m))
+
+
+def theoretical_f1_thresholds(error_probs_n: Tensor, groups_n: Tensor, num_groups: int):
+    """
+    For each group, eg variant type, find the error probability threshold that maximizes the expected F1 score, treating
+    error probabilities as calibrated, so that each datum contributes a fractional error and a fractional non-error.
+    Calling everything at or below the threshold as a non-error, the expected true positives are the sum of (1 - prob) and
+    the expected false positives the sum of prob over the data below the threshold.  This is the tensor version of
+    plotting.get_theoretical_roc_data, done for all groups at once.
+
+    :return: best thresholds, precisions, and sensitivities, each a 1D tensor of length num_groups.  Groups with no data
+    have a threshold of 0, precision of 1, and sensitivity of 0.
+    """
+    device, num_data = error_probs_n.device, len(error_probs_n)
+    thresholds_g = torch.zeros(num_groups, dtype=torch.float64, device=device)
+    precisions_g = torch.ones(num_groups, dtype=torch.float64, device=device)
+    sensitivities_g = torch.zeros(num_groups, dtype=torch.float64, device=device)
+    if num_data == 0:
+        return thresholds_g, precisions_g, sensitivities_g
+
+    # sort by probability, then stably by group, so that each group is a contiguous run of increasing probabilities
+    probs_n, order_n = torch.sort(error_probs_n.to(torch.float64), stable=True)
+    groups_n, group_order_n = torch.sort(groups_n.long()[order_n], stable=True)
+    probs_n = probs_n[group_order_n]
+
+    counts_g = torch.bincount(groups_n, minlength=num_groups)
+    totals_g = torch.zeros(num_groups, dtype=torch.float64, device=device).index_add_(0, groups_n, probs_n)
+    group_starts_n = (torch.cumsum(counts_g, dim=0) - counts_g)[groups_n]
+
+    # cumulative sums within each group are global cumulative sums minus the global cumulative sum before the group
+    cumsums_n = torch.cumsum(probs_n, dim=0)
+    fp_n = cumsums_n - (cumsums_n - probs_n)[group_starts_n]
+    num_called_n = (torch.arange(num_data, device=device) - group_starts_n + 1).to(torch.float64)
+    tp_n = num_called_n - fp_n
+
+    # the small constant in the total non-errors matches get_theoretical_roc_data
+    sensitivity_n = tp_n / (counts_g - totals_g + 0.0001)[groups_n]
+    precision_n = tp_n / num_called_n
+    harmonic_mean_n = torch.where(tp_n > 0, 1 / (1 / sensitivity_n + 1 / precision_n), 0)
+
+    # the first position of the (positive) maximum within each group
+    best_harmonic_mean_g = torch.zeros(num_groups, dtype=torch.float64, device=device).scatter_reduce_(0, groups_n, harmonic_mean_n, reduce='amax')
+    is_best_n = (harmonic_mean_n == best_harmonic_mean_g[groups_n]) & (harmonic_mean_n > 0)
+    positions_n = torch.where(is_best_n, torch.arange(num_data, device=device), num_data)
+    best_positions_g = torch.full((num_groups, ), num_data, device=device).scatter_reduce_(0, groups_n, positions_n, reduce='amin')
+
+    found_g = best_positions_g < num_data
+    best_positions = best_positions_g[found_g]
+    thresholds_g[found_g] = probs_n[best_positions]
+    precisions_g[found_g] = precision_n[best_positions]
+    sensitivities_g[found_g] = sensitivity_n[best_positions]
+    return thresholds_g, precisions_g, sensitivities_g
@@ -0,0 +1,66 @@
+from __future__ import annotations
+
+import numpy as np
+
+DEFAULT_MAF = 0.5
+
+
+class Segmentation:
+    """
+    Minor allele fractions of non-overlapping genomic segments, stored per contig as arrays of segment starts, stops
+    and mafs sorted by start.  A segment contains the positions start <= position < stop.  Positions not in any
+    segment, including those on contigs with no segments, have the default maf of 0.5.
+    """
+    def __init__(self, segments_by_contig=None):
+        # segments_by_contig is a dict from contig name to a list of (start, stop, maf) tuples
+        self.starts, self.stops, self.mafs = {}, {}, {}
+        for contig, segments in ({} if segments_by_contig is None else segments_by_contig).items():
+            segments = sorted(segment for segment in segments if segment[1] > segment[0])
+            self.starts[contig] = np.array([segment[0] for segment in segments], dtype=np.int64)
+            self.stops[contig] = np.array([segment[1] for segment in segments], dtype=np.int64)
+            self.mafs[contig] = np.array([segment[2] for segment in segments], dtype=np.float32)
+
+    @classmethod
+    def from_file(cls, segments_file) -> Segmentation:
+        """
+        read a GATK segmentation file, whose lines are contig, start, stop, maf, ...
+        """
+        if segments_file is None:
+            return cls()
+
+        print("reading segmentation file")
+        segments_by_contig = {}
+        with open(segments_file, 'r') as file:
+            for line in file:
+                if line.startswith("#") or (line.startswith("contig") and "minor_allele_fraction" in line):
+                    continue
+                tokens = line.split()
+                contig, start, stop, maf = tokens[0], int(tokens[1]), int(tokens[2]), float(tokens[3])
+                segments_by_contig.setdefault(contig, []).append((start, stop, maf))
+        return cls(segments_by_contig)
+
+    def get_mafs(self, contig: str, positions: np.ndarray) -> np.ndarray:
+        """
+        mafs of an array of positions on one contig
+        """
+        positions = np.asarray(positions, dtype=np.int64)
+        result = np.full(len(positions), DEFAULT_MAF, dtype=np.float32)
+        starts = self.starts.get(contig)
+        if starts is None or len(starts) == 0:
+            return result
+        segment_indices = np.searchsorted(starts, positions, side='right') - 1
+        clipped = np.maximum(segment_indices, 0)
+        in_segment = (segment_indices >= 0) & (positions < self.stops[contig][clipped])
+        result[in_segment] = self.mafs[contig][clipped[in_segment]]
+        return result
+
+    def get_mafs_by_contig_index(self, contigs: np.ndarray, positions: np.ndarray, contig_index_to_name_map) -> np.ndarray:
+        """
+        mafs of arrays of contig indices and positions, eg the contig and position columns of stacked datum arrays
+        """
+        contigs, positions = np.asarray(contigs), np.asarray(positions)
+        result = np.full(len(positions), DEFAULT_MAF, dtype=np.float32)
+        for contig in np.unique(contigs).tolist():
+            on_contig = contigs == contig
+            result[on_contig] = self.get_mafs(contig_index_to_name_map[contig], positions[on_contig])
+        return result
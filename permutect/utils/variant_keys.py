@@ -0,0 +1,93 @@
+import numpy as np
+
+from permutect.data.datum import Datum
+from permutect.utils.allele_utils import MAX_NUM_BASES_FOR_ENCODING, trim_alleles_on_right, bases_as_base5_int
+
+# A variant key packs a variant into 128 bits: the contig index in the high and the position in the low 32 bits of the
+# locus, and the base-5 encoding (as in Datum) of the right-trimmed, truncated alt allele.  Keys are compared
+# lexicographically, locus first.
+VARIANT_KEY_DTYPE = np.dtype([('locus', np.int64), ('allele', np.int64)])
+
+POSITION_BITS = 32
+
+# 5^k for k = 0 . . . MAX_NUM_BASES_FOR_ENCODING
+POWERS_OF_5 = 5 ** np.arange(MAX_NUM_BASES_FOR_ENCODING + 1, dtype=np.int64)
+
+
+def make_variant_keys(contigs, positions, alleles_base5) -> np.ndarray:
+    contigs, positions = np.asarray(contigs, dtype=np.int64), np.asarray(positions, dtype=np.int64)
+    result = np.empty(len(contigs), dtype=VARIANT_KEY_DTYPE)
+    result['locus'] = (contigs << POSITION_BITS) | positions
+    result['allele'] = alleles_base5
+    return result
+
+
+def base5_lengths(bases5: np.ndarray) -> np.ndarray:
+    # base-5 digits are 1-4, never 0, so a number of L bases lies in [5^(L-1), 5^L)
+    return np.sum(bases5[:, None] >= POWERS_OF_5[None, :], axis=1)
+
+
+def trimmed_alt_alleles_base5(ref_bases5: np.ndarray, alt_bases5: np.ndarray) -> np.ndarray:
+    """
+    vectorized trim_alleles_on_right of base-5 encoded ref and alt alleles, returning the encoded trimmed alts.  The last
+    base of an allele is its most significant base-5 digit.
+    """
+    ref, alt = np.array(ref_bases5, dtype=np.int64), np.array(alt_bases5, dtype=np.int64)
+    ref_lengths, alt_lengths = base5_lengths(ref), base5_lengths(alt)
+    for _ in range(MAX_NUM_BASES_FOR_ENCODING):
+        ref_place, alt_place = POWERS_OF_5[np.maximum(ref_lengths - 1, 0)], POWERS_OF_5[np.maximum(alt_lengths - 1, 0)]
+        ref_last, alt_last = ref // ref_place, alt // alt_place
+        trim = (ref_lengths > 1) & (alt_lengths > 1) & (ref_last == alt_last)
+        if not np.any(trim):
+            break
+        ref = np.where(trim, ref - ref_last * ref_place, ref)
+        alt = np.where(trim, alt - alt_last * alt_place, alt)
+        ref_lengths, alt_lengths = ref_lengths - trim, alt_lengths - trim
+    return alt
+
+
+def variant_keys_from_data_array(data_be: np.ndarray) -> np.ndarray:
+    """
+    keys of every row of a 2D array of stacked datum arrays
+    """
+    alts = trimmed_alt_alleles_base5(data_be[:, Datum.REF_ALLELE_AS_BASE_5_IDX], data_be[:, Datum.ALT_ALLELE_AS_BASE_5_IDX])
+    return make_variant_keys(data_be[:, Datum.CONTIG_IDX], data_be[:, Datum.POSITION_IDX], alts)
+
+
+def variant_keys_from_vcf_records(records, contig_name_to_index) -> np.ndarray:
+    """
+    keys of cyvcf2 records.  Contigs that are not in the map get index -1, which never matches a datum.
+    """
+    contigs, positions, alts = [], [], []
+    for v in records:
+        contigs.append(contig_name_to_index.get(v.CHROM, -1))
+        positions.append(v.start + 1)   # cyvcf2 is zero-based
+        alts.append(bases_as_base5_int(trim_alleles_on_right(v.REF, v.ALT[0])[1]))  # TODO: we're assuming biallelic
+    return make_variant_keys(contigs, positions, np.array(alts, dtype=np.int64))
+
+
+class VariantKeyIndex:
+    """
+    sorted variant keys for vectorized lookup of the rows of a table.  As with a dict, if a key occurs more than once
+    the last row wins.
+    """
+    def __init__(self, keys: np.ndarray):
+        self.order = np.lexsort((keys['allele'], keys['locus']))    # stable, so duplicates stay in row order
+        self.sorted_keys = keys[self.order]
+
+    def __len__(self) -> int:
+        return len(self.sorted_keys)
+
+    def find(self, query_keys: np.ndarray) -> np.ndarray:
+        """
+        the row of each query key, or -1 if it is absent
+        """
+        if len(self.sorted_keys) == 0:
+            return np.full(len(query_keys), -1, dtype=np.int64)
+        positions = np.searchsorted(self.sorted_keys, query_keys, side='right') - 1
+        clipped = np.maximum(positions, 0)
+        found = (positions >= 0) & (self.sorted_keys[clipped] == query_keys)
+        return np.where(found, self.order[clipped], -1)
+
+    def contains(self, query_keys: np.ndarray) -> np.ndarray:
+        return self.find(query_keys) >= 0
@@ -14,7 +14,8 @@ setup(
                             'filter_variants=permutect.tools.filter_variants:main',
                             'preprocess_dataset=permutect.tools.preprocess_dataset:main',
                             'edit_dataset=permutect.tools.edit_dataset:main',
-                            'prune_dataset=permutect.tools.prune_dataset:main'
+                            'prune_dataset=permutect.tools.prune_dataset:main',
+                            'compile_artifact_model=permutect.tools.compile_artifact_model:main'
                             ]
     }
 )